@@ -1,11 +1,19 @@
 from abc import ABC, abstractmethod
-from collections import deque
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from datetime import datetime
 from struct import Struct
 import asyncio
+import errno
+import io
+import os
 import secrets
+import stat
+import tempfile
+import threading
 import zlib
-from typing import Any, Iterable, Generator, Tuple, Optional, Deque, Type, AsyncIterable, Callable, TypeVar
+from typing import IO, Any, Iterable, Iterator, Generator, Tuple, Optional, Deque, Type, AsyncIterable, Awaitable, Callable, TypeVar, List, Union, cast
 
 from Crypto.Cipher import AES
 from Crypto.Hash import HMAC, SHA1
@@ -20,6 +28,14 @@ _NO_COMPRESSION_BUFFERED_32 = object()
 _NO_COMPRESSION_BUFFERED_64 = object()
 _NO_COMPRESSION_STREAMED_32 = object()
 _NO_COMPRESSION_STREAMED_64 = object()
+_NO_COMPRESSION_TWO_PASS_32 = object()
+_NO_COMPRESSION_TWO_PASS_64 = object()
+_DEFLATED_32 = object()
+_DEFLATED_64 = object()
+_GZIPPED_32 = object()
+_GZIPPED_64 = object()
+_RAW_32 = object()
+_RAW_64 = object()
 _ZIP_32 = object()
 _ZIP_64 = object()
 
@@ -29,14 +45,15 @@ _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY = object()
 # Used internally to fetch the (default) zlib Compress object
 _CompressObjGetter = Callable[[], 'zlib._Compress']
 
-# Used by the internals of stream_zip - a "public" Method is a tuple of 5 things that controls the
+# Used by the internals of stream_zip - a "public" Method is a tuple of 6 things that controls the
 # format/process of making each member of the ZIP file.
 _MethodTuple = Tuple[
     object,              # Sentinel of the methods above
     object,              # Sentinel of auto upgrade central directory or not
     _CompressObjGetter,  # Function to get the zlib Compress object for
-    int,                 # The uncompressed size of the file for NO_COMPRESSION_STREAMED_* types
-    int,                 # The CRC32 of the file for NO_COMPRESSION_STREAMED_* types
+    int,                 # The uncompressed size of the file for NO_COMPRESSION_STREAMED_* and DEFLATED_* types
+    int,                 # The CRC32 of the file for NO_COMPRESSION_STREAMED_* and DEFLATED_* types
+    int,                 # The compressed size of the file for DEFLATED_* types
 ]
 
 # A "Method" is an instance of a class that has a _get function that returns a _MethodTuple
@@ -47,33 +64,80 @@ class Method(ABC):
 
 class _ZIP_64_TYPE(Method):
     def _get(self, offset: int, default_get_compressobj: _CompressObjGetter)  -> _MethodTuple:
-        return _ZIP_64, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0
+        return _ZIP_64, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0, 0
 
 class _ZIP_32_TYPE(Method):
     def _get(self, offset: int, default_get_compressobj: _CompressObjGetter)  -> _MethodTuple:
-        return _ZIP_32, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0
+        return _ZIP_32, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0, 0
 
 class _NO_COMPRESSION_32_TYPE(Method):
     def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
-        return _NO_COMPRESSION_BUFFERED_32, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0
+        return _NO_COMPRESSION_BUFFERED_32, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0, 0
 
     def __call__(self, uncompressed_size: int, crc_32: int) -> Method:
         class _NO_COMPRESSION_32_TYPE_STREAMED_TYPE(Method):
             def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
-                return _NO_COMPRESSION_STREAMED_32, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, uncompressed_size, crc_32
+                return _NO_COMPRESSION_STREAMED_32, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, uncompressed_size, crc_32, 0
 
         return _NO_COMPRESSION_32_TYPE_STREAMED_TYPE()
 
 class _NO_COMPRESSION_64_TYPE(Method):
     def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
-        return _NO_COMPRESSION_BUFFERED_64, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0
+        return _NO_COMPRESSION_BUFFERED_64, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0, 0
 
     def __call__(self, uncompressed_size: int, crc_32: int) -> Method:
         class _NO_COMPRESSION_64_TYPE_STREAMED_TYPE(Method):
             def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
-                return _NO_COMPRESSION_STREAMED_64, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, uncompressed_size, crc_32
+                return _NO_COMPRESSION_STREAMED_64, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, uncompressed_size, crc_32, 0
         return _NO_COMPRESSION_64_TYPE_STREAMED_TYPE()
 
+class _NO_COMPRESSION_32_TWO_PASS_TYPE(Method):
+    def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
+        return _NO_COMPRESSION_TWO_PASS_32, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0, 0
+
+class _NO_COMPRESSION_64_TWO_PASS_TYPE(Method):
+    def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
+        return _NO_COMPRESSION_TWO_PASS_64, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0, 0
+
+class _DEFLATED_32_TYPE():
+    def __call__(self, uncompressed_size: int, compressed_size: int, crc_32: int) -> Method:
+        class _DEFLATED_32_TYPE_INNER(Method):
+            def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
+                return _DEFLATED_32, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, uncompressed_size, crc_32, compressed_size
+
+        return _DEFLATED_32_TYPE_INNER()
+
+class _DEFLATED_64_TYPE():
+    def __call__(self, uncompressed_size: int, compressed_size: int, crc_32: int) -> Method:
+        class _DEFLATED_64_TYPE_INNER(Method):
+            def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
+                return _DEFLATED_64, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, uncompressed_size, crc_32, compressed_size
+
+        return _DEFLATED_64_TYPE_INNER()
+
+class _GZIPPED_32_TYPE(Method):
+    def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
+        return _GZIPPED_32, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0, 0
+
+class _GZIPPED_64_TYPE(Method):
+    def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
+        return _GZIPPED_64, _NO_AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, 0, 0, 0
+
+# A copy of a member file of an existing ZIP, whose already-compressed and possibly encrypted data
+# is output unchanged. Made by raw_member_files
+class _RawCopy(Method):
+    def __init__(self, compression: int, flags: int, aes_extra: bytes, uncompressed_size: int, compressed_size: int, crc_32: int) -> None:
+        self.compression = compression
+        self.flags = flags
+        self.aes_extra = aes_extra
+        self.uncompressed_size = uncompressed_size
+        self.compressed_size = compressed_size
+        self.crc_32 = crc_32
+
+    def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
+        method = _RAW_64 if self.uncompressed_size > 0xffffffff or self.compressed_size > 0xffffffff or offset > 0xffffffff else _RAW_32
+        return method, _AUTO_UPGRADE_CENTRAL_DIRECTORY, default_get_compressobj, self.uncompressed_size, self.crc_32, self.compressed_size
+
 class _ZIP_AUTO_TYPE():
     def __call__(self, uncompressed_size: int, level: int=9) -> Method:
         # The limit of 4293656841 is calculated using the logic from a zlib function
@@ -92,7 +156,7 @@ class _ZIP_AUTO_TYPE():
         class _ZIP_AUTO_TYPE_INNER(Method):
             def _get(self, offset: int, default_get_compressobj: _CompressObjGetter) -> _MethodTuple:
                 method = _ZIP_64 if uncompressed_size > 4293656841 or offset > 0xffffffff else _ZIP_32
-                return (method, _AUTO_UPGRADE_CENTRAL_DIRECTORY, lambda: zlib.compressobj(level=level, memLevel=8, wbits=-zlib.MAX_WBITS), 0, 0)
+                return (method, _AUTO_UPGRADE_CENTRAL_DIRECTORY, lambda: zlib.compressobj(level=level, memLevel=8, wbits=-zlib.MAX_WBITS), 0, 0, 0)
 
         return _ZIP_AUTO_TYPE_INNER()
 
@@ -103,6 +167,278 @@ class _Flusher(bytes):
 
 _flush = _Flusher()
 
+# Sentinel object as a command, used by async_stream_zip, that an awaitable be awaited and its
+# result stored on the object before iteration continues. Extends from bytes to pass type checking
+class _Await(bytes):
+    get_awaitable: Callable[[], Awaitable[Any]]
+    result: Any
+
+    def __new__(cls, get_awaitable: Callable[[], Awaitable[Any]]) -> '_Await':
+        awaiting = super().__new__(cls)
+        awaiting.get_awaitable = get_awaitable
+        awaiting.result = None
+        return awaiting
+
+# Sentinel object used by stream_zip_range in place of the data of a member file, so the ZIP can be
+# laid out without reading any data. Its length is the size of the data in the ZIP. Extends from
+# bytes to pass type checking
+class _DataRegion(bytes):
+    size: int
+    get_chunks: Callable[[int], Iterable[bytes]]
+    size_integrity_error: Type[Exception]
+
+    def __new__(cls, size: int, get_chunks: Callable[[int], Iterable[bytes]], size_integrity_error: Type[Exception]) -> '_DataRegion':
+        region = super().__new__(cls)
+        region.size = size
+        region.get_chunks = get_chunks
+        region.size_integrity_error = size_integrity_error
+        return region
+
+    def __len__(self) -> int:
+        return self.size
+
+# Used by stream_zip_to_fd in place of the data of a member file from stored_member_file, so the
+# data can be copied from the local file to the output file descriptor by the kernel
+class _LocalFileDataRegion(_DataRegion):
+    path: str
+    crc_32: int
+
+    def __new__(cls, local_file: '_LocalFile', size: int, crc_32: int) -> '_LocalFileDataRegion':
+        region = cast('_LocalFileDataRegion', super().__new__(cls, size, lambda offset: _file_chunks(local_file.path, local_file.chunk_size, offset), UncompressedSizeIntegrityError))
+        region.path = local_file.path
+        region.crc_32 = crc_32
+        return region
+
+# Sentinel object used by stream_zip_to_seekable, as a command that the bytes already output at
+# offset be overwritten, to fill in the CRC32 and sizes of a local header once the data has been
+# output. Extends from bytes to pass type checking
+class _Patch(bytes):
+    offset: int
+
+    def __new__(cls, offset: int, patch: bytes) -> '_Patch':
+        patching = super().__new__(cls, patch)
+        patching.offset = offset
+        return patching
+
+# Used by stream_zip_to_seekable in place of a zlib Compress object, so NO_COMPRESSION_32 and
+# NO_COMPRESSION_64 member files are output like ZIP_32 and ZIP_64, but stored rather than deflated
+class _StoredCompressObj():
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b''
+
+_get_stored_compress_obj: _CompressObjGetter = lambda: cast('zlib._Compress', _StoredCompressObj())
+
+# Under async_stream_zip, chunks at least this size are compressed or encrypted in a thread rather
+# than blocking the event loop. Smaller chunks are processed quicker than the thread hop would take
+_run_in_thread_min_size = 16384
+
+# Data of buffered member files that's spooled to a temporary file is read back in blocks of this size
+_spooled_read_size = 1048576
+
+T = TypeVar("T")
+
+# The shared state of members being compressed ahead of time in an executor: how many compressed
+# bytes are buffered but not yet output, and whether the workers should give up
+class _Lookahead():
+    def __init__(self, max_bytes: int) -> None:
+        self.condition = threading.Condition()
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.closed = False
+
+    def has_capacity(self) -> bool:
+        with self.condition:
+            return self.num_bytes < self.max_bytes
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class _LookaheadClosed(Exception):
+    pass
+
+# The data of a single member being compressed in an executor, ahead of when its local header is
+# output. The compressed chunks are buffered until the member is output. Only the member that is
+# being output can exceed the look-ahead budget, which means that output can always progress
+class _CompressedAhead():
+    def __init__(self, lookahead: _Lookahead, executor: Executor, chunks: Iterable[bytes], get_compress_obj: _CompressObjGetter) -> None:
+        self.lookahead = lookahead
+        self.chunks = chunks
+        self.get_compress_obj = get_compress_obj
+        self.compressed: Deque[Tuple[bytes, int]] = deque()
+        self.crc_32 = zlib.crc32(b'')
+        self.done = False
+        self.exception: Optional[BaseException] = None
+        self.is_being_output = False
+        self.future = executor.submit(self._compress)
+
+    def _compress(self) -> None:
+        try:
+            uncompressed_size = 0
+            compress_obj = self.get_compress_obj()
+            for chunk in self.chunks:
+                uncompressed_size += len(chunk)
+                self.crc_32 = zlib.crc32(chunk, self.crc_32)
+                self._append(compress_obj.compress(chunk), uncompressed_size)
+            self._append(compress_obj.flush(), uncompressed_size)
+        except _LookaheadClosed:
+            pass
+        except BaseException as e:
+            self.exception = e
+
+        with self.lookahead.condition:
+            self.done = True
+            self.lookahead.condition.notify_all()
+
+    def _append(self, compressed_chunk: bytes, uncompressed_size: int) -> None:
+        lookahead = self.lookahead
+        with lookahead.condition:
+            while lookahead.num_bytes >= lookahead.max_bytes and not self.is_being_output and not lookahead.closed:
+                lookahead.condition.wait()
+            if lookahead.closed:
+                raise _LookaheadClosed()
+            lookahead.num_bytes += len(compressed_chunk)
+            self.compressed.append((compressed_chunk, uncompressed_size))
+            lookahead.condition.notify_all()
+
+    def __iter__(self) -> Iterator[bytes]:
+        # Only iterated if the compression never started in the executor
+        return iter(self.chunks)
+
+    def start_output(self) -> bool:
+        # Returns False if the compression never started, and so the caller should compress the
+        # chunks itself. This avoids waiting for other work queued in the executor
+        with self.lookahead.condition:
+            self.is_being_output = True
+            self.lookahead.condition.notify_all()
+        return not self.future.cancel()
+
+    def get(self) -> Optional[Tuple[bytes, int]]:
+        # Returns the next compressed chunk and the uncompressed size so far, or None if the
+        # compression has finished
+        lookahead = self.lookahead
+        with lookahead.condition:
+            while not self.compressed and not self.done:
+                lookahead.condition.wait()
+            if self.compressed:
+                compressed_chunk, uncompressed_size = self.compressed.popleft()
+                lookahead.num_bytes -= len(compressed_chunk)
+                lookahead.condition.notify_all()
+                return compressed_chunk, uncompressed_size
+        if self.exception is not None:
+            raise self.exception
+        return None
+
+# Used when a member's data is deflated in independent blocks in parallel, pigz-style. Each block
+# is compressed after priming the compressor with the 32KiB of data before it, which is the same
+# as the window the decompressor will have. Each block ends with a sync flush so it ends on a byte
+# boundary, and the blocks are followed by an empty final block to end the deflate stream
+_deflate_window_size = 32768
+_deflate_empty_final_block = b'\x03\x00'
+
+def _deflate_block(get_compress_obj: _CompressObjGetter, block: bytes, window: bytes) -> Tuple[bytes, int]:
+    compress_obj = get_compress_obj()
+    if window:
+        compress_obj.compress(window)
+        compress_obj.flush(zlib.Z_SYNC_FLUSH)
+    return compress_obj.compress(block) + compress_obj.flush(zlib.Z_SYNC_FLUSH), zlib.crc32(block)
+
+# The CRC32 of the concatenation of two blocks can be calculated from the CRC32 of each, by
+# multiplying the first by a matrix over GF(2) that depends only on the length of the second.
+# This is the approach of zlib's crc32_combine, which Python doesn't expose
+def _gf2_matrix_times(matrix: List[int], vector: int) -> int:
+    total = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return total
+
+def _gf2_matrix_square(matrix: List[int]) -> List[int]:
+    return [_gf2_matrix_times(matrix, row) for row in matrix]
+
+def _crc_32_combine_matrix(length: int) -> List[int]:
+    # The operator for one zero bit, which is then squared to get the operator for 2 bits, 4
+    # bits, 8 bits (1 byte), 2 bytes etc. These are multiplied together for each bit in length
+    combine_matrix = [1 << n for n in range(0, 32)]
+    operator = [0xedb88320] + [1 << n for n in range(0, 31)]
+    for _ in range(0, 3):
+        operator = _gf2_matrix_square(operator)
+    while length:
+        if length & 1:
+            combine_matrix = [_gf2_matrix_times(operator, row) for row in combine_matrix]
+        length >>= 1
+        if length:
+            operator = _gf2_matrix_square(operator)
+    return combine_matrix
+
+def _crc_32_combine(crc_32_1: int, crc_32_2: int, combine_matrix: List[int]) -> int:
+    return _gf2_matrix_times(combine_matrix, crc_32_1) ^ crc_32_2
+
+# The data of a GZIPPED_* member. The deflate stream inside the gzip data is output as the
+# compressed data of the member, rather than being compressed again
+class _Gzipped():
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self.chunks = chunks
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self.chunks)
+
+_gzip_signature = b'\x1f\x8b'
+_gzip_trailer_struct = Struct('<II')
+
+def _gzip_header_length(header: bytes) -> Optional[int]:
+    # The length of the gzip header at the start of the data, or None if more data is needed
+    if len(header) < 10:
+        return None
+    if header[0:2] != _gzip_signature or header[2] != 8 or header[3] & 0b11100000:
+        raise GzipIntegrityError()
+
+    flags = header[3]
+    length = 10
+    if flags & 0b00000100:  # Extra field
+        if len(header) < length + 2:
+            return None
+        length += 2 + int.from_bytes(header[length:length + 2], 'little')
+    for flag in (0b00001000, 0b00010000):  # File name, then comment, each zero-terminated
+        if flags & flag:
+            end = header.find(b'\x00', length)
+            if end == -1:
+                return None
+            length = end + 1
+    if flags & 0b00000010:  # CRC16 of the header
+        length += 2
+
+    return length if len(header) >= length else None
+
+def _raise_if_beyond_gzip_trailer(trailer: bytes) -> None:
+    # Anything after the 8 byte trailer is either another gzip member, or not valid
+    if len(trailer) > 8:
+        raise \
+            MultiMemberGzipError() if trailer[8:10] == _gzip_signature[:len(trailer) - 8] else \
+            GzipIntegrityError()
+
+# Used to check the data of already-deflated members. The inflated data is only needed for its
+# size and CRC32, so it's inflated in bounded pieces to not need much memory for highly compressed data.
+# Once the end of the deflate stream is reached, any bytes after it are in unused_data, and
+# unconsumed_tail is left as it was, so it's not fed back in
+def _inflated_size_crc_32(decompress_obj: 'zlib._Decompress', chunk: bytes, crc_32: int) -> Tuple[int, int]:
+    size = 0
+    while chunk:
+        uncompressed = decompress_obj.decompress(chunk, 65536)
+        size += len(uncompressed)
+        crc_32 = zlib.crc32(uncompressed, crc_32)
+        if decompress_obj.eof:
+            break
+        chunk = decompress_obj.unconsumed_tail
+    return size, crc_32
+
 
 ###############################
 # Public sentinel objects/types
@@ -112,478 +448,1124 @@ ZIP_64 = _ZIP_64_TYPE()
 ZIP_32 = _ZIP_32_TYPE()
 NO_COMPRESSION_32 = _NO_COMPRESSION_32_TYPE()
 NO_COMPRESSION_64 = _NO_COMPRESSION_64_TYPE()
+NO_COMPRESSION_32_TWO_PASS = _NO_COMPRESSION_32_TWO_PASS_TYPE()
+NO_COMPRESSION_64_TWO_PASS = _NO_COMPRESSION_64_TWO_PASS_TYPE()
+DEFLATED_32 = _DEFLATED_32_TYPE()
+DEFLATED_64 = _DEFLATED_64_TYPE()
+GZIPPED_32 = _GZIPPED_32_TYPE()
+GZIPPED_64 = _GZIPPED_64_TYPE()
 ZIP_AUTO = _ZIP_AUTO_TYPE()
 
-# Each member file is a tuple of its name, last modified date, file mode, Method, and its bytes
-MemberFile = Tuple[str, datetime, int, Method, Iterable[bytes]]
-AsyncMemberFile = Tuple[str, datetime, int, Method, AsyncIterable[bytes]]
-
-
-def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
-               get_compressobj: _CompressObjGetter=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
-               extended_timestamps: bool=True,
-               password: Optional[str]=None,
-               get_crypto_random: Callable[[int], bytes]=lambda num_bytes: secrets.token_bytes(num_bytes),
-) -> Iterable[bytes]:
+# Each member file is a tuple of its name, last modified date, file mode, Method, and its bytes.
+# For the *_TWO_PASS methods, the bytes are a function that returns a fresh iterable of bytes
+MemberFile = Tuple[str, datetime, int, Method, Union[Iterable[bytes], Callable[[], Iterable[bytes]]]]
+AsyncMemberFile = Tuple[str, datetime, int, Method, Union[AsyncIterable[bytes], Callable[[], AsyncIterable[bytes]]]]
+
+
+# The CRC32s of local files, keyed by their absolute path, inode, modification time in nanoseconds,
+# and size. Held in an LRU in memory, and if a path is passed, also in a SQLite database so they
+# persist between processes
+_CRC32CacheKey = Tuple[str, int, int, int]
+
+class CRC32Cache():
+    def __init__(self, max_entries: int=65536, sqlite_path: Optional[str]=None) -> None:
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[_CRC32CacheKey, int]' = OrderedDict()
+        self._db = None
+
+        if sqlite_path is not None:
+            # Not all builds of Python have sqlite3, so only imported if needed
+            import sqlite3
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS crc_32 ('
+                    'path TEXT, inode INTEGER, modified_at_ns INTEGER, size INTEGER, crc_32 INTEGER, '
+                    'PRIMARY KEY (path, inode, modified_at_ns, size))'
+                )
 
-    def evenly_sized(chunks: Iterable[bytes]) -> Iterable[bytes]:
-        chunk = b''
-        offset = 0
-        it = iter(chunks)
+    def get(self, key: _CRC32CacheKey) -> Optional[int]:
+        with self._lock:
+            crc_32 = self._entries.get(key)
+            if crc_32 is not None:
+                self._entries.move_to_end(key)
+                return crc_32
+
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                'SELECT crc_32 FROM crc_32 WHERE path = ? AND inode = ? AND modified_at_ns = ? AND size = ?', key,
+            ).fetchone()
+            if row is None:
+                return None
+            crc_32 = int(row[0])
+            self._set_in_memory(key, crc_32)
+            return crc_32
+
+    def set(self, key: _CRC32CacheKey, crc_32: int) -> None:
+        with self._lock:
+            self._set_in_memory(key, crc_32)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('INSERT OR REPLACE INTO crc_32 VALUES (?, ?, ?, ?, ?)', key + (crc_32,))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _set_in_memory(self, key: _CRC32CacheKey, crc_32: int) -> None:
+        self._entries[key] = crc_32
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+def _file_chunks(path: str, chunk_size: int, offset: int=0) -> Iterable[bytes]:
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        yield from iter(lambda: f.read(chunk_size), b'')
+
+
+# The data of a local file, read in chunks when iterated over. Made by stored_member_file, and
+# recognised by stream_zip_to_fd so the data can be copied straight from the file by the kernel
+class _LocalFile():
+    def __init__(self, path: str, chunk_size: int) -> None:
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(_file_chunks(self.path, self.chunk_size))
+
+
+def stored_member_file(path: str, crc_32_cache: CRC32Cache, name: Optional[str]=None,
+                       method: Callable[[int, int], Method]=NO_COMPRESSION_64,
+                       chunk_size: int=65536) -> MemberFile:
+    # A member file of a local file that's stored without compression, and so is always streamed
+    # rather than buffered. The CRC32 is taken from the cache, or if not present, found by reading
+    # the file and then cached
+    stat_result = os.stat(path)
+    key = (os.path.abspath(path), stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+    crc_32 = crc_32_cache.get(key)
+    if crc_32 is None:
+        size = 0
+        crc_32 = zlib.crc32(b'')
+        for chunk in _file_chunks(path, chunk_size):
+            size += len(chunk)
+            crc_32 = zlib.crc32(chunk, crc_32)
+        # If the file is being changed, not caching means the next use won't be stale
+        if size == stat_result.st_size:
+            crc_32_cache.set(key, crc_32)
+
+    return (
+        name if name is not None else os.path.basename(path),
+        datetime.fromtimestamp(stat_result.st_mtime),
+        stat_result.st_mode,
+        method(stat_result.st_size, crc_32),
+        _LocalFile(path, chunk_size),
+    )
 
-        def up_to(num: int) -> Iterable[bytes]:
-            nonlocal chunk, offset
 
-            while num:
-                if offset == len(chunk):
-                    try:
-                        chunk = next(it)
-                    except StopIteration:
-                        break
-                    else:
-                        offset = 0
-                        if chunk is _flush:
-                            chunk = b''
-                            break
-                to_yield = min(num, len(chunk) - offset)
-                offset = offset + to_yield
-                num -= to_yield
-                yield chunk[offset - to_yield:offset]
+# Signatures, structs and flags of the records of ZIP files, shared by every ZIP made or read
+_local_header_signature = b'PK\x03\x04'
+_local_header_struct = Struct('<HHH4sIIIHH')
+_local_header_crc_32_offset = 14
+_local_header_crc_32_struct = Struct('<I')
+_local_header_crc_32_and_sizes_struct = Struct('<III')
+_local_header_zip_64_extra_sizes_struct = Struct('<QQ')
+
+_data_descriptor_signature = b'PK\x07\x08'
+_data_descriptor_zip_64_struct = Struct('<IQQ')
+_data_descriptor_zip_32_struct = Struct('<III')
+
+_central_directory_header_signature = b'PK\x01\x02'
+_central_directory_header_struct = Struct('<BBBBHH4sIIIHHHHHII')
+
+_zip_64_end_of_central_directory_signature = b'PK\x06\x06'
+_zip_64_end_of_central_directory_struct = Struct('<QHHIIQQQQ')
+
+_zip_64_end_of_central_directory_locator_signature = b'PK\x06\x07'
+_zip_64_end_of_central_directory_locator_struct = Struct('<IQI')
+
+_end_of_central_directory_signature = b'PK\x05\x06'
+_end_of_central_directory_struct = Struct('<HHHHIIH')
+
+_zip_64_extra_signature = b'\x01\x00'
+_zip_64_local_extra_struct = Struct('<2sHQQ')
+_zip_64_central_directory_extra_struct = Struct('<2sHQQQ')
+
+_mod_at_unix_extra_signature = b'UT'
+_mod_at_unix_extra_struct = Struct('<2sH1sl')
+
+_aes_extra_signature = b'\x01\x99'
+_aes_extra_struct = Struct('<2sHH2sBH')
+
+_extra_header_struct = Struct('<HH')
+_modified_at_struct = Struct('<HH')
+
+_aes_flag = 0b0000000000000001
+_data_descriptor_flag = 0b0000000000001000
+_utf8_flag = 0b0000100000000000
+
+
+def _end_of_central_directory(fileobj: IO[bytes]) -> Tuple[int, int, int, bool]:
+    # The number of entries, size and offset of the central directory of an existing ZIP in a seekable
+    # file, and whether it has Zip64 end of central directory records
+
+    # The end of central directory record is at the end of the file, before a comment of up to 64KiB
+    fileobj.seek(0, os.SEEK_END)
+    file_size = fileobj.tell()
+    tail_offset = max(0, file_size - len(_end_of_central_directory_signature) - _end_of_central_directory_struct.size - 0xffff)
+    fileobj.seek(tail_offset)
+    tail = fileobj.read()
+    end_of_central_directory_position = tail.rfind(_end_of_central_directory_signature)
+    if end_of_central_directory_position == -1:
+        raise InvalidZipError()
+    _, _, _, num_entries, central_directory_size, central_directory_offset, _ = _end_of_central_directory_struct.unpack_from(
+        tail, end_of_central_directory_position + len(_end_of_central_directory_signature))
+
+    locator_position = end_of_central_directory_position - len(_zip_64_end_of_central_directory_locator_signature) - _zip_64_end_of_central_directory_locator_struct.size
+    if locator_position < 0 or tail[locator_position:locator_position + 4] != _zip_64_end_of_central_directory_locator_signature:
+        return num_entries, central_directory_size, central_directory_offset, False
+
+    _, zip_64_end_of_central_directory_offset, _ = _zip_64_end_of_central_directory_locator_struct.unpack_from(tail, locator_position + 4)
+    fileobj.seek(zip_64_end_of_central_directory_offset)
+    zip_64_end_of_central_directory = fileobj.read(len(_zip_64_end_of_central_directory_signature) + _zip_64_end_of_central_directory_struct.size)
+    if zip_64_end_of_central_directory[:4] != _zip_64_end_of_central_directory_signature:
+        raise InvalidZipError()
+    _, _, _, _, _, _, num_entries, central_directory_size, central_directory_offset = _zip_64_end_of_central_directory_struct.unpack_from(
+        zip_64_end_of_central_directory, 4)
+    return num_entries, central_directory_size, central_directory_offset, True
+
+
+def raw_member_files(fileobj: IO[bytes], chunk_size: int=65536) -> Iterable[MemberFile]:
+    # The member files of an existing ZIP in a seekable file, whose data is copied into the new ZIP
+    # as is, without decompressing and compressing it again. The data of each is read from the file
+    # when it's iterated over, so the file must stay open until the new ZIP has been made
+
+    def data(local_header_offset: int, compressed_size: int) -> Iterable[bytes]:
+        fileobj.seek(local_header_offset)
+        local_header = fileobj.read(len(_local_header_signature) + _local_header_struct.size)
+        if local_header[:len(_local_header_signature)] != _local_header_signature or len(local_header) != len(_local_header_signature) + _local_header_struct.size:
+            raise InvalidZipError()
+        *_, name_length, extra_length = _local_header_struct.unpack_from(local_header, len(_local_header_signature))
+        fileobj.seek(local_header_offset + len(local_header) + name_length + extra_length)
+
+        remaining = compressed_size
+        while remaining:
+            chunk = fileobj.read(min(chunk_size, remaining))
+            if not chunk:
+                raise InvalidZipError()
+            remaining -= len(chunk)
+            yield chunk
 
-        while True:
-            block = b''.join(up_to(chunk_size))
-            if not block:
-                break
-            yield block
+    def modified_at_from_ms_dos(mod_at_ms_dos: bytes) -> datetime:
+        time, date = _modified_at_struct.unpack(mod_at_ms_dos)
+        try:
+            return datetime((date >> 9) + 1980, (date >> 5) & 0xf, date & 0x1f, time >> 11, (time >> 5) & 0x3f, (time & 0x1f) * 2)
+        except ValueError:
+            return datetime(1980, 1, 1)
+
+    num_entries, central_directory_size, central_directory_offset, _ = _end_of_central_directory(fileobj)
+
+    fileobj.seek(central_directory_offset)
+    central_directory = fileobj.read(central_directory_size)
+    if len(central_directory) != central_directory_size:
+        raise InvalidZipError()
+
+    position = 0
+    for _ in range(0, num_entries):
+        if central_directory[position:position + 4] != _central_directory_header_signature:
+            raise InvalidZipError()
+        _, _, _, _, flags, compression, mod_at_ms_dos, crc_32, compressed_size, uncompressed_size, \
+            name_length, extra_length, comment_length, _, _, external_attr, local_header_offset = \
+            _central_directory_header_struct.unpack_from(central_directory, position + 4)
+        position += 4 + _central_directory_header_struct.size
+        name_encoded = central_directory[position:position + name_length]
+        extra = central_directory[position + name_length:position + name_length + extra_length]
+        position += name_length + extra_length + comment_length
+
+        # Traditional PKWARE encryption, strong encryption and masked headers can't be copied
+        if (flags & 0b0000000000000001 and compression != 99) or flags & 0b0010000001000000:
+            raise UnsupportedZipError()
+
+        aes_extra = b''
+        mod_at_unix: Optional[int] = None
+        extra_position = 0
+        while extra_position + _extra_header_struct.size <= len(extra):
+            header_id, size = _extra_header_struct.unpack_from(extra, extra_position)
+            field = extra[extra_position + _extra_header_struct.size:extra_position + _extra_header_struct.size + size]
+            if header_id == 0x0001:
+                # Zip64 extra: only the values that don't fit in the header, in this order
+                values = iter(Struct('<' + 'Q' * (size // 8)).unpack_from(field))
+                uncompressed_size = next(values) if uncompressed_size == 0xffffffff else uncompressed_size
+                compressed_size = next(values) if compressed_size == 0xffffffff else compressed_size
+                local_header_offset = next(values) if local_header_offset == 0xffffffff else local_header_offset
+            elif header_id == 0x9901:
+                aes_extra = extra[extra_position:extra_position + _extra_header_struct.size + size]
+            elif header_id == 0x5455 and size >= 5 and field[0] & 0b00000001:
+                mod_at_unix = int.from_bytes(field[1:5], 'little', signed=True)
+            extra_position += _extra_header_struct.size + size
+
+        yield (
+            name_encoded.decode('utf-8' if flags & 0b0000100000000000 else 'cp437'),
+            datetime.fromtimestamp(mod_at_unix) if mod_at_unix is not None else modified_at_from_ms_dos(mod_at_ms_dos),
+            external_attr >> 16,
+            _RawCopy(compression, flags & 0b0000000000000111, aes_extra, uncompressed_size, compressed_size, crc_32),
+            data(local_header_offset, compressed_size),
+        )
+
+
+def _evenly_sized(chunks: Iterable[bytes], chunk_size: int) -> Iterable[bytes]:
+    # Each output block is either an input chunk passed straight through if it's already
+    # exactly the right size, or a single copy of zero-copy memoryview slices of input chunks.
+    # Input chunks that aren't bytes, for example memoryviews of reused buffers, can change once
+    # the next is requested, so they're copied if passed through or kept until the next block
+    pending: List[memoryview] = []
+    pending_size = 0
+
+    for chunk in chunks:
+        if isinstance(chunk, _Await):
+            yield chunk
+            continue
 
-    def get_zipped_chunks_uneven() -> Iterable[bytes]:
-        local_header_signature = b'PK\x03\x04'
-        local_header_struct = Struct('<HHH4sIIIHH')
+        if chunk is _flush:
+            if pending:
+                yield b''.join(pending)
+                pending = []
+                pending_size = 0
+            continue
 
-        data_descriptor_signature = b'PK\x07\x08'
-        data_descriptor_zip_64_struct = Struct('<IQQ')
-        data_descriptor_zip_32_struct = Struct('<III')
+        chunk_view = memoryview(chunk)
+        offset = 0
+        while pending_size + len(chunk) - offset >= chunk_size:
+            to_yield = chunk_size - pending_size
+            if pending:
+                pending.append(chunk_view[offset:offset + to_yield])
+                yield b''.join(pending)
+                pending = []
+                pending_size = 0
+            else:
+                yield chunk if to_yield == len(chunk) and type(chunk) is bytes else bytes(chunk_view[offset:offset + to_yield])
+            offset += to_yield
+
+        if offset != len(chunk):
+            pending.append(chunk_view[offset:] if type(chunk) is bytes else memoryview(bytes(chunk_view[offset:])))
+            pending_size += len(chunk) - offset
+
+    if pending:
+        yield b''.join(pending)
+
+
+def _zipped_chunks_uneven(files: Iterable[MemberFile],
+                          get_compressobj: _CompressObjGetter,
+                          extended_timestamps: bool,
+                          password: Optional[str],
+                          get_crypto_random: Callable[[int], bytes],
+                          executor: Optional[Executor],
+                          lookahead_members: int,
+                          lookahead_bytes: int,
+                          deflate_block_size: Optional[int],
+                          run_in_thread: Optional[Callable[[Callable[[], Any]], Awaitable[Any]]]=None,
+                          central_directory_memory_limit: Optional[int]=None,
+                          buffer_memory_limit: Optional[int]=None,
+                          temp_dir: Optional[str]=None,
+                          existing_central_directory: bytes=b'',
+                          existing_central_directory_length: int=0,
+                          existing_zip_64_central_directory: bool=False,
+                          start_offset: int=0,
+                          seekable: bool=False,
+                          layout_only: bool=False,
+) -> Iterable[bytes]:
+    if deflate_block_size is not None and deflate_block_size < 1:
+        raise ValueError('deflate_block_size must be at least 1')
+
+    # The annotations of the functions below are strings so they're not evaluated, which would
+    # otherwise dominate the time to make small ZIP files
+    #
+    # The central directory records are appended to a single buffer rather than kept as separate
+    # bytes instances, since per-object overhead would otherwise dominate for many small members
+    # When appending to an existing ZIP, its central directory records are kept as they are, and
+    # new member files start where its central directory started
+    central_directory = bytearray(existing_central_directory)
+    central_directory_file: Optional[IO[bytes]] = None
+    central_directory_length = existing_central_directory_length
+    central_directory_size = len(existing_central_directory)
+    central_directory_start_offset = start_offset
+    central_directory_end_offset = start_offset + central_directory_size
+    zip_64_central_directory = existing_zip_64_central_directory
+    offset = start_offset
+
+    def _(chunk: bytes) -> 'Iterable[bytes]':
+        nonlocal offset
+        offset += len(chunk)
+        yield chunk
 
-        central_directory_header_signature = b'PK\x01\x02'
-        central_directory_header_struct = Struct('<BBBBHH4sIIIHHHHHII')
+    def _raise_if_beyond(offset: int, maximum: int, exception_class: 'Type[Exception]') -> None:
+        if offset > maximum:
+            raise exception_class()
+
+    def _run(func: 'Callable[[], T]', is_cpu_heavy: bool) -> 'Generator[bytes, None, T]':
+        # Under async_stream_zip, CPU-heavy functions are run in a thread to not block the event
+        # loop. Otherwise, or if not CPU-heavy, they're just called
+        if run_in_thread is None or not is_cpu_heavy:
+            return func()
+
+        awaiting = _Await(lambda: run_in_thread(func))
+        yield awaiting
+        result: T = awaiting.result
+        return result
+
+    def _with_returned(gen: 'Generator[bytes, None, Any]') -> 'Tuple[Callable[[], Any], Iterable[bytes]]':
+        # We leverage the not-often used "return value" of generators. Here, we want to iterate
+        # over chunks (to encrypt them), but still return the same "return value". So we use a
+        # bit of a trick to extract the return value but still have access to the chunks as
+        # we iterate over them
+
+        return_value = None
+        def with_return_value() -> 'Iterable[bytes]':
+            nonlocal return_value
+            return_value = yield from gen
+
+        return ((lambda: return_value), with_return_value())
+
+    def _encrypt_dummy(chunks: 'Generator[bytes, None, Any]') -> 'Generator[bytes, None, Any]':
+        get_return_value, chunks_with_return = _with_returned(chunks)
+        for chunk in chunks_with_return:
+            yield from _(chunk)
+        return get_return_value()
+
+    # This slightly complex getter allows mypy to work out that the _encrypt_aes function is
+    # only called when we have a non-None password, which then passes type checking for the
+    # PBKDF2 function that the password is passed into
+    def _get_encrypt_aes(password: str) -> 'Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]':
+        def _encrypt_aes(chunks: 'Generator[bytes, None, Any]') -> 'Generator[bytes, None, Any]':
+            key_length = 32
+            salt_length = 16
+            password_verification_length = 2
+
+            salt = get_crypto_random(salt_length)
+            yield from _(salt)
+
+            keys = yield from _run(lambda: PBKDF2(password, salt, 2 * key_length + password_verification_length, 1000), is_cpu_heavy=True)
+            yield from _(keys[-password_verification_length:])
+
+            encrypter = AES.new(
+                keys[:key_length], AES.MODE_CTR,
+                counter=Counter.new(nbits=128, little_endian=True),
+            )
+            hmac = HMAC.new(keys[key_length:key_length*2], digestmod=SHA1)
 
-        zip_64_end_of_central_directory_signature = b'PK\x06\x06'
-        zip_64_end_of_central_directory_struct = Struct('<QHHIIQQQQ')
+            get_return_value, chunks_with_return = _with_returned(chunks)
+            def encrypt(chunk: bytes) -> bytes:
+                encrypted_chunk = encrypter.encrypt(chunk)
+                hmac.update(encrypted_chunk)
+                return encrypted_chunk
 
-        zip_64_end_of_central_directory_locator_signature= b'PK\x06\x07'
-        zip_64_end_of_central_directory_locator_struct = Struct('<IQI')
+            for chunk in chunks_with_return:
+                if isinstance(chunk, _Await):
+                    yield chunk
+                    continue
+                encrypted_chunk = yield from _run(lambda: encrypt(chunk), is_cpu_heavy=len(chunk) >= _run_in_thread_min_size)
+                yield from _(encrypted_chunk)
 
-        end_of_central_directory_signature = b'PK\x05\x06'
-        end_of_central_directory_struct = Struct('<HHHHIIH')
-        
-        zip_64_extra_signature = b'\x01\x00'
-        zip_64_local_extra_struct = Struct('<2sHQQ')
-        zip_64_central_directory_extra_struct = Struct('<2sHQQQ')
+            yield from _(hmac.digest()[:10])
 
-        mod_at_unix_extra_signature = b'UT'
-        mod_at_unix_extra_struct = Struct('<2sH1sl')
+            return get_return_value()
+        return _encrypt_aes
+
+    # Used when only the layout of the ZIP is needed, and the data of member files are _DataRegion
+    # placeholders. The salt, password verification value and HMAC that AES encryption adds are
+    # output as zero bytes of the same length, without the cost of deriving the keys
+    def _encrypt_aes_layout(chunks: 'Generator[bytes, None, Any]') -> 'Generator[bytes, None, Any]':
+        get_return_value, chunks_with_return = _with_returned(chunks)
+        yield from _(bytes(18))
+        for chunk in chunks_with_return:
+            yield from _(chunk)
+        yield from _(bytes(10))
+        return get_return_value()
+
+    def _zip_64_local_header_and_data(
+            compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
+            mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
+            crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: 'Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]',
+            chunks: 'Iterable[bytes]',
+    ) -> 'Generator[bytes, None, Tuple[bytes, bytes, bytes]]':
+        file_offset = offset
+
+        _raise_if_beyond(file_offset, maximum=0xffffffffffffffff, exception_class=OffsetOverflowError)
+
+        extra = _zip_64_local_extra_struct.pack(
+            _zip_64_extra_signature,
+            16,  # Size of extra
+            0,   # Uncompressed size - since data descriptor
+            0,   # Compressed size - since data descriptor
+        ) + mod_at_unix_extra + aes_extra
+        flags = aes_flags | (0 if seekable else _data_descriptor_flag) | _utf8_flag
+
+        yield from _(_local_header_signature)
+        yield from _(_local_header_struct.pack(
+            45,           # Version
+            flags,
+            compression,
+            mod_at_ms_dos,
+            0,            # CRC32 - 0 since data descriptor or patched
+            0xffffffff,   # Compressed size - since zip64
+            0xffffffff,   # Uncompressed size - since zip64
+            len(name_encoded),
+            len(extra),
+        ))
+        yield from _(name_encoded)
+        yield from _(extra)
+        yield _flush
+
+        uncompressed_size, raw_compressed_size, crc_32 = yield from encryption_func(_zip_data(
+            chunks,
+            _get_compress_obj,
+            max_uncompressed_size=0xffffffffffffffff,
+            max_compressed_size=0xffffffffffffffff,
+        ))
+        compressed_size = raw_compressed_size + aes_size_increase
+        masked_crc_32 = crc_32 & crc_32_mask
+
+        if seekable:
+            yield _Patch(file_offset + _local_header_crc_32_offset, _local_header_crc_32_struct.pack(masked_crc_32))
+            yield _Patch(
+                file_offset + len(_local_header_signature) + _local_header_struct.size + len(name_encoded) + 4,
+                _local_header_zip_64_extra_sizes_struct.pack(uncompressed_size, compressed_size),
+            )
+        else:
+            yield from _(_data_descriptor_signature)
+            yield from _(_data_descriptor_zip_64_struct.pack(masked_crc_32, compressed_size, uncompressed_size))
+
+        extra = _zip_64_central_directory_extra_struct.pack(
+            _zip_64_extra_signature,
+            24,  # Size of extra
+            uncompressed_size,
+            compressed_size,
+            file_offset,
+        ) + mod_at_unix_extra + aes_extra
+        return _central_directory_header_struct.pack(
+            45,           # Version made by
+            3,            # System made by (UNIX)
+            45,           # Version required
+            0,            # Reserved
+            flags,
+            compression,
+            mod_at_ms_dos,
+            masked_crc_32,
+            0xffffffff,   # Compressed size - since zip64
+            0xffffffff,   # Uncompressed size - since zip64
+            len(name_encoded),
+            len(extra),
+            0,            # File comment length
+            0,            # Disk number
+            0,            # Internal file attributes - is binary
+            external_attr,
+            0xffffffff,   # Offset of local header - since zip64
+        ), name_encoded, extra
+
+    def _zip_32_local_header_and_data(
+            compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
+            mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
+            crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: 'Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]',
+            chunks: 'Iterable[bytes]',
+    ) -> 'Generator[bytes, None, Tuple[bytes, bytes, bytes]]':
+        file_offset = offset
+
+        _raise_if_beyond(file_offset, maximum=0xffffffff, exception_class=OffsetOverflowError)
+
+        extra = mod_at_unix_extra + aes_extra
+        flags = aes_flags | (0 if seekable else _data_descriptor_flag) | _utf8_flag
+
+        yield from _(_local_header_signature)
+        yield from _(_local_header_struct.pack(
+            20,           # Version
+            flags,
+            compression,
+            mod_at_ms_dos,
+            0,            # CRC32 - 0 since data descriptor or patched
+            0,            # Compressed size - 0 since data descriptor or patched
+            0,            # Uncompressed size - 0 since data descriptor or patched
+            len(name_encoded),
+            len(extra),
+        ))
+        yield from _(name_encoded)
+        yield from _(extra)
+        yield _flush
+
+        uncompressed_size, raw_compressed_size, crc_32 = yield from encryption_func(_zip_data(
+            chunks,
+            _get_compress_obj,
+            max_uncompressed_size=0xffffffff,
+            max_compressed_size=0xffffffff,
+        ))
+        compressed_size = raw_compressed_size + aes_size_increase
+        masked_crc_32 = crc_32 & crc_32_mask
+
+        if seekable:
+            yield _Patch(file_offset + _local_header_crc_32_offset, _local_header_crc_32_and_sizes_struct.pack(masked_crc_32, compressed_size, uncompressed_size))
+        else:
+            yield from _(_data_descriptor_signature)
+            yield from _(_data_descriptor_zip_32_struct.pack(masked_crc_32, compressed_size, uncompressed_size))
+
+        return _central_directory_header_struct.pack(
+            20,           # Version made by
+            3,            # System made by (UNIX)
+            20,           # Version required
+            0,            # Reserved
+            flags,
+            compression,
+            mod_at_ms_dos,
+            masked_crc_32,
+            compressed_size,
+            uncompressed_size,
+            len(name_encoded),
+            len(extra),
+            0,            # File comment length
+            0,            # Disk number
+            0,            # Internal file attributes - is binary
+            external_attr,
+            file_offset,
+        ), name_encoded, extra
+
+    def _zip_data(chunks: 'Iterable[bytes]', _get_compress_obj: _CompressObjGetter,
+                  max_uncompressed_size: int, max_compressed_size: int) -> 'Generator[bytes, None, Tuple[int, int, int]]':
+        if isinstance(chunks, _Gzipped):
+            return (yield from _zip_data_gzipped(chunks, max_uncompressed_size, max_compressed_size))
+
+        if isinstance(chunks, _CompressedAhead) and chunks.start_output():
+            return (yield from _zip_data_compressed_ahead(chunks, max_uncompressed_size, max_compressed_size))
+
+        if _is_deflated_in_blocks(_get_compress_obj):
+            return (yield from _zip_data_in_blocks(chunks, _get_compress_obj, max_uncompressed_size, max_compressed_size))
+
+        uncompressed_size = 0
+        compressed_size = 0
+        crc_32 = zlib.crc32(b'')
+        compress_obj = _get_compress_obj()
+        for chunk in chunks:
+            if isinstance(chunk, _Await):
+                yield chunk
+                continue
 
-        aes_extra_signature = b'\x01\x99'
-        aes_extra_struct = Struct('<2sHH2sBH')
+            uncompressed_size += len(chunk)
 
-        modified_at_struct = Struct('<HH')
+            _raise_if_beyond(uncompressed_size, maximum=max_uncompressed_size, exception_class=UncompressedSizeOverflowError)
 
-        aes_flag = 0b0000000000000001
-        data_descriptor_flag = 0b0000000000001000
-        utf8_flag = 0b0000100000000000
+            crc_32 = zlib.crc32(chunk, crc_32)
+            compressed_chunk = yield from _run(lambda: compress_obj.compress(chunk), is_cpu_heavy=len(chunk) >= _run_in_thread_min_size)
+            compressed_size += len(compressed_chunk)
 
-        central_directory: Deque[Tuple[bytes, bytes, bytes]] = deque()
-        central_directory_size = 0
-        central_directory_start_offset = 0
-        zip_64_central_directory = False
-        offset = 0
+            _raise_if_beyond(compressed_size, maximum=max_compressed_size, exception_class=CompressedSizeOverflowError)
 
-        def _(chunk: bytes) -> Iterable[bytes]:
-            nonlocal offset
-            offset += len(chunk)
-            yield chunk
+            yield compressed_chunk
 
-        def _raise_if_beyond(offset: int, maximum: int, exception_class: Type[Exception]) -> None:
-            if offset > maximum:
-                raise exception_class()
+        compressed_chunk = compress_obj.flush()
+        compressed_size += len(compressed_chunk)
 
-        def _with_returned(gen: Generator[bytes, None, Any]) -> Tuple[Callable[[], Any], Iterable[bytes]]:
-            # We leverage the not-often used "return value" of generators. Here, we want to iterate
-            # over chunks (to encrypt them), but still return the same "return value". So we use a
-            # bit of a trick to extract the return value but still have access to the chunks as
-            # we iterate over them
+        _raise_if_beyond(compressed_size, maximum=max_compressed_size, exception_class=CompressedSizeOverflowError)
 
-            return_value = None
-            def with_return_value() -> Iterable[bytes]:
-                nonlocal return_value
-                return_value = yield from gen
+        yield compressed_chunk
 
-            return ((lambda: return_value), with_return_value())
+        return uncompressed_size, compressed_size, crc_32
 
-        def _encrypt_dummy(chunks: Generator[bytes, None, Any]) -> Generator[bytes, None, Any]:
-            get_return_value, chunks_with_return = _with_returned(chunks)
-            for chunk in chunks_with_return:
-                yield from _(chunk)
-            return get_return_value()
+    def _zip_data_gzipped(chunks: _Gzipped, max_uncompressed_size: int, max_compressed_size: int) -> 'Generator[bytes, None, Tuple[int, int, int]]':
+        # The deflate stream between the gzip header and trailer is output unchanged. It's inflated
+        # along the way to check it, to find where it ends, and to find its uncompressed size, since
+        # the trailer only has the size modulo 2^32
+        decompress_obj = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+        header = b''
+        header_length: Optional[int] = None
+        trailer: Optional[bytes] = None
+        uncompressed_size = 0
+        compressed_size = 0
+        crc_32 = zlib.crc32(b'')
 
-        # This slightly complex getter allows mypy to work out that the _encrypt_aes function is
-        # only called when we have a non-None password, which then passes type checking for the
-        # PBKDF2 function that the password is passed into
-        def _get_encrypt_aes(password: str) -> Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]:
-            def _encrypt_aes(chunks: Generator[bytes, None, Any]) -> Generator[bytes, None, Any]:
-                key_length = 32
-                salt_length = 16
-                password_verification_length = 2
+        for chunk in chunks:
+            if isinstance(chunk, _Await):
+                yield chunk
+                continue
 
-                salt = get_crypto_random(salt_length)
-                yield from _(salt)
+            if header_length is None:
+                header += chunk
+                header_length = _gzip_header_length(header)
+                if header_length is None:
+                    continue
+                chunk = header[header_length:]
 
-                keys = PBKDF2(password, salt, 2 * key_length + password_verification_length, 1000)
-                yield from _(keys[-password_verification_length:])
+            if trailer is not None:
+                trailer += chunk
+                _raise_if_beyond_gzip_trailer(trailer)
+                continue
 
-                encrypter = AES.new(
-                    keys[:key_length], AES.MODE_CTR,
-                    counter=Counter.new(nbits=128, little_endian=True),
+            try:
+                chunk_uncompressed_size, crc_32 = yield from _run(
+                    lambda: _inflated_size_crc_32(decompress_obj, chunk, crc_32),
+                    is_cpu_heavy=len(chunk) >= _run_in_thread_min_size,
                 )
-                hmac = HMAC.new(keys[key_length:key_length*2], digestmod=SHA1)
+            except zlib.error:
+                raise DeflateIntegrityError() from None
+            uncompressed_size += chunk_uncompressed_size
+            _raise_if_beyond(uncompressed_size, maximum=max_uncompressed_size, exception_class=UncompressedSizeOverflowError)
 
-                get_return_value, chunks_with_return = _with_returned(chunks)
-                for chunk in chunks_with_return:
-                    encrypted_chunk = encrypter.encrypt(chunk)
-                    hmac.update(encrypted_chunk)
-                    yield from _(encrypted_chunk)
+            if decompress_obj.eof:
+                trailer = decompress_obj.unused_data
+                _raise_if_beyond_gzip_trailer(trailer)
+                chunk = chunk[:len(chunk) - len(trailer)]
 
-                yield from _(hmac.digest()[:10])
+            compressed_size += len(chunk)
+            _raise_if_beyond(compressed_size, maximum=max_compressed_size, exception_class=CompressedSizeOverflowError)
+            if chunk:
+                yield chunk
 
-                return get_return_value()
-            return _encrypt_aes
+        if header_length is None:
+            raise GzipIntegrityError()
 
-        def _zip_64_local_header_and_data(
-                compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
-                mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
-                crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]],
-                chunks: Iterable[bytes],
-        ) -> Generator[bytes, None, Tuple[bytes, bytes, bytes]]:
-            file_offset = offset
+        if trailer is None:
+            raise DeflateIntegrityError()
 
-            _raise_if_beyond(file_offset, maximum=0xffffffffffffffff, exception_class=OffsetOverflowError)
+        if len(trailer) != 8:
+            raise GzipIntegrityError()
 
-            extra = zip_64_local_extra_struct.pack(
-                zip_64_extra_signature,
-                16,  # Size of extra
-                0,   # Uncompressed size - since data descriptor
-                0,   # Compressed size - since data descriptor
-            ) + mod_at_unix_extra + aes_extra
-            flags = aes_flags | data_descriptor_flag | utf8_flag
+        trailer_crc_32, trailer_uncompressed_size = _gzip_trailer_struct.unpack(trailer)
 
-            yield from _(local_header_signature)
-            yield from _(local_header_struct.pack(
-                45,           # Version
-                flags,
-                compression,
-                mod_at_ms_dos,
-                0,            # CRC32 - 0 since data descriptor
-                0xffffffff,   # Compressed size - since zip64
-                0xffffffff,   # Uncompressed size - since zip64
-                len(name_encoded),
-                len(extra),
-            ))
-            yield from _(name_encoded)
-            yield from _(extra)
-            yield _flush
+        if trailer_crc_32 != crc_32:
+            raise CRC32IntegrityError()
 
-            uncompressed_size, raw_compressed_size, crc_32 = yield from encryption_func(_zip_data(
-                chunks,
-                _get_compress_obj,
-                max_uncompressed_size=0xffffffffffffffff,
-                max_compressed_size=0xffffffffffffffff,
-            ))
-            compressed_size = raw_compressed_size + aes_size_increase
-            masked_crc_32 = crc_32 & crc_32_mask
+        if trailer_uncompressed_size != uncompressed_size & 0xffffffff:
+            raise UncompressedSizeIntegrityError()
 
-            yield from _(data_descriptor_signature)
-            yield from _(data_descriptor_zip_64_struct.pack(masked_crc_32, compressed_size, uncompressed_size))
+        return uncompressed_size, compressed_size, crc_32
 
-            extra = zip_64_central_directory_extra_struct.pack(
-                zip_64_extra_signature,
-                24,  # Size of extra
-                uncompressed_size,
-                compressed_size,
-                file_offset,
-            ) + mod_at_unix_extra + aes_extra
-            return central_directory_header_struct.pack(
-                45,           # Version made by
-                3,            # System made by (UNIX)
-                45,           # Version required
-                0,            # Reserved
-                flags,
-                compression,
-                mod_at_ms_dos,
-                masked_crc_32,
-                0xffffffff,   # Compressed size - since zip64
-                0xffffffff,   # Uncompressed size - since zip64
-                len(name_encoded),
-                len(extra),
-                0,            # File comment length
-                0,            # Disk number
-                0,            # Internal file attributes - is binary
-                external_attr,
-                0xffffffff,   # Offset of local header - since zip64
-            ), name_encoded, extra
-
-        def _zip_32_local_header_and_data(
-                compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
-                mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
-                crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]],
-                chunks: Iterable[bytes],
-        ) -> Generator[bytes, None, Tuple[bytes, bytes, bytes]]:
-            file_offset = offset
-
-            _raise_if_beyond(file_offset, maximum=0xffffffff, exception_class=OffsetOverflowError)
+    def _zip_data_compressed_ahead(compressed_ahead: _CompressedAhead,
+                                   max_uncompressed_size: int, max_compressed_size: int) -> 'Generator[bytes, None, Tuple[int, int, int]]':
+        uncompressed_size = 0
+        compressed_size = 0
+        while True:
+            compressed_chunk_and_uncompressed_size = compressed_ahead.get()
+            if compressed_chunk_and_uncompressed_size is None:
+                break
+            compressed_chunk, uncompressed_size = compressed_chunk_and_uncompressed_size
 
-            extra = mod_at_unix_extra + aes_extra
-            flags = aes_flags | data_descriptor_flag | utf8_flag
+            _raise_if_beyond(uncompressed_size, maximum=max_uncompressed_size, exception_class=UncompressedSizeOverflowError)
 
-            yield from _(local_header_signature)
-            yield from _(local_header_struct.pack(
-                20,           # Version
-                flags,
-                compression,
-                mod_at_ms_dos,
-                0,            # CRC32 - 0 since data descriptor
-                0,            # Compressed size - 0 since data descriptor
-                0,            # Uncompressed size - 0 since data descriptor
-                len(name_encoded),
-                len(extra),
-            ))
-            yield from _(name_encoded)
-            yield from _(extra)
-            yield _flush
-
-            uncompressed_size, raw_compressed_size, crc_32 = yield from encryption_func(_zip_data(
-                chunks,
-                _get_compress_obj,
-                max_uncompressed_size=0xffffffff,
-                max_compressed_size=0xffffffff,
-            ))
-            compressed_size = raw_compressed_size + aes_size_increase
-            masked_crc_32 = crc_32 & crc_32_mask
+            compressed_size += len(compressed_chunk)
 
-            yield from _(data_descriptor_signature)
-            yield from _(data_descriptor_zip_32_struct.pack(masked_crc_32, compressed_size, uncompressed_size))
+            _raise_if_beyond(compressed_size, maximum=max_compressed_size, exception_class=CompressedSizeOverflowError)
 
-            return central_directory_header_struct.pack(
-                20,           # Version made by
-                3,            # System made by (UNIX)
-                20,           # Version required
-                0,            # Reserved
-                flags,
-                compression,
-                mod_at_ms_dos,
-                masked_crc_32,
-                compressed_size,
-                uncompressed_size,
-                len(name_encoded),
-                len(extra),
-                0,            # File comment length
-                0,            # Disk number
-                0,            # Internal file attributes - is binary
-                external_attr,
-                file_offset,
-            ), name_encoded, extra
+            yield compressed_chunk
 
-        def _zip_data(chunks: Iterable[bytes], _get_compress_obj: _CompressObjGetter,
-                      max_uncompressed_size: int, max_compressed_size: int) -> Generator[bytes, None, Tuple[int, int, int]]:
-            uncompressed_size = 0
-            compressed_size = 0
-            crc_32 = zlib.crc32(b'')
-            compress_obj = _get_compress_obj()
+        return uncompressed_size, compressed_size, compressed_ahead.crc_32
+
+    def _is_deflated_in_blocks(_get_compress_obj: _CompressObjGetter) -> bool:
+        # Only ZIP_32 and ZIP_64 members use the get_compressobj parameter. ZIP_AUTO members
+        # are not deflated in blocks, since each block adds a few bytes that could take the
+        # compressed size beyond what ZIP_AUTO assumes is safe for ZIP_32
+        return executor is not None and deflate_block_size is not None and _get_compress_obj is get_compressobj
+
+    def _zip_data_in_blocks(chunks: 'Iterable[bytes]', _get_compress_obj: _CompressObjGetter,
+                            max_uncompressed_size: int, max_compressed_size: int) -> 'Generator[bytes, None, Tuple[int, int, int]]':
+        assert executor is not None and deflate_block_size is not None
+        block_size = deflate_block_size
+        max_blocks_in_flight = max(1, lookahead_bytes // block_size)
+        full_block_combine_matrix = _crc_32_combine_matrix(block_size)
+        uncompressed_size = 0
+        compressed_size = 0
+        crc_32 = zlib.crc32(b'')
+
+        def blocks() -> 'Iterable[bytes]':
+            nonlocal uncompressed_size
+            pending: List[bytes] = []
+            pending_size = 0
             for chunk in chunks:
                 uncompressed_size += len(chunk)
 
                 _raise_if_beyond(uncompressed_size, maximum=max_uncompressed_size, exception_class=UncompressedSizeOverflowError)
 
-                crc_32 = zlib.crc32(chunk, crc_32)
-                compressed_chunk = compress_obj.compress(chunk)
-                compressed_size += len(compressed_chunk)
-
-                _raise_if_beyond(compressed_size, maximum=max_compressed_size, exception_class=CompressedSizeOverflowError)
-
-                yield compressed_chunk
-
-            compressed_chunk = compress_obj.flush()
+                pending.append(chunk if type(chunk) is bytes else bytes(chunk))
+                pending_size += len(chunk)
+                if pending_size >= block_size:
+                    joined = b''.join(pending)
+                    full_blocks_size = len(joined) - len(joined) % block_size
+                    for i in range(0, full_blocks_size, block_size):
+                        yield joined[i:i + block_size]
+                    pending = [joined[full_blocks_size:]]
+                    pending_size -= full_blocks_size
+            if pending_size:
+                yield b''.join(pending)
+
+        def compressed(future: 'Future[Tuple[bytes, int]]', size: int) -> bytes:
+            nonlocal compressed_size, crc_32
+            compressed_chunk, block_crc_32 = future.result()
+            crc_32 = _crc_32_combine(crc_32, block_crc_32, full_block_combine_matrix if size == block_size else _crc_32_combine_matrix(size))
             compressed_size += len(compressed_chunk)
 
             _raise_if_beyond(compressed_size, maximum=max_compressed_size, exception_class=CompressedSizeOverflowError)
 
-            yield compressed_chunk
-
-            return uncompressed_size, compressed_size, crc_32
-
-        def _no_compression_64_local_header_and_data(
-                compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
-                mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
-                crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]],
-                chunks: Iterable[bytes],
-        ) -> Generator[bytes, None, Tuple[bytes, bytes, bytes]]:
-            file_offset = offset
+            return compressed_chunk
 
-            _raise_if_beyond(file_offset, maximum=0xffffffffffffffff, exception_class=OffsetOverflowError)
-
-            chunks, uncompressed_size, crc_32 = _no_compression_buffered_data_size_crc_32(chunks, maximum_size=0xffffffffffffffff)
-
-            compressed_size = uncompressed_size + aes_size_increase
-            extra = zip_64_local_extra_struct.pack(
-                zip_64_extra_signature,
-                16,    # Size of extra
-                uncompressed_size,
-                compressed_size,
-            ) + mod_at_unix_extra + aes_extra
-            flags = aes_flags | utf8_flag
-            masked_crc_32 = crc_32 & crc_32_mask
-
-            yield from _(local_header_signature)
-            yield from _(local_header_struct.pack(
-                45,           # Version
-                flags,
-                compression,
-                mod_at_ms_dos,
-                masked_crc_32,
-                0xffffffff,   # Compressed size - since zip64
-                0xffffffff,   # Uncompressed size - since zip64
-                len(name_encoded),
-                len(extra),
-            ))
-            yield from _(name_encoded)
-            yield from _(extra)
-            yield _flush
-
-            yield from encryption_func((chunk for chunk in chunks))
-
-            extra = zip_64_central_directory_extra_struct.pack(
-                zip_64_extra_signature,
-                24,    # Size of extra
-                uncompressed_size,
-                compressed_size,
-                file_offset,
-            ) + mod_at_unix_extra + aes_extra
-            return central_directory_header_struct.pack(
-               45,           # Version made by
-               3,            # System made by (UNIX)
-               45,           # Version required
-               0,            # Reserved
-               flags,
-               compression,
-               mod_at_ms_dos,
-               masked_crc_32,
-               0xffffffff,   # Compressed size - since zip64
-               0xffffffff,   # Uncompressed size - since zip64
-               len(name_encoded),
-               len(extra),
-               0,            # File comment length
-               0,            # Disk number
-               0,            # Internal file attributes - is binary
-               external_attr,
-               0xffffffff,   # File offset - since zip64
-            ), name_encoded, extra
-
-
-        def _no_compression_32_local_header_and_data(
-                compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
-                mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
-                crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]],
-                chunks: Iterable[bytes],
-        ) -> Generator[bytes, None, Tuple[bytes, bytes, bytes]]:
-            file_offset = offset
-
-            _raise_if_beyond(file_offset, maximum=0xffffffff, exception_class=OffsetOverflowError)
-
-            chunks, uncompressed_size, crc_32 = _no_compression_buffered_data_size_crc_32(chunks, maximum_size=0xffffffff)
-
-            compressed_size = uncompressed_size + aes_size_increase
-            extra = mod_at_unix_extra + aes_extra
-            flags = aes_flags | utf8_flag
-            masked_crc_32 = crc_32 & crc_32_mask
-
-            yield from _(local_header_signature)
-            yield from _(local_header_struct.pack(
-                20,           # Version
-                flags,
-                compression,
-                mod_at_ms_dos,
-                masked_crc_32,
-                compressed_size,
-                uncompressed_size,
-                len(name_encoded),
-                len(extra),
-            ))
-            yield from _(name_encoded)
-            yield from _(extra)
-            yield _flush
-
-            yield from encryption_func((chunk for chunk in chunks))
-
-            return central_directory_header_struct.pack(
-               20,           # Version made by
-               3,            # System made by (UNIX)
-               20,           # Version required
-               0,            # Reserved
-               flags,
-               compression,
-               mod_at_ms_dos,
-               masked_crc_32,
-               compressed_size,
-               uncompressed_size,
-               len(name_encoded),
-               len(extra),
-               0,            # File comment length
-               0,            # Disk number
-               0,            # Internal file attributes - is binary
-               external_attr,
-               file_offset,
-            ), name_encoded, extra
-
-        def _no_compression_buffered_data_size_crc_32(chunks: Iterable[bytes], maximum_size: int) -> Tuple[Iterable[bytes], int, int]:
-            # We cannot have a data descriptor, and so have to be able to determine the total
-            # length and CRC32 before output ofchunks to client code
-
-            size = 0
-            crc_32 = zlib.crc32(b'')
+        in_flight: Deque[Tuple['Future[Tuple[bytes, int]]', int]] = deque()
+        try:
+            window = b''
+            for block in blocks():
+                in_flight.append((executor.submit(_deflate_block, _get_compress_obj, block, window), len(block)))
+                window = block[-_deflate_window_size:]
+                while len(in_flight) >= max_blocks_in_flight or (in_flight and in_flight[0][0].done()):
+                    yield compressed(*in_flight.popleft())
+
+            while in_flight:
+                yield compressed(*in_flight.popleft())
+        finally:
+            for future, _ in in_flight:
+                future.cancel()
+
+        compressed_size += len(_deflate_empty_final_block)
+
+        _raise_if_beyond(compressed_size, maximum=max_compressed_size, exception_class=CompressedSizeOverflowError)
+
+        yield _deflate_empty_final_block
+
+        return uncompressed_size, compressed_size, crc_32
+
+    def _no_compression_64_local_header_and_data(
+            compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
+            mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
+            crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: 'Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]',
+            chunks: 'Iterable[bytes]',
+    ) -> 'Generator[bytes, None, Tuple[bytes, bytes, bytes]]':
+        file_offset = offset
+
+        _raise_if_beyond(file_offset, maximum=0xffffffffffffffff, exception_class=OffsetOverflowError)
+
+        chunks, uncompressed_size, crc_32 = yield from _no_compression_buffered_data_size_crc_32(chunks, maximum_size=0xffffffffffffffff)
+
+        compressed_size = uncompressed_size + aes_size_increase
+        extra = _zip_64_local_extra_struct.pack(
+            _zip_64_extra_signature,
+            16,    # Size of extra
+            uncompressed_size,
+            compressed_size,
+        ) + mod_at_unix_extra + aes_extra
+        flags = aes_flags | _utf8_flag
+        masked_crc_32 = crc_32 & crc_32_mask
+
+        yield from _(_local_header_signature)
+        yield from _(_local_header_struct.pack(
+            45,           # Version
+            flags,
+            compression,
+            mod_at_ms_dos,
+            masked_crc_32,
+            0xffffffff,   # Compressed size - since zip64
+            0xffffffff,   # Uncompressed size - since zip64
+            len(name_encoded),
+            len(extra),
+        ))
+        yield from _(name_encoded)
+        yield from _(extra)
+        yield _flush
+
+        yield from encryption_func((chunk for chunk in chunks))
+
+        extra = _zip_64_central_directory_extra_struct.pack(
+            _zip_64_extra_signature,
+            24,    # Size of extra
+            uncompressed_size,
+            compressed_size,
+            file_offset,
+        ) + mod_at_unix_extra + aes_extra
+        return _central_directory_header_struct.pack(
+           45,           # Version made by
+           3,            # System made by (UNIX)
+           45,           # Version required
+           0,            # Reserved
+           flags,
+           compression,
+           mod_at_ms_dos,
+           masked_crc_32,
+           0xffffffff,   # Compressed size - since zip64
+           0xffffffff,   # Uncompressed size - since zip64
+           len(name_encoded),
+           len(extra),
+           0,            # File comment length
+           0,            # Disk number
+           0,            # Internal file attributes - is binary
+           external_attr,
+           0xffffffff,   # File offset - since zip64
+        ), name_encoded, extra
+
+
+    def _no_compression_32_local_header_and_data(
+            compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
+            mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
+            crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: 'Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]',
+            chunks: 'Iterable[bytes]',
+    ) -> 'Generator[bytes, None, Tuple[bytes, bytes, bytes]]':
+        file_offset = offset
+
+        _raise_if_beyond(file_offset, maximum=0xffffffff, exception_class=OffsetOverflowError)
+
+        chunks, uncompressed_size, crc_32 = yield from _no_compression_buffered_data_size_crc_32(chunks, maximum_size=0xffffffff)
+
+        compressed_size = uncompressed_size + aes_size_increase
+        extra = mod_at_unix_extra + aes_extra
+        flags = aes_flags | _utf8_flag
+        masked_crc_32 = crc_32 & crc_32_mask
+
+        yield from _(_local_header_signature)
+        yield from _(_local_header_struct.pack(
+            20,           # Version
+            flags,
+            compression,
+            mod_at_ms_dos,
+            masked_crc_32,
+            compressed_size,
+            uncompressed_size,
+            len(name_encoded),
+            len(extra),
+        ))
+        yield from _(name_encoded)
+        yield from _(extra)
+        yield _flush
+
+        yield from encryption_func((chunk for chunk in chunks))
+
+        return _central_directory_header_struct.pack(
+           20,           # Version made by
+           3,            # System made by (UNIX)
+           20,           # Version required
+           0,            # Reserved
+           flags,
+           compression,
+           mod_at_ms_dos,
+           masked_crc_32,
+           compressed_size,
+           uncompressed_size,
+           len(name_encoded),
+           len(extra),
+           0,            # File comment length
+           0,            # Disk number
+           0,            # Internal file attributes - is binary
+           external_attr,
+           file_offset,
+        ), name_encoded, extra
+
+    def _no_compression_buffered_data_size_crc_32(chunks: 'Iterable[bytes]', maximum_size: int) -> 'Generator[bytes, None, Tuple[Iterable[bytes], int, int]]':
+        # We cannot have a data descriptor, and so have to be able to determine the total
+        # length and CRC32 before output ofchunks to client code. If there is a limit on
+        # memory, the data beyond the limit is spooled to a temporary file
+
+        size = 0
+        crc_32 = zlib.crc32(b'')
+        buffered: List[bytes] = []
+        spooled = None if buffer_memory_limit is None else \
+            tempfile.SpooledTemporaryFile(max_size=buffer_memory_limit, dir=temp_dir)
 
-            def _chunks() -> Generator[bytes, None, Any]:
-                nonlocal size, crc_32
-                for chunk in chunks:
-                    size += len(chunk)
-                    _raise_if_beyond(size, maximum=maximum_size, exception_class=UncompressedSizeOverflowError)
-                    crc_32 = zlib.crc32(chunk, crc_32)
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, _Await):
                     yield chunk
+                    continue
+                size += len(chunk)
+                _raise_if_beyond(size, maximum=maximum_size, exception_class=UncompressedSizeOverflowError)
+                crc_32 = zlib.crc32(chunk, crc_32)
+                if spooled is None:
+                    buffered.append(chunk if type(chunk) is bytes else bytes(chunk))
+                else:
+                    spooled.write(chunk)
+        except BaseException:
+            if spooled is not None:
+                spooled.close()
+            raise
+
+        return (buffered if spooled is None else _spooled_chunks(spooled)), size, crc_32
+
+    def _no_compression_size_crc_32(chunks: 'Iterable[bytes]', maximum_size: int) -> 'Generator[bytes, None, Tuple[int, int]]':
+        size = 0
+        crc_32 = zlib.crc32(b'')
+
+        for chunk in chunks:
+            if isinstance(chunk, _Await):
+                yield chunk
+                continue
+            size += len(chunk)
+            _raise_if_beyond(size, maximum=maximum_size, exception_class=UncompressedSizeOverflowError)
+            crc_32 = zlib.crc32(chunk, crc_32)
+
+        return size, crc_32
+
+    def _spooled_chunks(spooled: 'IO[bytes]') -> 'Iterable[bytes]':
+        with spooled:
+            spooled.seek(0)
+            yield from iter(lambda: spooled.read(_spooled_read_size), b'')
+
+    def _no_compression_streamed_64_local_header_and_data(
+            compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
+            mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
+            crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: 'Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]',
+            chunks: 'Iterable[bytes]',
+    ) -> 'Generator[bytes, None, Tuple[bytes, bytes, bytes]]':
+        file_offset = offset
+
+        _raise_if_beyond(file_offset, maximum=0xffffffffffffffff, exception_class=OffsetOverflowError)
+
+        compressed_size = uncompressed_size + aes_size_increase
+        extra = _zip_64_local_extra_struct.pack(
+            _zip_64_extra_signature,
+            16,                 # Size of extra
+            uncompressed_size,
+            compressed_size,
+        ) + mod_at_unix_extra + aes_extra
+        flags = aes_flags | _utf8_flag
+        masked_crc_32 = crc_32 & crc_32_mask
+
+        yield from _(_local_header_signature)
+        yield from _(_local_header_struct.pack(
+            45,           # Version
+            flags,
+            compression,
+            mod_at_ms_dos,
+            masked_crc_32,
+            0xffffffff,   # Compressed size - since zip64
+            0xffffffff,   # Uncompressed size - since zip64
+            len(name_encoded),
+            len(extra),
+        ))
+        yield from _(name_encoded)
+        yield from _(extra)
+        yield _flush
+
+        yield from encryption_func(_no_compression_streamed_data(chunks, uncompressed_size, crc_32, 0xffffffffffffffff))
+
+        extra = _zip_64_central_directory_extra_struct.pack(
+            _zip_64_extra_signature,
+            24,                 # Size of extra
+            uncompressed_size,
+            compressed_size,
+            file_offset,
+        ) + mod_at_unix_extra + aes_extra
+        return _central_directory_header_struct.pack(
+           45,           # Version made by
+           3,            # System made by (UNIX)
+           45,           # Version required
+           0,            # Reserved
+           flags,
+           compression,
+           mod_at_ms_dos,
+           masked_crc_32,
+           0xffffffff,   # Compressed size - since zip64
+           0xffffffff,   # Uncompressed size - since zip64
+           len(name_encoded),
+           len(extra),
+           0,            # File comment length
+           0,            # Disk number
+           0,            # Internal file attributes - is binary
+           external_attr,
+           0xffffffff,   # File offset - since zip64
+        ), name_encoded, extra
+
+
+    def _no_compression_streamed_32_local_header_and_data(
+            compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
+            mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
+            crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: 'Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]',
+            chunks: 'Iterable[bytes]',
+    ) -> 'Generator[bytes, None, Any]':
+        file_offset = offset
+
+        _raise_if_beyond(file_offset, maximum=0xffffffff, exception_class=OffsetOverflowError)
+
+        compressed_size = uncompressed_size + aes_size_increase
+        extra = mod_at_unix_extra + aes_extra
+        flags = aes_flags | _utf8_flag
+        masked_crc_32 = crc_32 & crc_32_mask
+
+        yield from _(_local_header_signature)
+        yield from _(_local_header_struct.pack(
+            20,                 # Version
+            flags,
+            compression,
+            mod_at_ms_dos,
+            masked_crc_32,
+            compressed_size,
+            uncompressed_size,
+            len(name_encoded),
+            len(extra),
+        ))
+        yield from _(name_encoded)
+        yield from _(extra)
+        yield _flush
+
+        yield from encryption_func(_no_compression_streamed_data(chunks, uncompressed_size, crc_32, 0xffffffff))
+
+        return _central_directory_header_struct.pack(
+           20,                 # Version made by
+           3,                  # System made by (UNIX)
+           20,                 # Version required
+           0,                  # Reserved
+           flags,
+           compression,
+           mod_at_ms_dos,
+           masked_crc_32,
+           compressed_size,
+           uncompressed_size,
+           len(name_encoded),
+           len(extra),
+           0,                  # File comment length
+           0,                  # Disk number
+           0,                  # Internal file attributes - is binary
+           external_attr,
+           file_offset,
+        ), name_encoded, extra
+
+    def _no_compression_streamed_data(chunks: 'Iterable[bytes]', uncompressed_size: int, crc_32: int, maximum_size: int) -> 'Generator[bytes, None, Any]':
+        actual_crc_32 = zlib.crc32(b'')
+        size = 0
+        for chunk in chunks:
+            if isinstance(chunk, _DataRegion):
+                _raise_if_beyond(len(chunk), maximum=maximum_size, exception_class=UncompressedSizeOverflowError)
+                yield chunk
+                return
+            actual_crc_32 = zlib.crc32(chunk, actual_crc_32)
+            size += len(chunk)
+            _raise_if_beyond(size, maximum=maximum_size, exception_class=UncompressedSizeOverflowError)
+            yield chunk
 
-            __chunks = tuple(_chunks())
+        if actual_crc_32 != crc_32:
+            raise CRC32IntegrityError()
 
-            return __chunks, size, crc_32
+        if size != uncompressed_size:
+            raise UncompressedSizeIntegrityError()
 
-        def _no_compression_streamed_64_local_header_and_data(
+    def _get_precompressed_64_local_header_and_data(
+            compressed_size: int, checked_data: 'Callable[[Iterable[bytes], int, int, int, int], Generator[bytes, None, Any]]',
+    ) -> 'Callable[..., Generator[bytes, None, Tuple[bytes, bytes, bytes]]]':
+        def _precompressed_64_local_header_and_data(
                 compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
                 mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
-                crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]],
-                chunks: Iterable[bytes],
-        ) -> Generator[bytes, None, Tuple[bytes, bytes, bytes]]:
+                crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: 'Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]',
+                chunks: 'Iterable[bytes]',
+        ) -> 'Generator[bytes, None, Tuple[bytes, bytes, bytes]]':
             file_offset = offset
 
             _raise_if_beyond(file_offset, maximum=0xffffffffffffffff, exception_class=OffsetOverflowError)
 
-            compressed_size = uncompressed_size + aes_size_increase
-            extra = zip_64_local_extra_struct.pack(
-                zip_64_extra_signature,
+            encrypted_compressed_size = compressed_size + aes_size_increase
+            extra = _zip_64_local_extra_struct.pack(
+                _zip_64_extra_signature,
                 16,                 # Size of extra
                 uncompressed_size,
-                compressed_size,
+                encrypted_compressed_size,
             ) + mod_at_unix_extra + aes_extra
-            flags = aes_flags | utf8_flag
+            flags = aes_flags | _utf8_flag
             masked_crc_32 = crc_32 & crc_32_mask
 
-            yield from _(local_header_signature)
-            yield from _(local_header_struct.pack(
+            yield from _(_local_header_signature)
+            yield from _(_local_header_struct.pack(
                 45,           # Version
                 flags,
                 compression,
@@ -598,16 +1580,16 @@ def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
             yield from _(extra)
             yield _flush
 
-            yield from encryption_func(_no_compression_streamed_data(chunks, uncompressed_size, crc_32, 0xffffffffffffffff))
+            yield from encryption_func(checked_data(chunks, uncompressed_size, compressed_size, crc_32, 0xffffffffffffffff))
 
-            extra = zip_64_central_directory_extra_struct.pack(
-                zip_64_extra_signature,
+            extra = _zip_64_central_directory_extra_struct.pack(
+                _zip_64_extra_signature,
                 24,                 # Size of extra
                 uncompressed_size,
-                compressed_size,
+                encrypted_compressed_size,
                 file_offset,
             ) + mod_at_unix_extra + aes_extra
-            return central_directory_header_struct.pack(
+            return _central_directory_header_struct.pack(
                45,           # Version made by
                3,            # System made by (UNIX)
                45,           # Version required
@@ -627,30 +1609,37 @@ def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
                0xffffffff,   # File offset - since zip64
             ), name_encoded, extra
 
+        return _precompressed_64_local_header_and_data
 
-        def _no_compression_streamed_32_local_header_and_data(
+    def _get_precompressed_32_local_header_and_data(
+            compressed_size: int, checked_data: 'Callable[[Iterable[bytes], int, int, int, int], Generator[bytes, None, Any]]',
+    ) -> 'Callable[..., Generator[bytes, None, Tuple[bytes, bytes, bytes]]]':
+        def _precompressed_32_local_header_and_data(
                 compression: int, aes_size_increase: int, aes_flags: int, name_encoded: bytes, mod_at_ms_dos: bytes,
                 mod_at_unix_extra: bytes, aes_extra: bytes, external_attr: int, uncompressed_size: int, crc_32: int,
-                crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]],
-                chunks: Iterable[bytes],
-        ) -> Generator[bytes, None, Any]:
+                crc_32_mask: int, _get_compress_obj: _CompressObjGetter, encryption_func: 'Callable[[Generator[bytes, None, Any]], Generator[bytes, None, Any]]',
+                chunks: 'Iterable[bytes]',
+        ) -> 'Generator[bytes, None, Tuple[bytes, bytes, bytes]]':
             file_offset = offset
 
             _raise_if_beyond(file_offset, maximum=0xffffffff, exception_class=OffsetOverflowError)
+            _raise_if_beyond(uncompressed_size, maximum=0xffffffff, exception_class=UncompressedSizeOverflowError)
+
+            encrypted_compressed_size = compressed_size + aes_size_increase
+            _raise_if_beyond(encrypted_compressed_size, maximum=0xffffffff, exception_class=CompressedSizeOverflowError)
 
-            compressed_size = uncompressed_size + aes_size_increase
             extra = mod_at_unix_extra + aes_extra
-            flags = aes_flags | utf8_flag
+            flags = aes_flags | _utf8_flag
             masked_crc_32 = crc_32 & crc_32_mask
 
-            yield from _(local_header_signature)
-            yield from _(local_header_struct.pack(
+            yield from _(_local_header_signature)
+            yield from _(_local_header_struct.pack(
                 20,                 # Version
                 flags,
                 compression,
                 mod_at_ms_dos,
                 masked_crc_32,
-                compressed_size,
+                encrypted_compressed_size,
                 uncompressed_size,
                 len(name_encoded),
                 len(extra),
@@ -659,9 +1648,9 @@ def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
             yield from _(extra)
             yield _flush
 
-            yield from encryption_func(_no_compression_streamed_data(chunks, uncompressed_size, crc_32, 0xffffffff))
+            yield from encryption_func(checked_data(chunks, uncompressed_size, compressed_size, crc_32, 0xffffffff))
 
-            return central_directory_header_struct.pack(
+            return _central_directory_header_struct.pack(
                20,                 # Version made by
                3,                  # System made by (UNIX)
                20,                 # Version required
@@ -670,7 +1659,7 @@ def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
                compression,
                mod_at_ms_dos,
                masked_crc_32,
-               compressed_size,
+               encrypted_compressed_size,
                uncompressed_size,
                len(name_encoded),
                len(extra),
@@ -681,28 +1670,136 @@ def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
                file_offset,
             ), name_encoded, extra
 
-        def _no_compression_streamed_data(chunks: Iterable[bytes], uncompressed_size: int, crc_32: int, maximum_size: int) -> Generator[bytes, None, Any]:
-            actual_crc_32 = zlib.crc32(b'')
-            size = 0
-            for chunk in chunks:
-                actual_crc_32 = zlib.crc32(chunk, actual_crc_32)
-                size += len(chunk)
-                _raise_if_beyond(size, maximum=maximum_size, exception_class=UncompressedSizeOverflowError)
+        return _precompressed_32_local_header_and_data
+
+    def _deflated_data(chunks: 'Iterable[bytes]', uncompressed_size: int, compressed_size: int, crc_32: int, maximum_size: int) -> 'Generator[bytes, None, Any]':
+        # The already-deflated data is output unchanged, but inflated along the way to check it
+        decompress_obj = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+        actual_crc_32 = zlib.crc32(b'')
+        actual_uncompressed_size = 0
+        actual_compressed_size = 0
+
+        for chunk in chunks:
+            if isinstance(chunk, _Await):
+                yield chunk
+                continue
+            if isinstance(chunk, _DataRegion):
+                _raise_if_beyond(len(chunk), maximum=maximum_size, exception_class=CompressedSizeOverflowError)
                 yield chunk
+                return
+            actual_compressed_size += len(chunk)
+            _raise_if_beyond(actual_compressed_size, maximum=maximum_size, exception_class=CompressedSizeOverflowError)
+            try:
+                chunk_uncompressed_size, actual_crc_32 = yield from _run(
+                    lambda: _inflated_size_crc_32(decompress_obj, chunk, actual_crc_32),
+                    is_cpu_heavy=len(chunk) >= _run_in_thread_min_size,
+                )
+            except zlib.error:
+                raise DeflateIntegrityError() from None
+            actual_uncompressed_size += chunk_uncompressed_size
+            _raise_if_beyond(actual_uncompressed_size, maximum=maximum_size, exception_class=UncompressedSizeOverflowError)
+            yield chunk
 
-            if actual_crc_32 != crc_32:
-                raise CRC32IntegrityError()
+        if actual_compressed_size != compressed_size:
+            raise CompressedSizeIntegrityError()
 
-            if size != uncompressed_size:
-                raise UncompressedSizeIntegrityError()
+        if not decompress_obj.eof or decompress_obj.unused_data:
+            raise DeflateIntegrityError()
+
+        if actual_crc_32 != crc_32:
+            raise CRC32IntegrityError()
 
-        for name, modified_at, mode, method, chunks in files:
-            _method, _auto_upgrade_central_directory, _get_compress_obj, uncompressed_size, crc_32 = method._get(offset, get_compressobj)
+        if actual_uncompressed_size != uncompressed_size:
+            raise UncompressedSizeIntegrityError()
+
+    def _raw_data(chunks: 'Iterable[bytes]', uncompressed_size: int, compressed_size: int, crc_32: int, maximum_size: int) -> 'Generator[bytes, None, Any]':
+        # The data of raw copies may be encrypted or use any compression, so only its size is checked
+        actual_compressed_size = 0
+        for chunk in chunks:
+            if isinstance(chunk, _DataRegion):
+                _raise_if_beyond(len(chunk), maximum=maximum_size, exception_class=CompressedSizeOverflowError)
+                yield chunk
+                return
+            actual_compressed_size += len(chunk)
+            _raise_if_beyond(actual_compressed_size, maximum=maximum_size, exception_class=CompressedSizeOverflowError)
+            yield chunk
+
+        if actual_compressed_size != compressed_size:
+            raise CompressedSizeIntegrityError()
+
+    def _with_compressed_ahead(files: 'Iterable[MemberFile]') -> 'Generator[MemberFile, None, None]':
+        # Starts compressing the data of upcoming ZIP_32 and ZIP_64 members in the executor,
+        # while earlier members are being output, as long as the look-ahead budget allows
+        assert executor is not None
+        lookahead = _Lookahead(lookahead_bytes)
+        pending: Deque[MemberFile] = deque()
+        it = iter(files)
+        exhausted = False
+
+        try:
+            while True:
+                # The member to be output next is always pulled, even if the look-ahead budget is
+                # zero or used up, so no member is lost
+                while not exhausted and (not pending or (len(pending) < lookahead_members and lookahead.has_capacity())):
+                    try:
+                        name, modified_at, mode, method, chunks = next(it)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    _method, _, _get_compress_obj, _, _, _ = method._get(0, get_compressobj)
+                    if (_method is _ZIP_32 or _method is _ZIP_64) and not _is_deflated_in_blocks(_get_compress_obj) and not callable(chunks):
+                        chunks = _CompressedAhead(lookahead, executor, chunks, _get_compress_obj)
+                    pending.append((name, modified_at, mode, method, chunks))
+
+                if not pending:
+                    break
+
+                yield pending.popleft()
+        finally:
+            lookahead.close()
+            for _, _, _, _, chunks in pending:
+                if isinstance(chunks, _CompressedAhead):
+                    chunks.future.cancel()
+
+    # Upcoming members are not compressed ahead when deflating in blocks. Workers compressing ahead
+    # wait for the look-ahead budget while holding their threads, and so could take every thread
+    # of the executor while the member being output waits for its blocks to be compressed
+    members = files if executor is None or deflate_block_size is not None else _with_compressed_ahead(files)
+
+    try:
+        for member_file in members:
+            if isinstance(member_file, _Await):
+                yield member_file
+                continue
+
+            name, modified_at, mode, method, data = member_file
+            _method, _auto_upgrade_central_directory, _get_compress_obj, uncompressed_size, crc_32, compressed_size = method._get(offset, get_compressobj)
+
+            if _method is _NO_COMPRESSION_TWO_PASS_32 or _method is _NO_COMPRESSION_TWO_PASS_64:
+                # The data is iterated once to find its size and CRC32, and then again to stream it
+                if not callable(data):
+                    raise TypeError('The data of a *_TWO_PASS member file must be a function returning an iterable of bytes')
+                uncompressed_size, crc_32 = yield from _no_compression_size_crc_32(data(), maximum_size=0xffffffff if _method is _NO_COMPRESSION_TWO_PASS_32 else 0xffffffffffffffff)
+                _method = _NO_COMPRESSION_STREAMED_32 if _method is _NO_COMPRESSION_TWO_PASS_32 else _NO_COMPRESSION_STREAMED_64
+                chunks = data()
+            elif callable(data):
+                raise TypeError('Only the data of a *_TWO_PASS member file can be a function')
+            else:
+                chunks = data
+
+            if _method is _GZIPPED_32 or _method is _GZIPPED_64:
+                # Output the same as ZIP_32 and ZIP_64, but with the already-compressed data
+                _method = _ZIP_32 if _method is _GZIPPED_32 else _ZIP_64
+                chunks = _Gzipped(chunks)
+
+            if seekable and (_method is _NO_COMPRESSION_BUFFERED_32 or _method is _NO_COMPRESSION_BUFFERED_64):
+                # The CRC32 and size are patched into the local header, so the data isn't buffered
+                _get_compress_obj = _get_stored_compress_obj
 
             name_encoded = name.encode('utf-8')
             _raise_if_beyond(len(name_encoded), maximum=0xffff, exception_class=NameLengthOverflowError)
 
-            mod_at_ms_dos = modified_at_struct.pack(
+            mod_at_ms_dos = _modified_at_struct.pack(
                 int(modified_at.second / 2) | \
                 (modified_at.minute << 5) | \
                 (modified_at.hour << 11),
@@ -710,8 +1807,8 @@ def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
                 (modified_at.month << 5) | \
                 (modified_at.year - 1980) << 9,
             )
-            mod_at_unix_extra = mod_at_unix_extra_struct.pack(
-                mod_at_unix_extra_signature,
+            mod_at_unix_extra = _mod_at_unix_extra_struct.pack(
+                _mod_at_unix_extra_signature,
                 5,        # Size of extra
                 b'\x01',  # Only modification time (as opposed to also other times)
                 int(modified_at.timestamp()),
@@ -723,23 +1820,42 @@ def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
             data_func, raw_compression = \
                 (_zip_64_local_header_and_data, 8) if _method is _ZIP_64 else \
                 (_zip_32_local_header_and_data, 8) if _method is _ZIP_32 else \
+                (_get_precompressed_64_local_header_and_data(compressed_size, _deflated_data), 8) if _method is _DEFLATED_64 else \
+                (_get_precompressed_32_local_header_and_data(compressed_size, _deflated_data), 8) if _method is _DEFLATED_32 else \
+                (_get_precompressed_64_local_header_and_data(compressed_size, _raw_data), 0) if _method is _RAW_64 else \
+                (_get_precompressed_32_local_header_and_data(compressed_size, _raw_data), 0) if _method is _RAW_32 else \
+                (_zip_64_local_header_and_data, 0) if _method is _NO_COMPRESSION_BUFFERED_64 and seekable else \
+                (_zip_32_local_header_and_data, 0) if _method is _NO_COMPRESSION_BUFFERED_32 and seekable else \
                 (_no_compression_64_local_header_and_data, 0) if _method is _NO_COMPRESSION_BUFFERED_64 else \
                 (_no_compression_32_local_header_and_data, 0) if _method is _NO_COMPRESSION_BUFFERED_32 else \
                 (_no_compression_streamed_64_local_header_and_data, 0) if _method is _NO_COMPRESSION_STREAMED_64 else \
                 (_no_compression_streamed_32_local_header_and_data, 0)
 
+            # Raw copies of members of other ZIP files keep their compression and any encryption
             compression, aes_size_increase, aes_flags, aes_extra, crc_32_mask, encryption_func = \
-                (99, 28, aes_flag, aes_extra_struct.pack(aes_extra_signature, 7, 2, b'AE', 3, raw_compression), 0, _get_encrypt_aes(password)) if password is not None else \
+                (method.compression, 0, method.flags, method.aes_extra, 0xffffffff, _encrypt_dummy) if isinstance(method, _RawCopy) else \
+                (99, 28, _aes_flag, _aes_extra_struct.pack(_aes_extra_signature, 7, 2, b'AE', 3, raw_compression), 0, _encrypt_aes_layout if layout_only else _get_encrypt_aes(password)) if password is not None else \
                 (raw_compression, 0, 0, b'', 0xffffffff, _encrypt_dummy)
 
             central_directory_header_entry, name_encoded, extra = yield from data_func(compression, aes_size_increase, aes_flags, name_encoded, mod_at_ms_dos, mod_at_unix_extra, aes_extra, external_attr, uncompressed_size, crc_32, crc_32_mask, _get_compress_obj, encryption_func, chunks)
-            central_directory_size += len(central_directory_header_signature) + len(central_directory_header_entry) + len(name_encoded) + len(extra)
-            central_directory.append((central_directory_header_entry, name_encoded, extra))
+            central_directory_size += len(_central_directory_header_signature) + len(central_directory_header_entry) + len(name_encoded) + len(extra)
+            central_directory += _central_directory_header_signature
+            central_directory += central_directory_header_entry
+            central_directory += name_encoded
+            central_directory += extra
+            central_directory_length += 1
+
+            # Past the limit, records are moved from memory to a temporary file
+            if central_directory_memory_limit is not None and len(central_directory) > central_directory_memory_limit:
+                if central_directory_file is None:
+                    central_directory_file = tempfile.TemporaryFile(dir=temp_dir)
+                central_directory_file.write(central_directory)
+                central_directory.clear()
 
             zip_64_central_directory = zip_64_central_directory \
                 or (_auto_upgrade_central_directory is _AUTO_UPGRADE_CENTRAL_DIRECTORY and offset > 0xffffffff) \
-                or (_auto_upgrade_central_directory is _AUTO_UPGRADE_CENTRAL_DIRECTORY and len(central_directory) > 0xffff) \
-                or _method in (_ZIP_64, _NO_COMPRESSION_BUFFERED_64, _NO_COMPRESSION_STREAMED_64)
+                or (_auto_upgrade_central_directory is _AUTO_UPGRADE_CENTRAL_DIRECTORY and central_directory_length > 0xffff) \
+                or _method in (_ZIP_64, _NO_COMPRESSION_BUFFERED_64, _NO_COMPRESSION_STREAMED_64, _DEFLATED_64, _RAW_64)
 
             max_central_directory_length, max_central_directory_start_offset, max_central_directory_size = \
                 (0xffffffffffffffff, 0xffffffffffffffff, 0xffffffffffffffff) if zip_64_central_directory else \
@@ -749,39 +1865,44 @@ def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
             central_directory_end_offset = offset + central_directory_size
 
             _raise_if_beyond(central_directory_start_offset, maximum=max_central_directory_start_offset, exception_class=OffsetOverflowError)
-            _raise_if_beyond(len(central_directory), maximum=max_central_directory_length, exception_class=CentralDirectoryNumberOfEntriesOverflowError)
+            _raise_if_beyond(central_directory_length, maximum=max_central_directory_length, exception_class=CentralDirectoryNumberOfEntriesOverflowError)
             _raise_if_beyond(central_directory_size, maximum=max_central_directory_size, exception_class=CentralDirectorySizeOverflowError)
             _raise_if_beyond(central_directory_end_offset, maximum=0xffffffffffffffff, exception_class=OffsetOverflowError)
 
-        for central_directory_header_entry, name_encoded, extra in central_directory:
-            yield from _(central_directory_header_signature)
-            yield from _(central_directory_header_entry)
-            yield from _(name_encoded)
-            yield from _(extra)
+        if central_directory_file is not None:
+            central_directory_file.write(central_directory)
+            central_directory.clear()
+            central_directory_file.seek(0)
+            for block in iter(lambda: central_directory_file.read(65536), b''):
+                yield from _(block)
+        else:
+            central_directory_view = memoryview(central_directory)
+            for i in range(0, len(central_directory), 65536):
+                yield from _(bytes(central_directory_view[i:i + 65536]))
 
         if zip_64_central_directory:
-            yield from _(zip_64_end_of_central_directory_signature)
-            yield from _(zip_64_end_of_central_directory_struct.pack(
+            yield from _(_zip_64_end_of_central_directory_signature)
+            yield from _(_zip_64_end_of_central_directory_struct.pack(
                 44,  # Size of zip_64 end of central directory record
                 45,  # Version made by
                 45,  # Version required
                 0,   # Disk number
                 0,   # Disk number with central directory
-                len(central_directory),  # On this disk
-                len(central_directory),  # In total
+                central_directory_length,  # On this disk
+                central_directory_length,  # In total
                 central_directory_size,
                 central_directory_start_offset,
             ))
 
-            yield from _(zip_64_end_of_central_directory_locator_signature)
-            yield from _(zip_64_end_of_central_directory_locator_struct.pack(
+            yield from _(_zip_64_end_of_central_directory_locator_signature)
+            yield from _(_zip_64_end_of_central_directory_locator_struct.pack(
                 0,  # Disk number with zip_64 end of central directory record
                 central_directory_end_offset,
                 1   # Total number of disks
             ))
 
-            yield from _(end_of_central_directory_signature)
-            yield from _(end_of_central_directory_struct.pack(
+            yield from _(_end_of_central_directory_signature)
+            yield from _(_end_of_central_directory_struct.pack(
                 0xffff,      # Disk number - since zip64
                 0xffff,      # Disk number with central directory - since zip64
                 0xffff,      # Number of central directory entries on this disk - since zip64
@@ -791,18 +1912,747 @@ def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
                 0,           # ZIP_32 file comment length
             ))
         else:
-            yield from _(end_of_central_directory_signature)
-            yield from _(end_of_central_directory_struct.pack(
+            yield from _(_end_of_central_directory_signature)
+            yield from _(_end_of_central_directory_struct.pack(
                 0,  # Disk number
                 0,  # Disk number with central directory
-                len(central_directory),  # On this disk
-                len(central_directory),  # In total
+                central_directory_length,  # On this disk
+                central_directory_length,  # In total
                 central_directory_size,
                 central_directory_start_offset,
                 0, # ZIP_32 file comment length
             ))
 
-    yield from evenly_sized(get_zipped_chunks_uneven())
+    finally:
+        if central_directory_file is not None:
+            central_directory_file.close()
+
+def stream_zip(files: Iterable[MemberFile], chunk_size: int=65536,
+               get_compressobj: _CompressObjGetter=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
+               extended_timestamps: bool=True,
+               password: Optional[str]=None,
+               get_crypto_random: Callable[[int], bytes]=lambda num_bytes: secrets.token_bytes(num_bytes),
+               executor: Optional[Executor]=None,
+               lookahead_members: int=16,
+               lookahead_bytes: int=33554432,
+               deflate_block_size: Optional[int]=None,
+               central_directory_memory_limit: Optional[int]=None,
+               buffer_memory_limit: Optional[int]=None,
+               temp_dir: Optional[str]=None,
+) -> Iterable[bytes]:
+    yield from _evenly_sized(_zipped_chunks_uneven(
+        files=files,
+        get_compressobj=get_compressobj,
+        extended_timestamps=extended_timestamps,
+        password=password,
+        get_crypto_random=get_crypto_random,
+        executor=executor,
+        lookahead_members=lookahead_members,
+        lookahead_bytes=lookahead_bytes,
+        deflate_block_size=deflate_block_size,
+        central_directory_memory_limit=central_directory_memory_limit,
+        buffer_memory_limit=buffer_memory_limit,
+        temp_dir=temp_dir,
+    ), chunk_size)
+
+
+def stream_zip_to_seekable(files: Iterable[MemberFile], fileobj: IO[bytes],
+                           get_compressobj: _CompressObjGetter=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
+                           extended_timestamps: bool=True,
+                           password: Optional[str]=None,
+                           get_crypto_random: Callable[[int], bytes]=lambda num_bytes: secrets.token_bytes(num_bytes),
+                           executor: Optional[Executor]=None,
+                           lookahead_members: int=16,
+                           lookahead_bytes: int=33554432,
+                           deflate_block_size: Optional[int]=None,
+                           central_directory_memory_limit: Optional[int]=None,
+                           temp_dir: Optional[str]=None,
+) -> None:
+    # Writes the ZIP to a seekable file from its current position. Rather than data descriptors
+    # after the data of ZIP_32 and ZIP_64 member files, the CRC32 and sizes are patched into their
+    # local headers afterwards, and NO_COMPRESSION_32 and NO_COMPRESSION_64 member files are
+    # output the same way, without being buffered
+    for chunk in _zipped_chunks_uneven(
+        files=files,
+        get_compressobj=get_compressobj,
+        extended_timestamps=extended_timestamps,
+        password=password,
+        get_crypto_random=get_crypto_random,
+        executor=executor,
+        lookahead_members=lookahead_members,
+        lookahead_bytes=lookahead_bytes,
+        deflate_block_size=deflate_block_size,
+        central_directory_memory_limit=central_directory_memory_limit,
+        temp_dir=temp_dir,
+        start_offset=fileobj.tell(),
+        seekable=True,
+    ):
+        if chunk is _flush:
+            continue
+        if isinstance(chunk, _Patch):
+            position = fileobj.tell()
+            fileobj.seek(chunk.offset)
+            fileobj.write(chunk)
+            fileobj.seek(position)
+        else:
+            fileobj.write(chunk)
+
+
+def stream_zip_to_fd(files: Iterable[MemberFile], fd: int, size: Optional[int]=None,
+                     get_compressobj: _CompressObjGetter=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
+                     extended_timestamps: bool=True,
+                     password: Optional[str]=None,
+                     get_crypto_random: Callable[[int], bytes]=lambda num_bytes: secrets.token_bytes(num_bytes),
+                     executor: Optional[Executor]=None,
+                     lookahead_members: int=16,
+                     lookahead_bytes: int=33554432,
+                     deflate_block_size: Optional[int]=None,
+                     central_directory_memory_limit: Optional[int]=None,
+                     buffer_memory_limit: Optional[int]=None,
+                     temp_dir: Optional[str]=None,
+                     sendfile: bool=True,
+                     verify_crc_32: bool=False,
+) -> None:
+    # Writes the ZIP to a file descriptor, for example of a file or pipe. Rather than re-chunking
+    # the output into evenly sized chunks, the uneven chunks of headers, data and data descriptors
+    # are gathered and written together with os.writev. If the size of the ZIP is known, for example
+    # from stream_zip_size, and the file descriptor is of a regular file, space is allocated up front.
+    # The data of unencrypted member files from stored_member_file is copied from the local file by
+    # the kernel, trusting the CRC32 from the cache unless verify_crc_32 is True
+    fd_stat = os.fstat(fd)
+    is_regular_file = stat.S_ISREG(fd_stat.st_mode)
+    allocated = False
+    if size is not None and hasattr(os, 'posix_fallocate') and is_regular_file:
+        os.posix_fallocate(fd, os.lseek(fd, 0, os.SEEK_CUR), size)
+        allocated = True
+
+    max_chunks = min(os.sysconf('SC_IOV_MAX'), 1024) if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names else 1
+    max_bytes = 1048576
+
+    def write(chunks: List[Union[bytes, memoryview]]) -> None:
+        while chunks:
+            written = os.writev(fd, chunks) if hasattr(os, 'writev') else os.write(fd, chunks[0])
+            # Handle partial writes, for example to pipes
+            num_written = 0
+            while num_written < len(chunks) and written >= len(chunks[num_written]):
+                written -= len(chunks[num_written])
+                num_written += 1
+            chunks = chunks[num_written:]
+            if written:
+                chunks[0] = memoryview(chunks[0])[written:]
+
+    # Falls back to copying via Python if the kernel can't copy between the file descriptors
+    copy_mode = \
+        'copy_file_range' if is_regular_file and hasattr(os, 'copy_file_range') else \
+        'sendfile' if hasattr(os, 'sendfile') else \
+        'read'
+
+    def copied(f: IO[bytes], offset: int, count: int) -> int:
+        nonlocal copy_mode
+        while True:
+            try:
+                if copy_mode == 'copy_file_range':
+                    return os.copy_file_range(f.fileno(), fd, count, offset)
+                if copy_mode == 'sendfile':
+                    return os.sendfile(fd, f.fileno(), offset, count)
+                f.seek(offset)
+                chunk = f.read(min(count, max_bytes))
+                write([chunk])
+                return len(chunk)
+            except OSError as e:
+                if copy_mode == 'read' or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                copy_mode = 'sendfile' if copy_mode == 'copy_file_range' and hasattr(os, 'sendfile') else 'read'
+
+    def copy_local_file(region: _LocalFileDataRegion) -> None:
+        with open(region.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size != region.size:
+                raise UncompressedSizeIntegrityError()
+
+            if verify_crc_32:
+                crc_32 = zlib.crc32(b'')
+                for chunk in iter(lambda: f.read(max_bytes), b''):
+                    crc_32 = zlib.crc32(chunk, crc_32)
+                if crc_32 != region.crc_32:
+                    raise CRC32IntegrityError()
+
+            offset = 0
+            while offset < region.size:
+                num_copied = copied(f, offset, region.size - offset)
+                if not num_copied:
+                    raise UncompressedSizeIntegrityError()
+                offset += num_copied
+
+    def with_local_file_data_regions(files: Iterable[MemberFile]) -> Iterable[MemberFile]:
+        for name, modified_at, mode, method, data in files:
+            if isinstance(data, _LocalFile):
+                _method, _, _, uncompressed_size, crc_32, _ = method._get(0, get_compressobj)
+                if _method is _NO_COMPRESSION_STREAMED_32 or _method is _NO_COMPRESSION_STREAMED_64:
+                    data = (_LocalFileDataRegion(data, uncompressed_size, crc_32),)
+            yield name, modified_at, mode, method, data
+
+    pending: List[Union[bytes, memoryview]] = []
+    pending_size = 0
+    try:
+        for chunk in _zipped_chunks_uneven(
+            files=with_local_file_data_regions(files) if sendfile and password is None else files,
+            get_compressobj=get_compressobj,
+            extended_timestamps=extended_timestamps,
+            password=password,
+            get_crypto_random=get_crypto_random,
+            executor=executor,
+            lookahead_members=lookahead_members,
+            lookahead_bytes=lookahead_bytes,
+            deflate_block_size=deflate_block_size,
+            central_directory_memory_limit=central_directory_memory_limit,
+            buffer_memory_limit=buffer_memory_limit,
+            temp_dir=temp_dir,
+        ):
+            if isinstance(chunk, _LocalFileDataRegion):
+                write(pending)
+                pending = []
+                pending_size = 0
+                copy_local_file(chunk)
+                continue
+            if not chunk:
+                continue
+            pending.append(chunk)
+            pending_size += len(chunk)
+            # Chunks that aren't bytes can change once the next is requested, so are written now
+            if len(pending) >= max_chunks or pending_size >= max_bytes or type(chunk) is not bytes:
+                write(pending)
+                pending = []
+                pending_size = 0
+
+        write(pending)
+    finally:
+        # Don't leave the allocated but unwritten space at the end of the file, whether on
+        # exception or because size was larger than the ZIP, but keep anything that was already
+        # in the file after where the ZIP was written
+        if allocated:
+            os.ftruncate(fd, max(fd_stat.st_size, os.lseek(fd, 0, os.SEEK_CUR)))
+
+
+def stream_zip_to_fileobj(files: Iterable[MemberFile], fileobj: IO[bytes], size: Optional[int]=None,
+                          get_compressobj: _CompressObjGetter=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
+                          extended_timestamps: bool=True,
+                          password: Optional[str]=None,
+                          get_crypto_random: Callable[[int], bytes]=lambda num_bytes: secrets.token_bytes(num_bytes),
+                          executor: Optional[Executor]=None,
+                          lookahead_members: int=16,
+                          lookahead_bytes: int=33554432,
+                          deflate_block_size: Optional[int]=None,
+                          central_directory_memory_limit: Optional[int]=None,
+                          buffer_memory_limit: Optional[int]=None,
+                          temp_dir: Optional[str]=None,
+                          sendfile: bool=True,
+                          verify_crc_32: bool=False,
+) -> None:
+    # As stream_zip_to_fd, but for a file object that has a file descriptor, for example one
+    # returned by open. Anything buffered in the file object is flushed first, and afterwards its
+    # position is synced with the file descriptor's if it's seekable
+    fileobj.flush()
+    stream_zip_to_fd(
+        files, fileobj.fileno(), size=size,
+        get_compressobj=get_compressobj,
+        extended_timestamps=extended_timestamps,
+        password=password,
+        get_crypto_random=get_crypto_random,
+        executor=executor,
+        lookahead_members=lookahead_members,
+        lookahead_bytes=lookahead_bytes,
+        deflate_block_size=deflate_block_size,
+        central_directory_memory_limit=central_directory_memory_limit,
+        buffer_memory_limit=buffer_memory_limit,
+        temp_dir=temp_dir,
+        sendfile=sendfile,
+        verify_crc_32=verify_crc_32,
+    )
+    if fileobj.seekable():
+        fileobj.seek(0, os.SEEK_CUR)
+
+
+# A file-like object of the ZIP that stream_zip would output, for APIs that read from file objects.
+# readinto copies the uneven chunks of headers and data straight into the caller's buffer, rather
+# than via evenly sized chunks of bytes
+class StreamZipReader(io.RawIOBase):
+    def __init__(self, files: Iterable[MemberFile],
+                 get_compressobj: _CompressObjGetter=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
+                 extended_timestamps: bool=True,
+                 password: Optional[str]=None,
+                 get_crypto_random: Callable[[int], bytes]=lambda num_bytes: secrets.token_bytes(num_bytes),
+                 executor: Optional[Executor]=None,
+                 lookahead_members: int=16,
+                 lookahead_bytes: int=33554432,
+                 deflate_block_size: Optional[int]=None,
+                 central_directory_memory_limit: Optional[int]=None,
+                 buffer_memory_limit: Optional[int]=None,
+                 temp_dir: Optional[str]=None,
+    ) -> None:
+        super().__init__()
+
+        def chunks() -> Generator[bytes, None, None]:
+            yield from _zipped_chunks_uneven(
+                files=files,
+                get_compressobj=get_compressobj,
+                extended_timestamps=extended_timestamps,
+                password=password,
+                get_crypto_random=get_crypto_random,
+                executor=executor,
+                lookahead_members=lookahead_members,
+                lookahead_bytes=lookahead_bytes,
+                deflate_block_size=deflate_block_size,
+                central_directory_memory_limit=central_directory_memory_limit,
+                buffer_memory_limit=buffer_memory_limit,
+                temp_dir=temp_dir,
+            )
+
+        self._chunks = chunks()
+        self._chunk = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        target = memoryview(buffer).cast('B')
+        num_read = 0
+        while num_read < len(target):
+            if not self._chunk:
+                try:
+                    self._chunk = memoryview(next(self._chunks)).cast('B')
+                except StopIteration:
+                    break
+                continue
+            num_to_read = min(len(target) - num_read, len(self._chunk))
+            target[num_read:num_read + num_to_read] = self._chunk[:num_to_read]
+            self._chunk = self._chunk[num_to_read:]
+            num_read += num_to_read
+        return num_read
+
+    def close(self) -> None:
+        if not self.closed:
+            self._chunks.close()
+            self._chunk = memoryview(b'')
+        super().close()
+
+
+# Replaces the data of member files with _DataRegion placeholders of the size of their data in the
+# ZIP, so the core can lay out the ZIP without reading any data. The data of each member file is a
+# function taking an offset into its data and returning its data from that offset
+def _with_data_regions(files: Iterable[Tuple[str, datetime, int, Method, Callable[[int], Iterable[bytes]]]]) -> Iterable[MemberFile]:
+    for name, modified_at, mode, method, get_chunks in files:
+        _method, _, _, uncompressed_size, _, compressed_size = method._get(0, lambda: zlib.compressobj())
+        size_integrity_error: Type[Exception]
+        if _method in (_NO_COMPRESSION_STREAMED_32, _NO_COMPRESSION_STREAMED_64):
+            size, size_integrity_error = uncompressed_size, UncompressedSizeIntegrityError
+        elif _method in (_DEFLATED_32, _DEFLATED_64, _RAW_32, _RAW_64):
+            size, size_integrity_error = compressed_size, CompressedSizeIntegrityError
+        else:
+            raise UnknownSizeError()
+        yield name, modified_at, mode, method, (_DataRegion(size, get_chunks, size_integrity_error),)
+
+
+def stream_zip_size(files: Iterable[Tuple[str, datetime, int, Method]],
+                    extended_timestamps: bool=True,
+                    password: Optional[str]=None,
+) -> int:
+    # The exact number of bytes stream_zip would output for member files with the same names,
+    # modification times, modes and methods, for example for a Content-Length header. Only
+    # possible when the size of each member file's data in the ZIP is known in advance. The ZIP is
+    # laid out by the same code as stream_zip, with placeholders in place of the data
+    return sum(len(chunk) for chunk in _zipped_chunks_uneven(
+        files=_with_data_regions((name, modified_at, mode, method, lambda offset: ()) for name, modified_at, mode, method in files),
+        get_compressobj=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
+        extended_timestamps=extended_timestamps,
+        password=password,
+        get_crypto_random=lambda num_bytes: bytes(num_bytes),
+        executor=None,
+        lookahead_members=0,
+        lookahead_bytes=0,
+        deflate_block_size=None,
+        layout_only=True,
+    ))
+
+
+# The offset index of a ZIP whose member files' data have sizes known in advance. The headers,
+# central directory and end records between the data of member files are joined into single
+# pieces, and the data of each member file is a _DataRegion placeholder. The offset that each piece
+# starts at is kept, so the pieces of any range of the ZIP are found by bisecting the offsets,
+# without laying out the ZIP again
+class _ZipLayout():
+    def __init__(self, files: Iterable[Tuple[str, datetime, int, Method, Callable[[int], Iterable[bytes]]]],
+                 extended_timestamps: bool) -> None:
+        self.offsets: List[int] = []
+        self.pieces: List[bytes] = []
+        self.size = 0
+        pending: List[bytes] = []
+
+        def append(piece: bytes) -> None:
+            if len(piece):
+                self.offsets.append(self.size)
+                self.pieces.append(piece)
+                self.size += len(piece)
+
+        for chunk in _zipped_chunks_uneven(
+            files=_with_data_regions(files),
+            get_compressobj=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
+            extended_timestamps=extended_timestamps,
+            password=None,
+            get_crypto_random=lambda num_bytes: secrets.token_bytes(num_bytes),
+            executor=None,
+            lookahead_members=0,
+            lookahead_bytes=0,
+            deflate_block_size=None,
+        ):
+            if isinstance(chunk, _DataRegion):
+                append(b''.join(pending))
+                pending = []
+                append(chunk)
+            else:
+                pending.append(chunk)
+        append(b''.join(pending))
+
+    def chunks(self, start: int, end: Optional[int]=None) -> Iterable[bytes]:
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        index = max(bisect_right(self.offsets, start) - 1, 0)
+        while index < len(self.pieces) and self.offsets[index] < end:
+            piece = self.pieces[index]
+            piece_start = self.offsets[index]
+            from_offset = max(start - piece_start, 0)
+            to_offset = min(end - piece_start, len(piece))
+            if isinstance(piece, _DataRegion):
+                yield from self._data_region_chunks(piece, from_offset, to_offset)
+            else:
+                yield piece[from_offset:to_offset]
+            index += 1
+
+    @staticmethod
+    def _data_region_chunks(region: _DataRegion, from_offset: int, to_offset: int) -> Iterable[bytes]:
+        remaining = to_offset - from_offset
+        for chunk in region.get_chunks(from_offset):
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+            if not remaining:
+                break
+        if remaining:
+            raise region.size_integrity_error()
+
+
+def stream_zip_range(files: Iterable[Tuple[str, datetime, int, Method, Callable[[int], Iterable[bytes]]]],
+                     start: int, end: Optional[int]=None, chunk_size: int=65536,
+                     extended_timestamps: bool=True,
+) -> Iterable[bytes]:
+    # The bytes from start up to but not including end of the ZIP that stream_zip would output, for
+    # example to respond to an HTTP Range request. The data of each member file is a function taking
+    # an offset into its data and returning its data from that offset, and it's only called if some
+    # of its data is in the range. Only possible when the size of each member file's data in the ZIP
+    # is known in advance, and without encryption, since it would use a different salt each time.
+    # The ZIP is laid out from the metadata of the member files without reading any data, and then
+    # only the pieces that overlap the range are output
+    layout = _ZipLayout(files, extended_timestamps)
+    yield from _evenly_sized(layout.chunks(start, end), chunk_size)
+
+
+def stream_zip_parts(get_files: Callable[[], Iterable[Tuple[str, datetime, int, Method, Callable[[int], Iterable[bytes]]]]],
+                     part_size: int, upload_part: Callable[[int, Iterable[bytes]], T],
+                     executor: Optional[Executor]=None, chunk_size: int=65536,
+                     extended_timestamps: bool=True,
+) -> List[T]:
+    # Splits the ZIP that stream_zip_range would output into parts of part_size bytes, apart from
+    # the last, and passes each to upload_part concurrently in the executor, for example for a
+    # multipart upload to object storage. Parts are numbered from 1, and the return values of
+    # upload_part are returned in order of part number. The ZIP is laid out once, and each part
+    # is then made from the offset index of the layout, only reading the data in that part
+    layout = _ZipLayout(get_files(), extended_timestamps)
+    num_parts = max(1, -(-layout.size // part_size))
+
+    def upload(part_number: int) -> T:
+        start = (part_number - 1) * part_size
+        return upload_part(part_number, _evenly_sized(layout.chunks(start, start + part_size), chunk_size))
+
+    parts_executor = ThreadPoolExecutor() if executor is None else executor
+    futures = [parts_executor.submit(upload, part_number) for part_number in range(1, num_parts + 1)]
+    try:
+        return [future.result() for future in futures]
+    finally:
+        # On failure of one part, the parts that haven't started are not uploaded
+        for future in futures:
+            future.cancel()
+        if executor is None:
+            parts_executor.shutdown(wait=True)
+
+
+def append_to_zip(fileobj: IO[bytes], files: Iterable[MemberFile], chunk_size: int=65536,
+                  get_compressobj: _CompressObjGetter=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
+                  extended_timestamps: bool=True,
+                  password: Optional[str]=None,
+                  get_crypto_random: Callable[[int], bytes]=lambda num_bytes: secrets.token_bytes(num_bytes),
+) -> None:
+    # Appends member files to an existing ZIP in a seekable file opened for reading and writing.
+    # The new member files overwrite the existing central directory, which is kept in memory and
+    # written out again followed by the records of the new member files. If there's an exception,
+    # the existing central directory and end records are restored
+    num_entries, central_directory_size, central_directory_offset, is_zip_64 = _end_of_central_directory(fileobj)
+    fileobj.seek(central_directory_offset)
+    existing_tail = fileobj.read()
+    existing_central_directory = existing_tail[:central_directory_size]
+    if len(existing_central_directory) != central_directory_size:
+        raise InvalidZipError()
+
+    fileobj.seek(central_directory_offset)
+    try:
+        for chunk in _evenly_sized(_zipped_chunks_uneven(
+            files=files,
+            get_compressobj=get_compressobj,
+            extended_timestamps=extended_timestamps,
+            password=password,
+            get_crypto_random=get_crypto_random,
+            executor=None,
+            lookahead_members=0,
+            lookahead_bytes=0,
+            deflate_block_size=None,
+            existing_central_directory=existing_central_directory,
+            existing_central_directory_length=num_entries,
+            existing_zip_64_central_directory=is_zip_64,
+            start_offset=central_directory_offset,
+        ), chunk_size):
+            fileobj.write(chunk)
+    except BaseException:
+        fileobj.seek(central_directory_offset)
+        fileobj.write(existing_tail)
+        fileobj.truncate()
+        raise
+    fileobj.truncate()
+
+
+def merge_zips(sources: Iterable[IO[bytes]], chunk_size: int=65536) -> Iterable[bytes]:
+    # Merges existing ZIPs in seekable files into one ZIP. Everything before the central directory
+    # of each is copied byte for byte, and their central directory records are combined, with the
+    # offsets of their local headers shifted by where each ZIP starts in the merged ZIP
+
+    def shifted_central_directory(central_directory: bytes, num_entries: int, shift: int) -> Iterable[bytes]:
+        position = 0
+        for _ in range(0, num_entries):
+            if central_directory[position:position + 4] != _central_directory_header_signature:
+                raise InvalidZipError()
+            version_made_by, system_made_by, version_required, reserved, flags, compression, mod_at_ms_dos, crc_32, \
+                compressed_size, uncompressed_size, name_length, extra_length, comment_length, disk_number, \
+                internal_attr, external_attr, local_header_offset = \
+                _central_directory_header_struct.unpack_from(central_directory, position + 4)
+            position += 4 + _central_directory_header_struct.size
+            name_encoded = central_directory[position:position + name_length]
+            extra = central_directory[position + name_length:position + name_length + extra_length]
+            comment = central_directory[position + name_length + extra_length:position + name_length + extra_length + comment_length]
+            position += name_length + extra_length + comment_length
+
+            # Zip64 extra: only the values that don't fit in the header, in this order
+            zip_64_values: List[int] = []
+            other_extra = bytearray()
+            extra_position = 0
+            while extra_position + _extra_header_struct.size <= len(extra):
+                header_id, size = _extra_header_struct.unpack_from(extra, extra_position)
+                field = extra[extra_position + _extra_header_struct.size:extra_position + _extra_header_struct.size + size]
+                if header_id == 0x0001:
+                    zip_64_values = list(Struct('<' + 'Q' * (size // 8)).unpack_from(field))
+                else:
+                    other_extra += extra[extra_position:extra_position + _extra_header_struct.size + size]
+                extra_position += _extra_header_struct.size + size
+
+            num_zip_64_values_before_offset = (uncompressed_size == 0xffffffff) + (compressed_size == 0xffffffff)
+            if local_header_offset == 0xffffffff:
+                if len(zip_64_values) <= num_zip_64_values_before_offset:
+                    raise InvalidZipError()
+                zip_64_values[num_zip_64_values_before_offset] += shift
+            elif local_header_offset + shift > 0xffffffff:
+                zip_64_values.insert(num_zip_64_values_before_offset, local_header_offset + shift)
+                local_header_offset = 0xffffffff
+                version_required = max(version_required, 45)
+            else:
+                local_header_offset += shift
+
+            zip_64_extra = \
+                _extra_header_struct.pack(0x0001, 8 * len(zip_64_values)) + Struct('<' + 'Q' * len(zip_64_values)).pack(*zip_64_values) if zip_64_values else \
+                b''
+
+            yield _central_directory_header_signature
+            yield _central_directory_header_struct.pack(
+                version_made_by, system_made_by, version_required, reserved, flags, compression, mod_at_ms_dos, crc_32,
+                compressed_size, uncompressed_size, name_length, len(zip_64_extra) + len(other_extra), comment_length,
+                disk_number, internal_attr, external_attr, local_header_offset,
+            )
+            yield from (name_encoded, zip_64_extra, bytes(other_extra), comment)
+
+    def merged_chunks() -> Iterable[bytes]:
+        central_directory = bytearray()
+        central_directory_length = 0
+        zip_64_central_directory = False
+        offset = 0
+
+        for source in sources:
+            num_entries, central_directory_size, central_directory_offset, is_zip_64 = _end_of_central_directory(source)
+            source.seek(central_directory_offset)
+            source_central_directory = source.read(central_directory_size)
+            if len(source_central_directory) != central_directory_size:
+                raise InvalidZipError()
+
+            for chunk in shifted_central_directory(source_central_directory, num_entries, offset):
+                central_directory += chunk
+            central_directory_length += num_entries
+            zip_64_central_directory = zip_64_central_directory or is_zip_64
+
+            source.seek(0)
+            remaining = central_directory_offset
+            while remaining:
+                chunk = source.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise InvalidZipError()
+                remaining -= len(chunk)
+                offset += len(chunk)
+                yield chunk
+
+        # As for ZIP_AUTO, the end of central directory records are only Zip64 if they need to be,
+        # or if any of the merged ZIPs had them
+        zip_64_central_directory = zip_64_central_directory \
+            or central_directory_length > 0xffff \
+            or len(central_directory) > 0xffffffff \
+            or offset > 0xffffffff
+
+        yield from _zipped_chunks_uneven(
+            files=(),
+            get_compressobj=lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9),
+            extended_timestamps=True,
+            password=None,
+            get_crypto_random=lambda num_bytes: secrets.token_bytes(num_bytes),
+            executor=None,
+            lookahead_members=0,
+            lookahead_bytes=0,
+            deflate_block_size=None,
+            existing_central_directory=bytes(central_directory),
+            existing_central_directory_length=central_directory_length,
+            existing_zip_64_central_directory=zip_64_central_directory,
+            start_offset=offset,
+        )
+
+    yield from _evenly_sized(merged_chunks(), chunk_size)
+
+
+class FairScheduler(Executor):
+    # An executor that shares its threads fairly between archives. Each call to async_stream_zip
+    # that's passed the scheduler gets its own queue of tasks, and threads take tasks from the
+    # queues round-robin, running at most max_workers_per_archive tasks from each at once. Tasks
+    # submitted directly all go in one further queue
+    def __init__(self, max_workers: int, max_workers_per_archive: int=1) -> None:
+        self._max_workers = max_workers
+        self._max_workers_per_archive = max_workers_per_archive
+        self._condition = threading.Condition()
+        self._ready: Deque[_FairSchedulerQueue] = deque()
+        self._threads: List[threading.Thread] = []
+        self._num_idle = 0
+        self._queue_depth = 0
+        self._is_shutdown = False
+        self._default_queue = _FairSchedulerQueue(self, max_workers)
+
+    @property
+    def queue_depth(self) -> int:
+        # The number of tasks waiting for a thread
+        with self._condition:
+            return self._queue_depth
+
+    def submit(self, __fn: Callable[..., T], *args: Any, **kwargs: Any) -> 'Future[T]':
+        return self._default_queue.submit(__fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool=True, *, cancel_futures: bool=False) -> None:
+        with self._condition:
+            self._is_shutdown = True
+            if cancel_futures:
+                for queue in self._ready:
+                    for future, _, _, _ in queue.tasks:
+                        future.cancel()
+                    queue.tasks.clear()
+                    queue.is_ready = False
+                self._ready.clear()
+                self._queue_depth = 0
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _for_archive(self) -> Executor:
+        return _FairSchedulerQueue(self, self._max_workers_per_archive)
+
+    def _submit(self, queue: '_FairSchedulerQueue', fn: Callable[..., T], args: Tuple[Any, ...], kwargs: Any) -> 'Future[T]':
+        future: 'Future[T]' = Future()
+        with self._condition:
+            if self._is_shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            queue.tasks.append((future, fn, args, kwargs))
+            self._queue_depth += 1
+            if not queue.is_ready:
+                queue.is_ready = True
+                self._ready.append(queue)
+            if self._num_idle:
+                self._condition.notify_all()
+            elif len(self._threads) < self._max_workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def _next_task(self) -> Optional[Tuple['_FairSchedulerQueue', 'Future[Any]', Callable[..., Any], Tuple[Any, ...], Any]]:
+        # Round-robin over the queues with waiting tasks, skipping those at their limit
+        for _ in range(0, len(self._ready)):
+            queue = self._ready.popleft()
+            if queue.num_running >= queue.max_running:
+                self._ready.append(queue)
+                continue
+            future, fn, args, kwargs = queue.tasks.popleft()
+            queue.num_running += 1
+            self._queue_depth -= 1
+            if queue.tasks:
+                self._ready.append(queue)
+            else:
+                queue.is_ready = False
+            return queue, future, fn, args, kwargs
+        return None
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                task = self._next_task()
+                while task is None:
+                    if self._is_shutdown and not self._queue_depth:
+                        return
+                    self._num_idle += 1
+                    self._condition.wait()
+                    self._num_idle -= 1
+                    task = self._next_task()
+
+            queue, future, fn, args, kwargs = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+
+            with self._condition:
+                queue.num_running -= 1
+                self._condition.notify_all()
+
+class _FairSchedulerQueue(Executor):
+    def __init__(self, scheduler: FairScheduler, max_running: int) -> None:
+        self.scheduler = scheduler
+        self.max_running = max_running
+        self.num_running = 0
+        self.is_ready = False
+        self.tasks: Deque[Tuple['Future[Any]', Callable[..., Any], Tuple[Any, ...], Any]] = deque()
+
+    def submit(self, __fn: Callable[..., T], *args: Any, **kwargs: Any) -> 'Future[T]':
+        return self.scheduler._submit(self, __fn, args, kwargs)
 
 
 async def async_stream_zip(
@@ -811,57 +2661,203 @@ async def async_stream_zip(
     extended_timestamps: bool=True,
     password: Optional[str]=None,
     get_crypto_random: Callable[[int], bytes]=lambda num_bytes: secrets.token_bytes(num_bytes),
+    producer_thread: bool=False,
+    high_watermark: int=4194304,
+    low_watermark: int=1048576,
+    executor: Optional[Executor]=None,
 ) -> AsyncIterable[bytes]:
 
-    async def to_async_iterable(sync_iterable: Iterable[Any]) -> AsyncIterable[Any]:
-        # asyncio.to_thread is not available until Python 3.9, and StopIteration doesn't get
-        # propagated by run_in_executor, so we use a sentinel to detect the end of the iterable
+    # The same internals as stream_zip run on the event loop, and when they need the next member
+    # file or the next chunk of a member file, the sync iterables below yield a command to await
+    # it. Each is awaited in its own task to give each a copy of the context, which is how a
+    # thread would see it. Only CPU-heavy compression and encryption run in a thread
+
+    def to_sync_iterable(async_iterable: AsyncIterable[T]) -> Iterable[Any]:
+        # The built-in aiter and anext functions are not available until Python 3.10
+        async_it = async_iterable.__aiter__()
         done = object()
-        it = iter(sync_iterable)
+
+        async def get_next() -> Any:
+            try:
+                return await async_it.__anext__()
+            except StopAsyncIteration:
+                return done
+
+        while True:
+            awaiting = _Await(lambda: asyncio.ensure_future(get_next()))
+            yield awaiting
+            if awaiting.result is done:
+                break
+            yield awaiting.result
+
+    def to_sync_getter(get_async_iterable: Callable[[], AsyncIterable[T]]) -> Callable[[], Iterable[Any]]:
+        return lambda: to_sync_iterable(get_async_iterable())
+
+    def sync_member_files() -> Iterable[Any]:
+        for member_file in to_sync_iterable(files):
+            yield \
+                member_file if isinstance(member_file, _Await) else \
+                member_file[0:4] + (to_sync_getter(member_file[4]) if callable(member_file[4]) else to_sync_iterable(member_file[4]),)
+
+    def run_in_thread(func: Callable[[], T]) -> Awaitable[T]:
+        return loop.run_in_executor(archive_executor, func)
+
+    async def on_event_loop(chunks: Iterable[bytes]) -> AsyncIterable[bytes]:
+        for chunk in chunks:
+            if isinstance(chunk, _Await):
+                chunk.result = await chunk.get_awaitable()
+            else:
+                yield chunk
+
+    async def produced_ahead(chunks: Iterable[bytes]) -> AsyncIterable[bytes]:
+        # The internals run ahead of client code, pushing chunks to a queue, pausing when the
+        # queue reaches the high watermark until it's drained to the low watermark. The event
+        # loop is only woken when the queue goes from empty to non-empty, and so typically
+        # receives chunks in batches. Without an executor the internals run in a dedicated
+        # thread. With an executor they run as a series of tasks that each produce one chunk,
+        # so the executor's threads are shared between archives chunk by chunk
+        it = iter(chunks)
+        condition = threading.Condition()
+        queue: Deque[bytes] = deque()
+        queue_size = 0
+        paused = False
+        done = False
+        closed = False
+        exception: Optional[BaseException] = None
+        available = asyncio.Event()
+
+        async def awaited(awaiting: _Await) -> Any:
+            return await awaiting.get_awaitable()
+
+        def push(chunk: bytes) -> bool:
+            # Returns whether production should continue
+            nonlocal queue_size, paused
+            with condition:
+                while executor is None and paused and not closed:
+                    condition.wait()
+                if closed:
+                    return False
+                was_empty = not queue
+                queue.append(chunk)
+                queue_size += len(chunk)
+                paused = queue_size >= high_watermark
+                should_continue = executor is None or not paused
+            if was_empty:
+                loop.call_soon_threadsafe(available.set)
+            return should_continue
+
+        def finish(e: Optional[BaseException]) -> None:
+            nonlocal done, exception
+            with condition:
+                exception = e
+                done = True
+            loop.call_soon_threadsafe(available.set)
+
+        def produce_in_thread() -> None:
+            try:
+                for chunk in it:
+                    if isinstance(chunk, _Await):
+                        chunk.result = asyncio.run_coroutine_threadsafe(awaited(chunk), loop).result()
+                    elif not push(chunk):
+                        return
+            except BaseException as e:
+                finish(e)
+            else:
+                finish(None)
+
+        def produce_in_executor() -> None:
+            try:
+                with condition:
+                    if closed:
+                        return
+                chunk = next(it, None)
+                if chunk is None:
+                    finish(None)
+                elif isinstance(chunk, _Await):
+                    asyncio.run_coroutine_threadsafe(awaited(chunk), loop).add_done_callback(
+                        lambda future: resume_after_await(chunk, future))
+                elif push(chunk):
+                    submit()
+            except BaseException as e:
+                finish(e)
+
+        def resume_after_await(awaiting: _Await, future: 'Future[Any]') -> None:
+            try:
+                awaiting.result = future.result()
+            except BaseException as e:
+                finish(e)
+            else:
+                submit()
+
+        def submit() -> None:
+            assert archive_executor is not None
+            try:
+                archive_executor.submit(run_in_context, produce_in_executor)
+            except BaseException as e:
+                finish(e)
 
         # contextvars are not available until Python 3.7
         try:
             import contextvars
         except ImportError:
-            get_func_args: Callable[[], Tuple[Callable[..., Any], Tuple[Any, ...]]] = lambda: (next, (it, done))
+            run_in_context: Callable[[Callable[[], None]], None] = lambda func: func()
         else:
-            get_func_args = lambda: (contextvars.copy_context().run, (next, it, done))
+            context = contextvars.copy_context()
+            run_in_context = lambda func: context.copy().run(func)
 
-        while True:
-            func, args = get_func_args()
-            value = await loop.run_in_executor(None, func, *args)
-            if value is done:
-                break
-            yield value
+        if executor is None:
+            threading.Thread(target=lambda: run_in_context(produce_in_thread), daemon=True).start()
+        else:
+            submit()
 
-    T = TypeVar("T")
+        try:
+            while True:
+                with condition:
+                    if not queue and done:
+                        break
+                    if not queue:
+                        available.clear()
+                    chunk = queue.popleft() if queue else None
 
-    def to_sync_iterable(async_iterable: AsyncIterable[T]) -> Iterable[T]:
-        # The built-in aiter and anext functions are not available until Python 3.10
-        async_it = async_iterable.__aiter__()
+                if chunk is None:
+                    await available.wait()
+                    continue
 
-        async def get_next() -> T:
-            return await async_it.__anext__()
-        while True:
-            try:
-                value = asyncio.run_coroutine_threadsafe(get_next(), loop).result()
-            except StopAsyncIteration:
-                break
-            yield value
+                yield chunk
 
-    loop = asyncio.get_event_loop()
-    sync_member_files = (
-        member_file[0:4] + (to_sync_iterable(member_file[4],),)
-        for member_file in to_sync_iterable(files)
-    )
+                with condition:
+                    queue_size -= len(chunk)
+                    resume = paused and queue_size <= low_watermark
+                    if resume:
+                        paused = False
+                        condition.notify_all()
+                if resume and executor is not None:
+                    submit()
+        finally:
+            with condition:
+                closed = True
+                condition.notify_all()
+
+        if exception is not None:
+            raise exception
 
-    async for chunk in to_async_iterable(stream_zip(
-            files=sync_member_files, chunk_size=chunk_size,
-            get_compressobj=get_compressobj,
-            extended_timestamps=extended_timestamps,
-            password=password,
-            get_crypto_random=get_crypto_random,
-    )):
+    loop = asyncio.get_event_loop()
+    archive_executor = executor._for_archive() if isinstance(executor, FairScheduler) else executor
+
+    zipped_chunks = _evenly_sized(_zipped_chunks_uneven(
+        files=sync_member_files(),
+        get_compressobj=get_compressobj,
+        extended_timestamps=extended_timestamps,
+        password=password,
+        get_crypto_random=get_crypto_random,
+        executor=None,
+        lookahead_members=0,
+        lookahead_bytes=0,
+        deflate_block_size=None,
+        run_in_thread=None if producer_thread else run_in_thread,
+    ), chunk_size)
+
+    async for chunk in (produced_ahead if producer_thread else on_event_loop)(zipped_chunks):
         yield chunk
 
 
@@ -885,6 +2881,34 @@ class UncompressedSizeIntegrityError(ZipIntegrityError):
     pass
 
 
+class CompressedSizeIntegrityError(ZipIntegrityError):
+    pass
+
+
+class DeflateIntegrityError(ZipIntegrityError):
+    pass
+
+
+class GzipIntegrityError(ZipIntegrityError):
+    pass
+
+
+class MultiMemberGzipError(ZipValueError):
+    pass
+
+
+class UnknownSizeError(ZipValueError):
+    pass
+
+
+class InvalidZipError(ZipValueError):
+    pass
+
+
+class UnsupportedZipError(ZipValueError):
+    pass
+
+
 class ZipOverflowError(ZipValueError, OverflowError):
     pass
 
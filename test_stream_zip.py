@@ -1,13 +1,22 @@
 from collections import Counter
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from io import BytesIO
 import asyncio
 import contextlib
+import errno
+import gzip
+import io
+import mmap
 import os
 import secrets
+import shutil
 import stat
 import subprocess
 import sys
+import threading
+import time
+import tracemalloc
 import zlib
 from tempfile import TemporaryDirectory
 from struct import Struct
@@ -20,13 +29,39 @@ from stream_unzip import IncorrectAESPasswordError, UnsupportedZip64Error, strea
 from stream_zip import (
     async_stream_zip,
     stream_zip,
+    FairScheduler,
+    CRC32Cache,
+    stored_member_file,
+    raw_member_files,
+    append_to_zip,
+    merge_zips,
+    stream_zip_size,
+    stream_zip_range,
+    stream_zip_parts,
+    stream_zip_to_seekable,
+    stream_zip_to_fd,
+    stream_zip_to_fileobj,
+    StreamZipReader,
     NO_COMPRESSION_64,
     NO_COMPRESSION_32,
+    NO_COMPRESSION_64_TWO_PASS,
+    NO_COMPRESSION_32_TWO_PASS,
+    DEFLATED_64,
+    DEFLATED_32,
+    GZIPPED_64,
+    GZIPPED_32,
     ZIP_AUTO,
     ZIP_64,
     ZIP_32,
     CRC32IntegrityError,
     UncompressedSizeIntegrityError,
+    CompressedSizeIntegrityError,
+    DeflateIntegrityError,
+    GzipIntegrityError,
+    MultiMemberGzipError,
+    UnknownSizeError,
+    InvalidZipError,
+    UnsupportedZipError,
     CompressedSizeOverflowError,
     UncompressedSizeOverflowError,
     OffsetOverflowError,
@@ -178,6 +213,303 @@ def test_with_stream_unzip_with_no_compresion_bad_size(method):
                 pass
 
 
+@pytest.mark.parametrize(
+    "method_two_pass,method_streamed",
+    [
+        (NO_COMPRESSION_32_TWO_PASS, NO_COMPRESSION_32),
+        (NO_COMPRESSION_64_TWO_PASS, NO_COMPRESSION_64),
+    ],
+)
+def test_no_compression_two_pass_equivalent_to_known_crc_32(method_two_pass, method_streamed):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    num_calls = 0
+
+    def data():
+        nonlocal num_calls
+        num_calls += 1
+        yield b'a' * 10000
+        yield b'b' * 10000
+
+    def files_two_pass():
+        yield 'file-1', now, mode, method_two_pass, data
+        yield 'file-2', now, mode, method_two_pass, lambda: ()
+
+    def files_streamed():
+        yield 'file-1', now, mode, method_streamed(20000, zlib.crc32(b'a' * 10000 + b'b' * 10000)), data()
+        yield 'file-2', now, mode, method_streamed(0, zlib.crc32(b'')), ()
+
+    assert b''.join(stream_zip(files_two_pass())) == b''.join(stream_zip(files_streamed()))
+    assert num_calls == 3
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        NO_COMPRESSION_32_TWO_PASS,
+        NO_COMPRESSION_64_TWO_PASS,
+    ],
+)
+def test_no_compression_two_pass_data_changed_between_passes(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    passes = iter((b'a', b'b'))
+
+    def files():
+        yield 'file-1', now, mode, method, lambda: (next(passes),)
+
+    with pytest.raises(CRC32IntegrityError):
+        for _ in stream_zip(files()):
+            pass
+
+
+def test_no_compression_two_pass_needs_function():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64_TWO_PASS, (b'a',)
+
+    with pytest.raises(TypeError):
+        for _ in stream_zip(files()):
+            pass
+
+
+def _deflated(data):
+    compress_obj = zlib.compressobj(wbits=-zlib.MAX_WBITS, level=9)
+    return compress_obj.compress(data) + compress_obj.flush()
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        DEFLATED_32,
+        DEFLATED_64,
+    ],
+)
+@pytest.mark.parametrize(
+    "password",
+    [
+        None,
+        'my-password',
+    ],
+)
+def test_deflated_passed_through(method, password):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents_1 = b'a' * 100000 + os.urandom(100000)
+    contents_2 = b''
+    deflated_1 = _deflated(contents_1)
+    deflated_2 = _deflated(contents_2)
+
+    def files():
+        yield 'file-1', now, mode, method(len(contents_1), len(deflated_1), zlib.crc32(contents_1)), (deflated_1[:1000], deflated_1[1000:])
+        yield 'file-2', now, mode, method(len(contents_2), len(deflated_2), zlib.crc32(contents_2)), (deflated_2,)
+
+    zipped = b''.join(stream_zip(files(), password=password))
+    assert deflated_1 in zipped or password is not None
+
+    assert [(b'file-1', contents_1), (b'file-2', contents_2)] == [
+        (name, b''.join(chunks))
+        for name, size, chunks in stream_unzip((zipped,), password=password)
+    ]
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'test.zip')
+        with open(path, 'wb') as f:
+            f.write(zipped)
+        with pyzipper.AESZipFile(path) as zf:
+            if password is not None:
+                zf.setpassword(password.encode())
+            assert zf.read('file-1') == contents_1
+            assert zf.getinfo('file-1').compress_type == zlib.DEFLATED or password is not None
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        DEFLATED_32,
+        DEFLATED_64,
+    ],
+)
+@pytest.mark.parametrize(
+    "get_args,chunks,exception_class",
+    [
+        (lambda d: (99, len(d), zlib.crc32(b'a' * 100)), lambda d: (d,), UncompressedSizeIntegrityError),
+        (lambda d: (100, len(d), zlib.crc32(b'a' * 101)), lambda d: (d,), CRC32IntegrityError),
+        (lambda d: (100, len(d) + 1, zlib.crc32(b'a' * 100)), lambda d: (d,), CompressedSizeIntegrityError),
+        (lambda d: (100, len(d) - 1, zlib.crc32(b'a' * 100)), lambda d: (d[:-1],), DeflateIntegrityError),
+        (lambda d: (100, len(d) + 1, zlib.crc32(b'a' * 100)), lambda d: (d + b'-',), DeflateIntegrityError),
+        (lambda d: (100, 4, zlib.crc32(b'a' * 100)), lambda d: (b'\xff' * 4,), DeflateIntegrityError),
+    ],
+)
+def test_deflated_integrity(method, get_args, chunks, exception_class):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    deflated = _deflated(b'a' * 100)
+
+    def files():
+        yield 'file-1', now, mode, method(*get_args(deflated)), chunks(deflated)
+
+    with pytest.raises(exception_class):
+        for _ in stream_zip(files()):
+            pass
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        DEFLATED_32,
+        DEFLATED_64,
+    ],
+)
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        lambda d: (d + b'-',),
+        lambda d: (d, b'-'),
+        lambda d: (d[:1000], d[1000:] + b'-'),
+    ],
+)
+def test_deflated_trailing_bytes_after_long_stream(method, chunks):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b''.join(b'%d,line %d\n' % (i, i) for i in range(200000))
+    deflated = _deflated(contents)
+
+    def files():
+        yield 'file-1', now, mode, method(len(contents), len(deflated) + 1, zlib.crc32(contents)), chunks(deflated)
+
+    with pytest.raises(DeflateIntegrityError):
+        for _ in stream_zip(files()):
+            pass
+
+
+def _gzipped(data, filename=''):
+    f = BytesIO()
+    with gzip.GzipFile(filename=filename, mode='wb', fileobj=f, mtime=0) as g:
+        g.write(data)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize(
+    "method,zipfile_method",
+    [
+        (GZIPPED_32, ZIP_32),
+        (GZIPPED_64, ZIP_64),
+    ],
+)
+@pytest.mark.parametrize(
+    "filename",
+    [
+        '',
+        'file-1.txt',
+    ],
+)
+@pytest.mark.parametrize(
+    "chunk_size",
+    [
+        1,
+        1000,
+        1000000,
+    ],
+)
+@pytest.mark.parametrize(
+    "password",
+    [
+        None,
+        'my-password',
+    ],
+)
+def test_gzipped_equivalent_to_zip(method, zipfile_method, filename, chunk_size, password):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(1000)
+    gzipped = _gzipped(contents, filename)
+
+    def get_crypto_random(num_bytes):
+        return b'-' * num_bytes
+
+    def files_gzipped():
+        yield 'file-1', now, mode, method, (gzipped[i:i + chunk_size] for i in range(0, len(gzipped), chunk_size))
+        yield 'file-2', now, mode, method, (_gzipped(b''),)
+
+    def files():
+        yield 'file-1', now, mode, zipfile_method, (contents,)
+        yield 'file-2', now, mode, zipfile_method, ()
+
+    # gzip.GzipFile compresses with level 9, the same as stream_zip by default
+    assert b''.join(stream_zip(files_gzipped(), password=password, get_crypto_random=get_crypto_random)) \
+        == b''.join(stream_zip(files(), password=password, get_crypto_random=get_crypto_random))
+
+
+@pytest.mark.parametrize(
+    "method,zipfile_method",
+    [
+        (GZIPPED_32, ZIP_32),
+        (GZIPPED_64, ZIP_64),
+    ],
+)
+@pytest.mark.parametrize(
+    "chunk_size",
+    [
+        1000,
+        65536,
+        1000000,
+    ],
+)
+def test_gzipped_large_inflated_size(method, zipfile_method, chunk_size):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents_1 = b''.join(b'%d,line %d\n' % (i, i) for i in range(5000))
+    contents_2 = b'a' * 400000 + os.urandom(100000)
+    gzipped_1 = _gzipped(contents_1)
+    gzipped_2 = _gzipped(contents_2)
+
+    def files_gzipped():
+        yield 'file-1', now, mode, method, (gzipped_1[i:i + chunk_size] for i in range(0, len(gzipped_1), chunk_size))
+        yield 'file-2', now, mode, method, (gzipped_2[i:i + chunk_size] for i in range(0, len(gzipped_2), chunk_size))
+
+    def files():
+        yield 'file-1', now, mode, zipfile_method, (contents_1,)
+        yield 'file-2', now, mode, zipfile_method, (contents_2,)
+
+    assert len(contents_1) > 65536
+    assert b''.join(stream_zip(files_gzipped())) == b''.join(stream_zip(files()))
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        GZIPPED_32,
+        GZIPPED_64,
+    ],
+)
+@pytest.mark.parametrize(
+    "get_gzipped,exception_class",
+    [
+        (lambda g: g + g, MultiMemberGzipError),
+        (lambda g: g + b'-', GzipIntegrityError),
+        (lambda g: b'-' + g, GzipIntegrityError),
+        (lambda g: g[:5], GzipIntegrityError),
+        (lambda g: g[:-9], DeflateIntegrityError),
+        (lambda g: g[:-1], GzipIntegrityError),
+        (lambda g: g[:-8] + b'\x00' * 4 + g[-4:], CRC32IntegrityError),
+        (lambda g: g[:-4] + b'\x00' * 4, UncompressedSizeIntegrityError),
+    ],
+)
+def test_gzipped_integrity(method, get_gzipped, exception_class):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, method, (get_gzipped(_gzipped(b'a' * 100)),)
+
+    with pytest.raises(exception_class):
+        for _ in stream_zip(files()):
+            pass
+
+
 def test_with_stream_unzip_auto_small():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
@@ -589,415 +921,2041 @@ def test_central_directory_size_overflow():
             pass
 
 
-def test_directory_zipfile():
+@pytest.mark.parametrize(
+    "method",
+    [
+        NO_COMPRESSION_32,
+        NO_COMPRESSION_64,
+    ],
+)
+@pytest.mark.parametrize(
+    "buffer_memory_limit",
+    [
+        0,
+        100000,
+        10000000,
+    ],
+)
+@pytest.mark.parametrize(
+    "password",
+    [
+        None,
+        'my-password',
+    ],
+)
+def test_buffer_memory_limit_equivalent_to_no_limit(method, buffer_memory_limit, password):
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
+    batch = os.urandom(100000)
 
-    def files():
-        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
-        yield 'file-2/', now, mode, ZIP_64, ()
+    def get_crypto_random(num_bytes):
+        return b'-' * num_bytes
 
-    def extracted():
-        with ZipFile(BytesIO(b''.join(stream_zip(files())))) as my_zip:
-            for my_info in my_zip.infolist():
-                with my_zip.open(my_info.filename) as my_file:
-                    yield (
-                        my_info.filename,
-                        my_info.file_size,
-                        my_info.date_time,
-                        my_info.external_attr,
-                        my_file.read(),
-                    )
+    def files():
+        for i in range(0, 5):
+            yield f'file-{i}', now, mode, method, (batch,) * i
 
-    assert [(
-        'file-1',
-        20000,
-        (2021, 1, 1, 21, 1, 12),
-        mode << 16,
-        b'a' * 10000 + b'b' * 10000,
-    ), (
-        'file-2/',
-        0,
-        (2021, 1, 1, 21, 1, 12),
-        mode << 16 | 0x10,
-        b'',
-    )] == list(extracted())
+    with TemporaryDirectory() as d:
+        assert b''.join(stream_zip(files(), buffer_memory_limit=buffer_memory_limit, temp_dir=d,
+                                   password=password, get_crypto_random=get_crypto_random)) \
+            == b''.join(stream_zip(files(), password=password, get_crypto_random=get_crypto_random))
 
 
-def test_with_unzip_zip64():
+def test_buffer_memory_limit_bounds_memory():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
 
-    def files():
-        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
-        yield 'file-2', now, mode, ZIP_64, (b'c', b'd')
-
-    def extracted():
-        with TemporaryDirectory() as d:
-            with open(f'{d}/my.zip', 'wb') as f:
-                f.write(b''.join(stream_zip(files())))
-            subprocess.run(['unzip', f'{d}/my.zip', '-d', d])
+    def data():
+        for i in range(0, 512):
+            yield bytes(65536)
 
-            with open(f'{d}/file-1', 'rb') as f:
-                yield 'file-1', f.read()
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64, data()
 
-            with open(f'{d}/file-2', 'rb') as f:
-                yield 'file-2', f.read()
+    tracemalloc.start()
+    try:
+        size = 0
+        for chunk in stream_zip(files(), buffer_memory_limit=1048576):
+            size += len(chunk)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
 
-    assert [(
-        'file-1',
-        b'a' * 10000 + b'b' * 10000,
-    ), (
-        'file-2',
-        b'cd',
-    )] == list(extracted())
+    assert size > 33554432
+    assert peak < 8388608
 
 
-def test_with_unzip_zip_32_and_zip_64():
+@pytest.mark.parametrize(
+    "method,num_files",
+    [
+        (ZIP_32, 1000),
+        (ZIP_64, 1000),
+        (ZIP_AUTO(2), 0xffff + 1),
+    ],
+)
+def test_central_directory_memory_limit_equivalent_to_no_limit(method, num_files):
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
 
     def files():
-        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
-        yield 'file-2', now, mode, ZIP_32, (b'c', b'd')
-
-    def extracted():
-        with TemporaryDirectory() as d:
-            with open(f'{d}/my.zip', 'wb') as f:
-                f.write(b''.join(stream_zip(files())))
-            subprocess.run(['unzip', f'{d}/my.zip', '-d', d])
-
-            with open(f'{d}/file-1', 'rb') as f:
-                yield 'file-1', f.read()
-
-            with open(f'{d}/file-2', 'rb') as f:
-                yield 'file-2', f.read()
+        for i in range(0, num_files):
+            yield f'file-{i}', now, mode, method, (b'ab',)
 
-    assert [(
-        'file-1',
-        b'a' * 10000 + b'b' * 10000,
-    ), (
-        'file-2',
-        b'cd',
-    )] == list(extracted())
+    with TemporaryDirectory() as d:
+        assert b''.join(stream_zip(files(), central_directory_memory_limit=1000, temp_dir=d)) \
+            == b''.join(stream_zip(files()))
 
 
-def test_with_unzip_with_no_compression_32():
+def test_central_directory_size_overflow_with_memory_limit():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
 
     def files():
-        yield 'file-1', now, mode, NO_COMPRESSION_32, (b'a' * 10000, b'b' * 10000)
-        yield 'file-2', now, mode, NO_COMPRESSION_32, (b'c', b'd')
+        for i in range(0, 0xffff):
+            yield str(i).zfill(5) + '-' * 65502, now, mode, NO_COMPRESSION_32, (b'',)
 
-    def extracted():
-        with TemporaryDirectory() as d:
-            with open(f'{d}/my.zip', 'wb') as f:
-                f.write(b''.join(stream_zip(files())))
-            subprocess.run(['unzip', f'{d}/my.zip', '-d', d])
+    with pytest.raises(CentralDirectorySizeOverflowError):
+        for chunk in stream_zip(files(), central_directory_memory_limit=1000000):
+            pass
 
-            with open(f'{d}/file-1', 'rb') as f:
-                yield 'file-1', f.read()
 
-            with open(f'{d}/file-2', 'rb') as f:
-                yield 'file-2', f.read()
+@pytest.mark.parametrize(
+    "method",
+    [
+        NO_COMPRESSION_32,
+        NO_COMPRESSION_64,
+    ],
+)
+def test_stored_member_file_uses_crc_32_cache(method):
+    contents = os.urandom(200000)
 
-    assert [(
-        'file-1',
-        b'a' * 10000 + b'b' * 10000,
-    ), (
-        'file-2',
-        b'cd',
-    )] == list(extracted())
+    class CountingCRC32Cache(CRC32Cache):
+        num_sets = 0
 
+        def set(self, key, crc_32):
+            self.num_sets += 1
+            super().set(key, crc_32)
 
-def test_name_length_overflow():
+    cache = CountingCRC32Cache()
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'file-1.bin')
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+        for _ in range(0, 3):
+            assert [(b'file-1.bin', len(contents), contents)] == [
+                (name, size, b''.join(chunks))
+                for name, size, chunks in stream_unzip(stream_zip((stored_member_file(path, cache, method=method),)))
+            ]
+
+        assert cache.num_sets == 1
+
+        with open(path, 'wb') as f:
+            f.write(contents + b'-')
+        os.utime(path, ns=(1609534872000000000, 1609534872000000000))
+
+        assert [(b'file-1.bin', len(contents) + 1, contents + b'-')] == [
+            (name, size, b''.join(chunks))
+            for name, size, chunks in stream_unzip(stream_zip((stored_member_file(path, cache, method=method),)))
+        ]
+        assert cache.num_sets == 2
+
+
+def test_crc_32_cache_lru():
+    cache = CRC32Cache(max_entries=2)
+    cache.set(('a', 1, 1, 1), 1)
+    cache.set(('b', 1, 1, 1), 2)
+    assert cache.get(('a', 1, 1, 1)) == 1
+    cache.set(('c', 1, 1, 1), 3)
+
+    assert cache.get(('a', 1, 1, 1)) == 1
+    assert cache.get(('b', 1, 1, 1)) is None
+    assert cache.get(('c', 1, 1, 1)) == 3
+
+
+def test_crc_32_cache_sqlite_persists():
+    with TemporaryDirectory() as d:
+        sqlite_path = os.path.join(d, 'crc_32.sqlite')
+
+        cache_1 = CRC32Cache(sqlite_path=sqlite_path)
+        cache_1.set(('a', 1, 1, 1), 0xffffffff)
+        cache_1.close()
+
+        cache_2 = CRC32Cache(sqlite_path=sqlite_path)
+        assert cache_2.get(('a', 1, 1, 1)) == 0xffffffff
+        assert cache_2.get(('a', 1, 1, 2)) is None
+        cache_2.close()
+
+
+@pytest.mark.parametrize(
+    "password",
+    [
+        None,
+        'my-password',
+    ],
+)
+def test_raw_member_files_copied(password):
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(10000)
 
     def files():
-        yield '-' * (2**16), now, mode, ZIP_64, (b'ab',)
+        yield 'file-1', now, mode, ZIP_32, (contents,)
+        yield 'file-2', now, mode, ZIP_64, (contents,)
+        yield 'file-3', now, mode, NO_COMPRESSION_32, (contents,)
+        yield 'file-4', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (contents,)
+        yield 'file-5', now, mode, ZIP_32, ()
+
+    original = BytesIO(b''.join(stream_zip(files(), password=password)))
+
+    def copied_files():
+        for name, modified_at, mode, method, chunks in raw_member_files(original, chunk_size=1000):
+            if name != 'file-2':
+                yield 'copied-' + name, modified_at, mode, method, chunks
+        yield 'file-6', now, mode, ZIP_32, (b'new',)
+
+    copied = b''.join(stream_zip(copied_files(), password=password))
+
+    assert [
+        (b'copied-file-1', contents),
+        (b'copied-file-3', contents),
+        (b'copied-file-4', contents),
+        (b'copied-file-5', b''),
+        (b'file-6', b'new'),
+    ] == [
+        (name, b''.join(chunks))
+        for name, size, chunks in stream_unzip((copied,), password=password)
+    ]
 
-    with pytest.raises(NameLengthOverflowError):
-        for chunk in stream_zip(files()):
-            pass
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'test.zip')
+        with open(path, 'wb') as f:
+            f.write(copied)
+        with pyzipper.AESZipFile(path) as zf:
+            if password is not None:
+                zf.setpassword(password.encode())
+            assert zf.read('copied-file-1') == contents
+            assert zf.getinfo('copied-file-1').date_time == (2021, 1, 1, 21, 1, 12)
+            assert zf.getinfo('copied-file-1').external_attr >> 16 == mode
 
 
-def test_exception_propagates():
+def test_raw_member_files_from_zipfile():
+    contents = b'a' * 10000 + os.urandom(10000)
+
+    original = BytesIO()
+    with ZipFile(original, 'w', compression=zlib.DEFLATED) as zf:
+        zf.writestr('file-1', contents)
+        zf.writestr('file-2', b'')
+
+    copied = b''.join(stream_zip(raw_member_files(original)))
+
+    assert [(b'file-1', contents), (b'file-2', b'')] == [
+        (name, b''.join(chunks))
+        for name, size, chunks in stream_unzip((copied,))
+    ]
+
+
+def test_raw_member_files_invalid_zip():
+    with pytest.raises(InvalidZipError):
+        next(iter(raw_member_files(BytesIO(b'-' * 100))))
+
+
+def test_raw_member_files_traditional_encryption_unsupported():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
 
     def files():
-        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
-        raise Exception('From generator')
+        yield 'file-1', now, mode, ZIP_32, (b'a',)
 
-    with pytest.raises(Exception,  match='From generator'):
-        for chunk in stream_zip(files()):
-            pass
+    original = bytearray(b''.join(stream_zip(files())))
+    # Set the encryption flag without the AES extra, in the central directory
+    central_directory_offset = original.rfind(b'PK\x01\x02')
+    original[central_directory_offset + 8] |= 0b00000001
 
+    with pytest.raises(UnsupportedZipError):
+        next(iter(raw_member_files(BytesIO(original))))
 
-def test_exception_from_bytes_propagates():
+
+def test_append_to_zip():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
 
-    def data():
-        yield b'-'
-        raise Exception('From generator')
-
     def files():
-        yield 'file-1', now, mode, ZIP_64, data()
+        yield 'file-1', now, mode, ZIP_32, (b'a' * 10000,)
+        yield 'file-2', now, mode, NO_COMPRESSION_32, (b'b' * 10000,)
+
+    def new_files():
+        yield 'file-3', now, mode, ZIP_32, (b'c' * 10000,)
+        yield 'file-4', now, mode, ZIP_64, (b'd' * 10000,)
+
+    def all_files():
+        yield from files()
+        yield from new_files()
+
+    f = BytesIO(b''.join(stream_zip(files())))
+    append_to_zip(f, new_files())
+
+    assert [
+        (b'file-1', b'a' * 10000),
+        (b'file-2', b'b' * 10000),
+        (b'file-3', b'c' * 10000),
+        (b'file-4', b'd' * 10000),
+    ] == [
+        (name, b''.join(chunks))
+        for name, size, chunks in stream_unzip((f.getvalue(),))
+    ]
+    assert f.getvalue() == b''.join(stream_zip(all_files()))
 
-    with pytest.raises(Exception,  match='From generator'):
-        for chunk in stream_zip(files()):
-            pass
+    with ZipFile(f) as zf:
+        assert zf.read('file-4') == b'd' * 10000
 
 
-def test_chunk_sizes():
+def test_append_to_zip_no_files():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
 
     def files():
-        yield 'file-1', now, mode, ZIP_64, (os.urandom(500000),)
+        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000,)
 
-    def get_sizes():
-        for chunk in stream_zip(files()):
-            yield len(chunk)
+    original = b''.join(stream_zip(files()))
+    f = BytesIO(original)
+    append_to_zip(f, ())
 
-    sizes = list(get_sizes())
-    assert sizes[0] == 65
-    assert set(sizes[1:-1]) == {65536}
-    assert sizes[-1] <= 65536
+    assert f.getvalue() == original
 
 
-@pytest.mark.parametrize(
-    "method",
-    [
-        ZIP_32,
-        ZIP_64,
-        NO_COMPRESSION_64(1, 2547889144),
-        NO_COMPRESSION_32(1, 2547889144),
-    ],
-)
-def test_local_headers_flushed(method):
+def test_append_to_zip_auto_upgrade():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
 
-    state = []
+    def files(start, end):
+        for i in range(start, end):
+            yield f'file-{i}', now, mode, ZIP_AUTO(1), (b'a',)
 
-    def data():
-        state.append('data')
-        yield b'-'
+    f = BytesIO(b''.join(stream_zip(files(0, 0xffff))))
+    append_to_zip(f, files(0xffff, 0xffff + 1))
+
+    assert f.getvalue() == b''.join(stream_zip(files(0, 0xffff + 1)))
+    assert len([
+        b''.join(chunks)
+        for name, size, chunks in stream_unzip((f.getvalue(),))
+    ]) == 0xffff + 1
+
+
+def test_append_to_zip_exception_restores():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
 
     def files():
-        state.append('file')
-        yield 'file-1', now, mode, method, data()
+        yield 'file-1', now, mode, ZIP_32, (b'a' * 10000,)
 
-    for chunk in stream_zip(files()):
-        state.append('chunk')
-        if b'file-1' in chunk:
-            state.append('file-name')
+    def new_files():
+        yield 'file-2', now, mode, ZIP_32, (b'b' * 10000,)
+        raise Exception('Failed')
 
-    assert state == ['file', 'chunk', 'file-name', 'data', 'chunk', 'file-name']
+    original = b''.join(stream_zip(files()))
+    f = BytesIO(original)
+    with pytest.raises(Exception, match='Failed'):
+        append_to_zip(f, new_files())
 
+    assert f.getvalue() == original
 
-@pytest.mark.parametrize(
-    "method",
-    [
-        NO_COMPRESSION_64,
-        NO_COMPRESSION_32,
-    ],
-)
-def test_local_headers_flushed_buffered_data(method):
+
+def test_merge_zips():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(10000)
 
-    state = []
+    def files_1():
+        yield 'file-1', now, mode, ZIP_32, (contents,)
+        yield 'file-2', now, mode, ZIP_64, (contents,)
 
-    def data():
-        state.append('data')
-        yield b'-'
+    def files_2():
+        yield 'file-3', now, mode, NO_COMPRESSION_32, (contents,)
+        yield 'file-4', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (contents,)
 
-    def files():
-        state.append('file')
-        yield 'file-1', now, mode, method, data()
+    def files_3():
+        yield 'file-5', now, mode, ZIP_AUTO(len(contents)), (contents,)
 
-    for chunk in stream_zip(files()):
-        state.append('chunk')
-        if b'file-1' in chunk:
-            state.append('file-name')
+    def all_files():
+        yield from files_1()
+        yield from files_2()
+        yield from files_3()
 
-    assert state == ['file', 'data', 'chunk', 'file-name', 'chunk', 'file-name']
+    merged = b''.join(merge_zips((
+        BytesIO(b''.join(stream_zip(files_1()))),
+        BytesIO(b''.join(stream_zip(files_2()))),
+        BytesIO(b''.join(stream_zip(files_3()))),
+    ), chunk_size=1000))
 
+    assert merged == b''.join(stream_zip(all_files()))
+
+    with ZipFile(BytesIO(merged)) as zf:
+        assert [zf.read(f'file-{i}') for i in range(1, 6)] == [contents] * 5
+
+
+def test_merge_zips_from_zipfile():
+    original_1 = BytesIO()
+    with ZipFile(original_1, 'w', compression=zlib.DEFLATED) as zf:
+        zf.writestr('file-1', b'a' * 10000)
+        zf.comment = b'A comment'
+
+    original_2 = BytesIO()
+    with ZipFile(original_2, 'w') as zf:
+        zf.writestr('file-2', b'b' * 10000)
+
+    merged = b''.join(merge_zips((original_1, original_2)))
+
+    assert [(b'file-1', b'a' * 10000), (b'file-2', b'b' * 10000)] == [
+        (name, b''.join(chunks))
+        for name, size, chunks in stream_unzip((merged,))
+    ]
 
-@pytest.mark.parametrize(
-    "method",
-    [
-        ZIP_32,
-        ZIP_64,
-    ],
-)
-def test_bsdcpio(method):
-    assert method in (ZIP_32, ZIP_64)  # Paranoia check that parameterisation works
 
+def test_merge_zips_auto_upgrade():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
-    zip_bytes = b''.join(stream_zip((
-        ('file-1', now, mode, method, (b'contents',)),
+
+    def files(start, end):
+        for i in range(start, end):
+            yield f'file-{i}', now, mode, ZIP_AUTO(1), (b'a',)
+
+    merged = b''.join(merge_zips((
+        BytesIO(b''.join(stream_zip(files(0, 0xffff)))),
+        BytesIO(b''.join(stream_zip(files(0xffff, 0xffff + 1)))),
     )))
 
-    def read(path):
-        with open(path, 'rb') as f:
-            return f.read()
+    assert merged == b''.join(stream_zip(files(0, 0xffff + 1)))
 
-    bsdcpio = os.getcwd() + '/libarchive-3.5.3/bsdcpio'
-    with \
-            TemporaryDirectory() as d, \
-            cwd(d), \
-            subprocess.Popen(
-                [bsdcpio, '-i'],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            ) as p:
 
-        a = p.communicate(input=zip_bytes)
-        assert a == (b'', b'1 block\n')
-        assert p.returncode == 0
-        assert read('file-1') == b'contents'
+def test_merge_zips_invalid_zip():
+    with pytest.raises(InvalidZipError):
+        next(iter(merge_zips((BytesIO(b'not a zip'),))))
 
 
-@pytest.mark.parametrize(
-    "method",
-    [
-        ZIP_32,
-        ZIP_64,
-    ],
-)
-def test_7z_symbolic_link(method):
-    modified_at = datetime.now()
-    member_files = (
-        ('my-file-1.txt', modified_at, stat.S_IFREG | 0o600, ZIP_64, (b'Some bytes 1',)),
-        ('my-link.txt', modified_at, stat.S_IFLNK | 0o600, ZIP_64, (b'my-file-1.txt',)),
-    )
-    zipped_chunks = stream_zip(member_files)
+def test_merge_zips_large_offset():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
 
-    with \
-            TemporaryDirectory() as d, \
-            cwd(d): \
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (b'a' * 10000,)
 
-        with open('test.zip', 'wb') as fp:
-            for zipped_chunk in zipped_chunks:
-                fp.write(zipped_chunk)
+    with TemporaryDirectory() as d:
+        # A sparse file of 0xffffffff zero bytes and then an empty central directory
+        padding_path = os.path.join(d, 'padding.zip')
+        with open(padding_path, 'wb') as f:
+            f.truncate(0xffffffff)
+            f.seek(0xffffffff)
+            f.write(b'PK\x05\x06' + Struct('<HHHHIIH').pack(0, 0, 0, 0, 0, 0xffffffff, 0))
 
-        subprocess.run(['7z', 'e', 'test.zip'])
+        merged_path = os.path.join(d, 'merged.zip')
+        with open(padding_path, 'rb') as padding, open(merged_path, 'wb') as f:
+            for chunk in merge_zips((padding, BytesIO(b''.join(stream_zip(files()))))):
+                if chunk.count(0) == len(chunk):
+                    f.seek(len(chunk), os.SEEK_CUR)
+                else:
+                    f.write(chunk)
 
-        with open('my-link.txt') as f:
-            assert f.read() == 'Some bytes 1'
+        with ZipFile(merged_path) as zf:
+            assert zf.read('file-1') == b'a' * 10000
 
 
 @pytest.mark.parametrize(
-    "method",
-    [
-        ZIP_32,
-        ZIP_64,
-    ],
+    "password",
+    [None, 'my-password'],
 )
 @pytest.mark.parametrize(
-    "trailing_slash,mode,expected_mode",
-    [
-        ('', stat.S_IFDIR | 0o700, 'drwx------',),  # Documents that the mode is enough
-        ('/', stat.S_IFDIR | 0o700, 'drwx------',),
-        ('/', stat.S_IFREG | 0o700, 'drwx------',),  # Documents that trailing slash is enough
-    ],
+    "extended_timestamps",
+    [True, False],
 )
-def test_7z_empty_directory(method, trailing_slash, mode, expected_mode):
-    modified_at = datetime.now()
-    member_files = (
-        ('my-dir' + trailing_slash, modified_at, mode, method, ()),
-    )
-    zipped_chunks = stream_zip(member_files)
+def test_stream_zip_size(password, extended_timestamps):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(10000)
+    compress_obj = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    deflated = compress_obj.compress(contents) + compress_obj.flush()
 
-    with \
-            TemporaryDirectory() as d, \
-            cwd(d): \
+    existing = BytesIO(b''.join(stream_zip((
+        ('file-1', now, mode, ZIP_32, (contents,)),
+        ('file-2', now, mode, ZIP_64, (contents,)),
+    ), password='other-password')))
 
-        with open('test.zip', 'wb') as fp:
-            for zipped_chunk in zipped_chunks:
-                fp.write(zipped_chunk)
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_32(len(contents), zlib.crc32(contents)), (contents,)
+        yield 'file-2', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (contents,)
+        yield 'file-3-😀', now, mode, DEFLATED_32(len(contents), len(deflated), zlib.crc32(contents)), (deflated,)
+        yield 'file-4', now, mode, DEFLATED_64(len(contents), len(deflated), zlib.crc32(contents)), (deflated,)
+        yield 'file-5', now, mode, NO_COMPRESSION_32(0, zlib.crc32(b'')), ()
+        yield from raw_member_files(existing)
+        yield 'file-6', now, mode, NO_COMPRESSION_32(len(contents), zlib.crc32(contents)), (contents,)
 
-        subprocess.run(['7z', 'e', 'test.zip'])
+    zipped = b''.join(stream_zip(files(), extended_timestamps=extended_timestamps, password=password))
 
-        assert os.path.isdir('my-dir')
-        assert stat.filemode(os.lstat('my-dir').st_mode) == expected_mode
+    assert stream_zip_size(
+        ((name, modified_at, mode, method) for name, modified_at, mode, method, _ in files()),
+        extended_timestamps=extended_timestamps,
+        password=password,
+    ) == len(zipped)
 
 
 @pytest.mark.parametrize(
     "method",
-    [
-        ZIP_32,
-        ZIP_64,
-    ],
-)
-@pytest.mark.parametrize(
-    "trailing_slash,mode,expected_mode",
-    [
-        ('', stat.S_IFDIR | 0o700, '-rwx------'),  # Documents that unzip needs the trailing slash
-        ('/', stat.S_IFDIR | 0o700, 'drwx------'),
-        ('/', stat.S_IFREG | 0o700, 'drwx------'),  # Documents that trailing slash is enough
-    ],
+    [NO_COMPRESSION_32, NO_COMPRESSION_64],
 )
-def test_unzip_empty_directory(method, trailing_slash, mode, expected_mode):
-    modified_at = datetime.now()
-    member_files = (
-        ('my-dir' + trailing_slash, modified_at, mode, method, ()),
-    )
-    zipped_chunks = stream_zip(member_files)
+def test_stream_zip_size_only_32(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
 
-    with \
-            TemporaryDirectory() as d, \
-            cwd(d): \
+    def files():
+        yield 'file-1', now, mode, method(1, zlib.crc32(b'a')), (b'a',)
 
-        with open('test.zip', 'wb') as fp:
-            for zipped_chunk in zipped_chunks:
-                fp.write(zipped_chunk)
+    assert stream_zip_size(
+        ((name, modified_at, mode, method) for name, modified_at, mode, method, _ in files()),
+    ) == len(b''.join(stream_zip(files())))
 
-        subprocess.run(['unzip', f'{d}/test.zip', '-d', d])
 
-        assert stat.filemode(os.lstat('my-dir').st_mode) == expected_mode
+def test_stream_zip_size_auto_upgrade():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
 
+    def files():
+        for i in range(0, 0xffff + 1):
+            yield f'file-{i}', now, mode, ZIP_AUTO(1), (b'a',)
 
-@pytest.mark.parametrize(
+    existing = BytesIO(b''.join(stream_zip(files())))
+
+    assert stream_zip_size(
+        (name, modified_at, mode, method) for name, modified_at, mode, method, _ in raw_member_files(existing)
+    ) == len(b''.join(stream_zip(raw_member_files(existing))))
+
+
+@pytest.mark.parametrize(
+    "method",
+    [ZIP_32, ZIP_64, ZIP_AUTO(1), NO_COMPRESSION_32, NO_COMPRESSION_64, NO_COMPRESSION_32_TWO_PASS, NO_COMPRESSION_64_TWO_PASS, GZIPPED_32, GZIPPED_64],
+)
+def test_stream_zip_size_unknown(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    with pytest.raises(UnknownSizeError):
+        stream_zip_size((('file-1', now, mode, method),))
+
+
+@pytest.mark.parametrize(
+    "name,method,exception_class",
+    [
+        ('a' * 0x10000, NO_COMPRESSION_32(1, 0), NameLengthOverflowError),
+        ('file-1', DEFLATED_32(1, 0x100000000, 0), CompressedSizeOverflowError),
+    ],
+)
+def test_stream_zip_size_overflow(name, method, exception_class):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    with pytest.raises(exception_class):
+        stream_zip_size(((name, now, mode, method),))
+
+
+@pytest.mark.parametrize(
+    "extended_timestamps",
+    [True, False],
+)
+def test_stream_zip_range(extended_timestamps):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(10000)
+    compress_obj = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    deflated = compress_obj.compress(contents) + compress_obj.flush()
+
+    existing = BytesIO(b''.join(stream_zip((
+        ('file-1', now, mode, ZIP_32, (contents,)),
+    ))))
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_32(len(contents), zlib.crc32(contents)), contents
+        yield 'file-2', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), contents
+        yield 'file-3', now, mode, DEFLATED_32(len(contents), len(deflated), zlib.crc32(contents)), deflated
+        yield 'file-4', now, mode, DEFLATED_64(len(contents), len(deflated), zlib.crc32(contents)), deflated
+        yield 'file-5', now, mode, NO_COMPRESSION_32(0, zlib.crc32(b'')), b''
+        for name, modified_at, copied_mode, method, chunks in raw_member_files(existing):
+            yield 'copied-' + name, modified_at, copied_mode, method, b''.join(chunks)
+
+    zipped = b''.join(stream_zip(
+        ((name, modified_at, mode, method, (data,)) for name, modified_at, mode, method, data in files()),
+        extended_timestamps=extended_timestamps,
+    ))
+
+    requested_offsets = []
+    def ranged_files():
+        for name, modified_at, mode, method, data in files():
+            def get_chunks(offset, data=data):
+                requested_offsets.append(offset)
+                for i in range(offset, len(data), 1000):
+                    yield data[i:i + 1000]
+            yield name, modified_at, mode, method, get_chunks
+
+    for start, end in [(0, None), (0, 10), (10, 20000), (20000, 40001), (len(zipped) - 30, None), (len(zipped) - 30, len(zipped) + 10), (len(zipped), None), (len(zipped) + 10, None), (100, 50), (100, 100)]:
+        assert b''.join(stream_zip_range(ranged_files(), start, end, chunk_size=1000, extended_timestamps=extended_timestamps)) == zipped[start:end]
+
+    requested_offsets.clear()
+    assert b''.join(stream_zip_range(ranged_files(), len(zipped) - 30, extended_timestamps=extended_timestamps)) == zipped[-30:]
+    assert requested_offsets == []
+
+    requested_offsets.clear()
+    start = zipped.index(contents[12000:13000])
+    assert b''.join(stream_zip_range(ranged_files(), start, start + 10, extended_timestamps=extended_timestamps)) == contents[12000:12010]
+    assert requested_offsets == [12000]
+
+    # Every start and end at or either side of a boundary between headers and data
+    boundaries = sorted({0, len(zipped)} | {zipped.index(contents), zipped.index(deflated)} | {zipped.index(contents) + len(contents), zipped.index(deflated) + len(deflated)})
+    for start in (offset + delta for offset in boundaries for delta in (-1, 0, 1)):
+        for end in (offset + delta for offset in boundaries for delta in (-1, 0, 1)):
+            if 0 <= start:
+                assert b''.join(stream_zip_range(ranged_files(), start, end, extended_timestamps=extended_timestamps)) == zipped[start:max(start, end)]
+
+
+def test_stream_zip_range_data_too_short():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_32(2, zlib.crc32(b'ab')), lambda offset: (b'a'[offset:],)
+
+    with pytest.raises(UncompressedSizeIntegrityError):
+        b''.join(stream_zip_range(files(), 0))
+
+
+@pytest.mark.parametrize(
+    "method",
+    [ZIP_32, ZIP_64, ZIP_AUTO(1), NO_COMPRESSION_32, NO_COMPRESSION_64, NO_COMPRESSION_32_TWO_PASS, NO_COMPRESSION_64_TWO_PASS, GZIPPED_32, GZIPPED_64],
+)
+def test_stream_zip_range_unknown_size(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    with pytest.raises(UnknownSizeError):
+        b''.join(stream_zip_range((('file-1', now, mode, method, lambda offset: (b'a',)),), 0))
+
+
+class FakeMultipartStore():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.parts = {}
+        self.thread_ids = set()
+
+    def upload_part(self, part_number, chunks):
+        data = b''.join(chunks)
+        with self.lock:
+            assert part_number not in self.parts
+            self.parts[part_number] = data
+            self.thread_ids.add(threading.get_ident())
+        return f'etag-{part_number}'
+
+    def complete(self):
+        assert sorted(self.parts) == list(range(1, len(self.parts) + 1))
+        return b''.join(self.parts[part_number] for part_number in sorted(self.parts))
+
+
+@pytest.mark.parametrize(
+    "part_size",
+    [97, 1000, 10001, 1000000],
+)
+def test_stream_zip_parts(part_size):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(10000)
+    compress_obj = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    deflated = compress_obj.compress(contents) + compress_obj.flush()
+
+    def get_files():
+        yield 'file-1', now, mode, NO_COMPRESSION_32(len(contents), zlib.crc32(contents)), lambda offset: (contents[offset:],)
+        yield 'file-2', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), lambda offset: (contents[offset:],)
+        yield 'file-3', now, mode, DEFLATED_64(len(contents), len(deflated), zlib.crc32(contents)), lambda offset: (deflated[offset:],)
+
+    zipped = b''.join(stream_zip(
+        (name, modified_at, mode, method, get_chunks(0)) for name, modified_at, mode, method, get_chunks in get_files()
+    ))
+
+    store = FakeMultipartStore()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        etags = stream_zip_parts(get_files, part_size, store.upload_part, executor=executor)
+
+    assert store.complete() == zipped
+    assert etags == [f'etag-{i}' for i in range(1, len(store.parts) + 1)]
+    assert all(len(store.parts[i]) == part_size for i in range(1, len(store.parts)))
+
+
+def test_stream_zip_parts_default_executor():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def get_files():
+        yield 'file-1', now, mode, NO_COMPRESSION_32(10000, zlib.crc32(b'a' * 10000)), lambda offset: (b'a' * (10000 - offset),)
+
+    store = FakeMultipartStore()
+    stream_zip_parts(get_files, 1000, store.upload_part)
+
+    assert store.complete() == b''.join(stream_zip(
+        (name, modified_at, mode, method, get_chunks(0)) for name, modified_at, mode, method, get_chunks in get_files()
+    ))
+
+
+def test_stream_zip_parts_lays_out_once():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 100
+
+    get_files_calls = []
+    requested = []
+
+    def get_files():
+        get_files_calls.append(1)
+        for i in range(2000):
+            def get_chunks(offset, i=i):
+                requested.append(i)
+                return (contents[offset:],)
+            yield f'file-{i}', now, mode, NO_COMPRESSION_32(len(contents), zlib.crc32(contents)), get_chunks
+
+    store = FakeMultipartStore()
+    stream_zip_parts(get_files, 2000, store.upload_part)
+
+    assert len(get_files_calls) == 1
+
+    # The data of each member is requested once, or once for each part if split between two
+    assert sorted(set(requested)) == list(range(2000))
+    assert len(requested) < 2 * 2000
+
+    assert store.complete() == b''.join(stream_zip(
+        (name, modified_at, mode, method, get_chunks(0)) for name, modified_at, mode, method, get_chunks in get_files()
+    ))
+
+
+def test_stream_zip_parts_exception():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def get_files():
+        yield 'file-1', now, mode, NO_COMPRESSION_32(10000, zlib.crc32(b'a' * 10000)), lambda offset: (b'a' * (10000 - offset),)
+
+    def upload_part(part_number, chunks):
+        if part_number == 2:
+            raise Exception('Failed')
+
+    with pytest.raises(Exception, match='Failed'):
+        stream_zip_parts(get_files, 1000, upload_part)
+
+
+@pytest.mark.parametrize(
+    "password",
+    [None, 'my-password'],
+)
+def test_stream_zip_to_seekable(password):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(10000)
+
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (contents,)
+        yield 'file-2', now, mode, ZIP_64, (contents,)
+        yield 'file-3', now, mode, NO_COMPRESSION_32, (contents,)
+        yield 'file-4', now, mode, NO_COMPRESSION_64, (contents,)
+        yield 'file-5', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (contents,)
+        yield 'file-6', now, mode, ZIP_AUTO(len(contents)), (contents,)
+        yield 'file-7', now, mode, ZIP_32, ()
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'test.zip')
+        with open(path, 'wb') as f:
+            stream_zip_to_seekable(files(), f, password=password)
+
+        with open(path, 'rb') as f:
+            zipped = f.read()
+
+        assert len(zipped) < len(b''.join(stream_zip(files(), password=password)))
+        assert b'PK\x07\x08' not in zipped
+
+        assert [(f'file-{i}'.encode(), contents) for i in range(1, 7)] + [(b'file-7', b'')] == [
+            (name, b''.join(chunks))
+            for name, size, chunks in stream_unzip((zipped,), password=password)
+        ]
+
+        with pyzipper.AESZipFile(path) as zf:
+            if password is not None:
+                zf.setpassword(password.encode())
+            assert zf.testzip() is None
+            assert [zf.read(f'file-{i}') for i in range(1, 8)] == [contents] * 6 + [b'']
+
+
+def test_stream_zip_to_seekable_after_existing_data():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (b'a' * 10000,)
+        yield 'file-2', now, mode, NO_COMPRESSION_32, (b'b' * 10000,)
+
+    f = BytesIO()
+    f.write(b'-' * 1000)
+    stream_zip_to_seekable(files(), f)
+
+    with ZipFile(f) as zf:
+        assert zf.testzip() is None
+        assert zf.read('file-1') == b'a' * 10000
+        assert zf.read('file-2') == b'b' * 10000
+
+
+def test_stream_zip_to_seekable_does_not_buffer():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def data():
+        for i in range(0, 512):
+            yield bytes(65536)
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64, data()
+
+    class CountingFile(BytesIO):
+        size = 0
+        def write(self, chunk):
+            self.size = max(self.size, self.tell() + len(chunk))
+            self.seek(len(chunk), os.SEEK_CUR)
+            return len(chunk)
+
+    f = CountingFile()
+    tracemalloc.start()
+    try:
+        stream_zip_to_seekable(files(), f)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert f.size > 33554432
+    assert peak < 8388608
+
+
+def test_stream_zip_to_fd():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(10000)
+    big_contents = os.urandom(3000000)
+
+    def files():
+        for i in range(0, 2000):
+            yield f'file-{i}', now, mode, ZIP_32, (contents[:i * 10],)
+        yield 'file-big', now, mode, NO_COMPRESSION_64, (big_contents,)
+
+    def get_crypto_random(num_bytes):
+        return b'-' * num_bytes
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'test.zip')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+        try:
+            stream_zip_to_fd(files(), fd, password='my-password', get_crypto_random=get_crypto_random)
+        finally:
+            os.close(fd)
+
+        with open(path, 'rb') as f:
+            assert f.read() == b''.join(stream_zip(files(), password='my-password', get_crypto_random=get_crypto_random))
+
+
+def test_stream_zip_to_fd_size():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = os.urandom(100000)
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (contents,)
+
+    size = stream_zip_size((name, modified_at, mode, method) for name, modified_at, mode, method, _ in files())
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'test.zip')
+        with open(path, 'wb') as f:
+            stream_zip_to_fd(files(), f.fileno(), size=size)
+
+        with open(path, 'rb') as f:
+            assert f.read() == b''.join(stream_zip(files()))
+
+
+def test_stream_zip_to_fd_size_larger_than_zip_truncates():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = os.urandom(1000)
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (contents,)
+
+    size = stream_zip_size((name, modified_at, mode, method) for name, modified_at, mode, method, _ in files())
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'test.zip')
+        with open(path, 'wb') as f:
+            stream_zip_to_fd(files(), f.fileno(), size=size + 100)
+
+        with open(path, 'rb') as f:
+            assert f.read() == b''.join(stream_zip(files()))
+
+
+@pytest.mark.parametrize(
+    "size_delta",
+    [None, 0, 100],
+)
+def test_stream_zip_to_fd_keeps_existing_data(size_delta):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = os.urandom(1000)
+    existing = os.urandom(5000)
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (contents,)
+
+    size = None if size_delta is None else \
+        stream_zip_size((name, modified_at, mode, method) for name, modified_at, mode, method, _ in files()) + size_delta
+    zipped = b''.join(stream_zip(files()))
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'test.zip')
+        with open(path, 'wb') as f:
+            f.write(b'before' + existing)
+        with open(path, 'r+b') as f:
+            f.seek(6)
+            stream_zip_to_fd(files(), f.fileno(), size=size)
+
+        with open(path, 'rb') as f:
+            assert f.read() == b'before' + zipped + existing[len(zipped):]
+
+
+def test_stream_zip_to_fd_exception_truncates():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def data():
+        yield b'a' * 10000
+        raise Exception('Failed')
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64(20000, 0), data()
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'test.zip')
+        with open(path, 'wb') as f:
+            with pytest.raises(Exception, match='Failed'):
+                stream_zip_to_fd(files(), f.fileno(), size=1000000)
+
+        assert os.path.getsize(path) < 1000000
+
+
+def test_stream_zip_to_fd_pipe():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = os.urandom(1000000)
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64, (contents,) * 5
+        yield 'file-2', now, mode, ZIP_64, (contents,)
+
+    read_fd, write_fd = os.pipe()
+    read = []
+    def reader():
+        with os.fdopen(read_fd, 'rb') as f:
+            read.append(f.read())
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.start()
+    try:
+        stream_zip_to_fd(files(), write_fd)
+    finally:
+        os.close(write_fd)
+        reader_thread.join()
+
+    assert [(b'file-1', contents * 5), (b'file-2', contents)] == [
+        (name, b''.join(chunks))
+        for name, size, chunks in stream_unzip(read)
+    ]
+
+
+def test_stream_zip_to_fileobj():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (b'a' * 10000,)
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'test.zip')
+        with open(path, 'wb') as f:
+            f.write(b'before')
+            stream_zip_to_fileobj(files(), f)
+            f.write(b'after')
+
+        with open(path, 'rb') as f:
+            assert f.read() == b'before' + b''.join(stream_zip(files())) + b'after'
+
+
+@pytest.mark.parametrize(
+    "method",
+    [NO_COMPRESSION_32, NO_COMPRESSION_64],
+)
+@pytest.mark.parametrize(
+    "verify_crc_32",
+    [False, True],
+)
+def test_stream_zip_to_fd_copies_local_files(method, verify_crc_32, monkeypatch):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = os.urandom(3000000)
+
+    num_copies = 0
+    for name in ('copy_file_range', 'sendfile'):
+        if hasattr(os, name):
+            def counted(*args, original=getattr(os, name)):
+                nonlocal num_copies
+                num_copies += 1
+                return original(*args)
+            monkeypatch.setattr(os, name, counted)
+
+    with TemporaryDirectory() as d:
+        paths = [os.path.join(d, f'file-{i}.bin') for i in range(0, 3)]
+        for i, path in enumerate(paths):
+            with open(path, 'wb') as f:
+                f.write(contents[:i * 1000000])
+            os.utime(path, (1609535472, 1609535472))
+
+        cache = CRC32Cache()
+        def files():
+            yield 'file-0', now, mode, ZIP_32, (b'a' * 10000,)
+            for path in paths:
+                yield stored_member_file(path, cache, method=method)
+
+        zip_path = os.path.join(d, 'test.zip')
+        with open(zip_path, 'wb') as f:
+            stream_zip_to_fd(files(), f.fileno(), verify_crc_32=verify_crc_32)
+
+        with open(zip_path, 'rb') as f:
+            assert f.read() == b''.join(stream_zip(files()))
+
+        read_fd, write_fd = os.pipe()
+        read = []
+        def reader():
+            with os.fdopen(read_fd, 'rb') as f:
+                read.append(f.read())
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.start()
+        try:
+            stream_zip_to_fd(files(), write_fd, verify_crc_32=verify_crc_32)
+        finally:
+            os.close(write_fd)
+            reader_thread.join()
+
+        assert read == [b''.join(stream_zip(files()))]
+
+    if hasattr(os, 'copy_file_range') or hasattr(os, 'sendfile'):
+        assert num_copies >= 4
+
+
+def test_stream_zip_to_fd_copies_local_files_fallback(monkeypatch):
+    contents = os.urandom(100000)
+
+    def fail(*args):
+        raise OSError(errno.EXDEV, 'Cross-device link')
+    for name in ('copy_file_range', 'sendfile'):
+        if hasattr(os, name):
+            monkeypatch.setattr(os, name, fail)
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'file-1.bin')
+        with open(path, 'wb') as f:
+            f.write(contents)
+        member_file = stored_member_file(path, CRC32Cache())
+
+        zip_path = os.path.join(d, 'test.zip')
+        with open(zip_path, 'wb') as f:
+            stream_zip_to_fd((member_file,), f.fileno())
+
+        with open(zip_path, 'rb') as f:
+            assert [(b'file-1.bin', contents)] == [
+                (name, b''.join(chunks))
+                for name, size, chunks in stream_unzip((f.read(),))
+            ]
+
+
+def test_stream_zip_to_fd_local_file_changed():
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'file-1.bin')
+        with open(path, 'wb') as f:
+            f.write(b'a' * 10000)
+        member_file = stored_member_file(path, CRC32Cache())
+        zip_path = os.path.join(d, 'test.zip')
+
+        with open(path, 'wb') as f:
+            f.write(b'b' * 10000)
+
+        with open(zip_path, 'wb') as f:
+            with pytest.raises(CRC32IntegrityError):
+                stream_zip_to_fd((member_file,), f.fileno(), verify_crc_32=True)
+
+        with open(path, 'wb') as f:
+            f.write(b'b' * 10001)
+
+        with open(zip_path, 'wb') as f:
+            with pytest.raises(UncompressedSizeIntegrityError):
+                stream_zip_to_fd((member_file,), f.fileno())
+
+
+def test_stream_zip_to_fd_local_file_with_password():
+    def get_crypto_random(num_bytes):
+        return b'-' * num_bytes
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'file-1.bin')
+        with open(path, 'wb') as f:
+            f.write(b'a' * 10000)
+        cache = CRC32Cache()
+
+        zip_path = os.path.join(d, 'test.zip')
+        with open(zip_path, 'wb') as f:
+            stream_zip_to_fd((stored_member_file(path, cache),), f.fileno(), password='my-password', get_crypto_random=get_crypto_random)
+
+        with open(zip_path, 'rb') as f:
+            assert f.read() == b''.join(stream_zip((stored_member_file(path, cache),), password='my-password', get_crypto_random=get_crypto_random))
+
+
+@pytest.mark.parametrize(
+    "buffer_size",
+    [1, 7, 65536, 1000000],
+)
+def test_stream_zip_reader(buffer_size):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(10000)
+
+    def get_crypto_random(num_bytes):
+        return b'-' * num_bytes
+
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (contents,)
+        yield 'file-2', now, mode, ZIP_64, (contents,) * 3
+        yield 'file-3', now, mode, NO_COMPRESSION_32, (contents,)
+        yield 'file-4', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (contents,)
+        yield 'file-5', now, mode, ZIP_32, ()
+
+    zipped = b''.join(stream_zip(files(), password='my-password', get_crypto_random=get_crypto_random))
+
+    read = bytearray()
+    buffer = bytearray(buffer_size)
+    with StreamZipReader(files(), password='my-password', get_crypto_random=get_crypto_random) as reader:
+        while True:
+            num_read = reader.readinto(buffer)
+            if not num_read:
+                break
+            read += buffer[:num_read]
+
+    assert read == zipped
+
+
+def test_stream_zip_reader_file_apis():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 10000 + os.urandom(100000)
+
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (contents,)
+        yield 'file-2', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (contents,)
+
+    zipped = b''.join(stream_zip(files()))
+
+    assert StreamZipReader(files()).read() == zipped
+    assert io.BufferedReader(StreamZipReader(files())).read() == zipped
+
+    f = BytesIO()
+    shutil.copyfileobj(StreamZipReader(files()), f)
+    assert f.getvalue() == zipped
+
+
+def test_stream_zip_reader_close():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    closed = False
+
+    def data():
+        nonlocal closed
+        try:
+            yield b'a' * 10000
+            yield b'b' * 10000
+        finally:
+            closed = True
+
+    reader = StreamZipReader((('file-1', now, mode, NO_COMPRESSION_64(20000, zlib.crc32(b'a' * 10000 + b'b' * 10000)), data()),))
+    reader.read(100)
+    reader.close()
+
+    assert closed
+    assert reader.closed
+
+
+@pytest.mark.skipif(not hasattr(tracemalloc, 'reset_peak'), reason='tracemalloc.reset_peak is only available from Python 3.9')
+def test_stream_zip_reader_allocates_less():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = [os.urandom(1048576) for _ in range(0, 8)]
+    crc_32 = zlib.crc32(b''.join(contents))
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64(8388608, crc_32), iter(contents)
+
+    # The largest temporary allocation made while producing each 64KiB of output
+    def max_allocation(read):
+        tracemalloc.start()
+        try:
+            allocations = []
+            while True:
+                current, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                if not read():
+                    break
+                _, peak = tracemalloc.get_traced_memory()
+                allocations.append(peak - current)
+        finally:
+            tracemalloc.stop()
+        return max(allocations[1:-2])
+
+    chunks = iter(stream_zip(files(), chunk_size=65536))
+    stream_zip_allocation = max_allocation(lambda: next(chunks, None))
+
+    reader = StreamZipReader(files())
+    buffer = bytearray(65536)
+    reader_allocation = max_allocation(lambda: reader.readinto(buffer))
+
+    assert stream_zip_allocation >= 65536
+    assert reader_allocation < 16384
+
+
+@pytest.mark.parametrize(
+    "password",
+    [None, 'my-password'],
+)
+@pytest.mark.parametrize(
+    "stream_zip_kwargs",
+    [{}, {'executor': 'executor', 'deflate_block_size': 65536}, {'executor': 'executor'}],
+)
+def test_reused_buffer_chunks(password, stream_zip_kwargs):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = b'a' * 100000 + os.urandom(200000)
+    compress_obj = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    deflated = compress_obj.compress(contents) + compress_obj.flush()
+    gzipped = gzip.compress(contents, mtime=0)
+
+    def get_crypto_random(num_bytes):
+        return b'-' * num_bytes
+
+    # Reads into the same buffer each time, yielding memoryviews of it
+    def reused_buffer_chunks(data, buffer_size):
+        f = BytesIO(data)
+        buffer = bytearray(buffer_size)
+        while True:
+            num_read = f.readinto(buffer)
+            if not num_read:
+                break
+            yield memoryview(buffer)[:num_read]
+
+    def bytes_chunks(data, buffer_size):
+        for i in range(0, len(data), buffer_size):
+            yield data[i:i + buffer_size]
+
+    def files(get_chunks):
+        for buffer_size in (1000, 65536, 100001):
+            yield 'file-1', now, mode, ZIP_32, get_chunks(contents, buffer_size)
+            yield 'file-2', now, mode, ZIP_64, get_chunks(contents, buffer_size)
+            yield 'file-3', now, mode, NO_COMPRESSION_32, get_chunks(contents, buffer_size)
+            yield 'file-4', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), get_chunks(contents, buffer_size)
+            yield 'file-5', now, mode, DEFLATED_64(len(contents), len(deflated), zlib.crc32(contents)), get_chunks(deflated, buffer_size)
+            yield 'file-6', now, mode, GZIPPED_32, get_chunks(gzipped, buffer_size)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        kwargs = {
+            key: executor if value == 'executor' else value
+            for key, value in stream_zip_kwargs.items()
+        }
+        expected = b''.join(stream_zip(files(bytes_chunks), password=password, get_crypto_random=get_crypto_random, **kwargs))
+
+        assert b''.join(stream_zip(files(reused_buffer_chunks), password=password, get_crypto_random=get_crypto_random, **kwargs)) == expected
+        assert list(stream_zip(files(reused_buffer_chunks), password=password, get_crypto_random=get_crypto_random, **kwargs)) \
+            == list(stream_zip(files(bytes_chunks), password=password, get_crypto_random=get_crypto_random, **kwargs))
+        assert StreamZipReader(files(reused_buffer_chunks), password=password, get_crypto_random=get_crypto_random, **kwargs).read() == expected
+
+        with TemporaryDirectory() as d:
+            path = os.path.join(d, 'test.zip')
+            with open(path, 'wb') as f:
+                stream_zip_to_fd(files(reused_buffer_chunks), f.fileno(), password=password, get_crypto_random=get_crypto_random, **kwargs)
+            with open(path, 'rb') as f:
+                assert f.read() == expected
+
+
+def test_mmap_chunks():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents = os.urandom(1000000)
+
+    with TemporaryDirectory() as d:
+        path = os.path.join(d, 'file-1.bin')
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            def files():
+                view = memoryview(m)
+                try:
+                    yield 'file-1', now, mode, NO_COMPRESSION_64(len(contents), zlib.crc32(contents)), (view[:300000], view[300000:])
+                    yield 'file-2', now, mode, ZIP_64, (view,)
+                finally:
+                    view.release()
+
+            zipped = b''.join(stream_zip(files()))
+
+    assert [(b'file-1', contents), (b'file-2', contents)] == [
+        (name, b''.join(chunks))
+        for name, size, chunks in stream_unzip((zipped,))
+    ]
+
+
+def test_directory_zipfile():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
+        yield 'file-2/', now, mode, ZIP_64, ()
+
+    def extracted():
+        with ZipFile(BytesIO(b''.join(stream_zip(files())))) as my_zip:
+            for my_info in my_zip.infolist():
+                with my_zip.open(my_info.filename) as my_file:
+                    yield (
+                        my_info.filename,
+                        my_info.file_size,
+                        my_info.date_time,
+                        my_info.external_attr,
+                        my_file.read(),
+                    )
+
+    assert [(
+        'file-1',
+        20000,
+        (2021, 1, 1, 21, 1, 12),
+        mode << 16,
+        b'a' * 10000 + b'b' * 10000,
+    ), (
+        'file-2/',
+        0,
+        (2021, 1, 1, 21, 1, 12),
+        mode << 16 | 0x10,
+        b'',
+    )] == list(extracted())
+
+
+def test_with_unzip_zip64():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
+        yield 'file-2', now, mode, ZIP_64, (b'c', b'd')
+
+    def extracted():
+        with TemporaryDirectory() as d:
+            with open(f'{d}/my.zip', 'wb') as f:
+                f.write(b''.join(stream_zip(files())))
+            subprocess.run(['unzip', f'{d}/my.zip', '-d', d])
+
+            with open(f'{d}/file-1', 'rb') as f:
+                yield 'file-1', f.read()
+
+            with open(f'{d}/file-2', 'rb') as f:
+                yield 'file-2', f.read()
+
+    assert [(
+        'file-1',
+        b'a' * 10000 + b'b' * 10000,
+    ), (
+        'file-2',
+        b'cd',
+    )] == list(extracted())
+
+
+def test_with_unzip_zip_32_and_zip_64():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
+        yield 'file-2', now, mode, ZIP_32, (b'c', b'd')
+
+    def extracted():
+        with TemporaryDirectory() as d:
+            with open(f'{d}/my.zip', 'wb') as f:
+                f.write(b''.join(stream_zip(files())))
+            subprocess.run(['unzip', f'{d}/my.zip', '-d', d])
+
+            with open(f'{d}/file-1', 'rb') as f:
+                yield 'file-1', f.read()
+
+            with open(f'{d}/file-2', 'rb') as f:
+                yield 'file-2', f.read()
+
+    assert [(
+        'file-1',
+        b'a' * 10000 + b'b' * 10000,
+    ), (
+        'file-2',
+        b'cd',
+    )] == list(extracted())
+
+
+def test_with_unzip_with_no_compression_32():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_32, (b'a' * 10000, b'b' * 10000)
+        yield 'file-2', now, mode, NO_COMPRESSION_32, (b'c', b'd')
+
+    def extracted():
+        with TemporaryDirectory() as d:
+            with open(f'{d}/my.zip', 'wb') as f:
+                f.write(b''.join(stream_zip(files())))
+            subprocess.run(['unzip', f'{d}/my.zip', '-d', d])
+
+            with open(f'{d}/file-1', 'rb') as f:
+                yield 'file-1', f.read()
+
+            with open(f'{d}/file-2', 'rb') as f:
+                yield 'file-2', f.read()
+
+    assert [(
+        'file-1',
+        b'a' * 10000 + b'b' * 10000,
+    ), (
+        'file-2',
+        b'cd',
+    )] == list(extracted())
+
+
+def test_name_length_overflow():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield '-' * (2**16), now, mode, ZIP_64, (b'ab',)
+
+    with pytest.raises(NameLengthOverflowError):
+        for chunk in stream_zip(files()):
+            pass
+
+
+def test_exception_propagates():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
+        raise Exception('From generator')
+
+    with pytest.raises(Exception,  match='From generator'):
+        for chunk in stream_zip(files()):
+            pass
+
+
+def test_exception_from_bytes_propagates():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def data():
+        yield b'-'
+        raise Exception('From generator')
+
+    def files():
+        yield 'file-1', now, mode, ZIP_64, data()
+
+    with pytest.raises(Exception,  match='From generator'):
+        for chunk in stream_zip(files()):
+            pass
+
+
+def test_chunk_sizes():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, ZIP_64, (os.urandom(500000),)
+
+    def get_sizes():
+        for chunk in stream_zip(files()):
+            yield len(chunk)
+
+    sizes = list(get_sizes())
+    assert sizes[0] == 65
+    assert set(sizes[1:-1]) == {65536}
+    assert sizes[-1] <= 65536
+
+
+def test_chunk_size_same_as_local_header():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def files():
+        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000,)
+
+    assert [(b'file-1', None, b'a' * 10000)] == [
+        (name, size, b''.join(chunks))
+        for name, size, chunks in stream_unzip(stream_zip(files(), chunk_size=65))
+    ]
+
+
+def test_chunk_of_chunk_size_not_copied():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    chunk = os.urandom(65536)
+
+    def files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64(len(chunk) * 2, zlib.crc32(chunk * 2)), (chunk, chunk)
+
+    assert [c for c in stream_zip(files()) if c is chunk] == [chunk, chunk]
+
+
+
+def test_central_directory_memory_per_member_near_size_on_disk():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    num_members = 10000
+
+    def files():
+        for i in range(0, num_members):
+            yield f'file-{i:08d}', now, mode, NO_COMPRESSION_32(0, 0), ()
+
+    tracemalloc.start()
+    try:
+        for chunk in stream_zip(files()):
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # Each central directory record is 75 bytes on disk
+    assert peak / num_members < 120
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+        NO_COMPRESSION_64(1, 2547889144),
+        NO_COMPRESSION_32(1, 2547889144),
+    ],
+)
+def test_local_headers_flushed(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    state = []
+
+    def data():
+        state.append('data')
+        yield b'-'
+
+    def files():
+        state.append('file')
+        yield 'file-1', now, mode, method, data()
+
+    for chunk in stream_zip(files()):
+        state.append('chunk')
+        if b'file-1' in chunk:
+            state.append('file-name')
+
+    assert state == ['file', 'chunk', 'file-name', 'data', 'chunk', 'file-name']
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_32,
+    ],
+)
+def test_local_headers_flushed_buffered_data(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    state = []
+
+    def data():
+        state.append('data')
+        yield b'-'
+
+    def files():
+        state.append('file')
+        yield 'file-1', now, mode, method, data()
+
+    for chunk in stream_zip(files()):
+        state.append('chunk')
+        if b'file-1' in chunk:
+            state.append('file-name')
+
+    assert state == ['file', 'data', 'chunk', 'file-name', 'chunk', 'file-name']
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+    ],
+)
+def test_bsdcpio(method):
+    assert method in (ZIP_32, ZIP_64)  # Paranoia check that parameterisation works
+
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    zip_bytes = b''.join(stream_zip((
+        ('file-1', now, mode, method, (b'contents',)),
+    )))
+
+    def read(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    bsdcpio = os.getcwd() + '/libarchive-3.5.3/bsdcpio'
+    with \
+            TemporaryDirectory() as d, \
+            cwd(d), \
+            subprocess.Popen(
+                [bsdcpio, '-i'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            ) as p:
+
+        a = p.communicate(input=zip_bytes)
+        assert a == (b'', b'1 block\n')
+        assert p.returncode == 0
+        assert read('file-1') == b'contents'
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+    ],
+)
+def test_7z_symbolic_link(method):
+    modified_at = datetime.now()
+    member_files = (
+        ('my-file-1.txt', modified_at, stat.S_IFREG | 0o600, ZIP_64, (b'Some bytes 1',)),
+        ('my-link.txt', modified_at, stat.S_IFLNK | 0o600, ZIP_64, (b'my-file-1.txt',)),
+    )
+    zipped_chunks = stream_zip(member_files)
+
+    with \
+            TemporaryDirectory() as d, \
+            cwd(d): \
+
+        with open('test.zip', 'wb') as fp:
+            for zipped_chunk in zipped_chunks:
+                fp.write(zipped_chunk)
+
+        subprocess.run(['7z', 'e', 'test.zip'])
+
+        with open('my-link.txt') as f:
+            assert f.read() == 'Some bytes 1'
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+    ],
+)
+@pytest.mark.parametrize(
+    "trailing_slash,mode,expected_mode",
+    [
+        ('', stat.S_IFDIR | 0o700, 'drwx------',),  # Documents that the mode is enough
+        ('/', stat.S_IFDIR | 0o700, 'drwx------',),
+        ('/', stat.S_IFREG | 0o700, 'drwx------',),  # Documents that trailing slash is enough
+    ],
+)
+def test_7z_empty_directory(method, trailing_slash, mode, expected_mode):
+    modified_at = datetime.now()
+    member_files = (
+        ('my-dir' + trailing_slash, modified_at, mode, method, ()),
+    )
+    zipped_chunks = stream_zip(member_files)
+
+    with \
+            TemporaryDirectory() as d, \
+            cwd(d): \
+
+        with open('test.zip', 'wb') as fp:
+            for zipped_chunk in zipped_chunks:
+                fp.write(zipped_chunk)
+
+        subprocess.run(['7z', 'e', 'test.zip'])
+
+        assert os.path.isdir('my-dir')
+        assert stat.filemode(os.lstat('my-dir').st_mode) == expected_mode
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+    ],
+)
+@pytest.mark.parametrize(
+    "trailing_slash,mode,expected_mode",
+    [
+        ('', stat.S_IFDIR | 0o700, '-rwx------'),  # Documents that unzip needs the trailing slash
+        ('/', stat.S_IFDIR | 0o700, 'drwx------'),
+        ('/', stat.S_IFREG | 0o700, 'drwx------'),  # Documents that trailing slash is enough
+    ],
+)
+def test_unzip_empty_directory(method, trailing_slash, mode, expected_mode):
+    modified_at = datetime.now()
+    member_files = (
+        ('my-dir' + trailing_slash, modified_at, mode, method, ()),
+    )
+    zipped_chunks = stream_zip(member_files)
+
+    with \
+            TemporaryDirectory() as d, \
+            cwd(d): \
+
+        with open('test.zip', 'wb') as fp:
+            for zipped_chunk in zipped_chunks:
+                fp.write(zipped_chunk)
+
+        subprocess.run(['unzip', f'{d}/test.zip', '-d', d])
+
+        assert stat.filemode(os.lstat('my-dir').st_mode) == expected_mode
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+    ],
+)
+@pytest.mark.parametrize(
+    "trailing_slash,mode,is_dir",
+    [
+        ('', stat.S_IFDIR | 0o700, False),  # Documents that zipfile needs the trailing slash
+        ('/', stat.S_IFDIR | 0o700, True),
+        ('/', stat.S_IFREG | 0o700, True),  # Documents that trailing slash is enough
+    ],
+)
+def test_zipfile_empty_directory(method, trailing_slash, mode, is_dir):
+    modified_at = datetime.now()
+    member_files = (
+        ('my-dir' + trailing_slash, modified_at, stat.S_IFDIR | 0o700, method, ()),
+    )
+    zipped_chunks = stream_zip(member_files)
+
+    def extracted():
+        with ZipFile(BytesIO(b''.join(zipped_chunks))) as my_zip:
+            for my_info in my_zip.infolist():
+                with my_zip.open(my_info.filename) as my_file:
+                    yield (
+                        my_info.filename,
+                        my_info.is_dir(),
+                    )
+
+    assert [('my-dir' + trailing_slash, is_dir)] == list(extracted())
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+    ],
+)
+@pytest.mark.parametrize(
+    "trailing_slash,mode,expected_mode",
+    [
+        ('', stat.S_IFDIR | 0o700, '-rw-rw-r--'),  # Documents that bsdcpio needs the trailing slash and doesn't preserve perms
+        ('/', stat.S_IFDIR | 0o700, 'drwxrwxr-x'),  # Documents that bsdcpio doesn't preserve perms
+        ('/', stat.S_IFREG | 0o700, 'drwxrwxr-x'),  # Documents that trailing slash is enough and doesn't preserve perms
+    ],
+)
+def test_bsdio_empty_directory(method, trailing_slash, mode, expected_mode):
+    modified_at = datetime.now()
+    member_files = (
+        ('my-dir' + trailing_slash, modified_at, mode, method, ()),
+    )
+    zip_bytes = b''.join(stream_zip(member_files))
+
+    bsdcpio = os.getcwd() + '/libarchive-3.5.3/bsdcpio'
+    with \
+            TemporaryDirectory() as d, \
+            cwd(d), \
+            subprocess.Popen(
+                [bsdcpio, '-i'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            ) as p:
+
+        a = p.communicate(input=zip_bytes)
+
+        subprocess.run([bsdcpio, f'{d}/test.zip', '-d', d])
+
+        assert stat.filemode(os.lstat('my-dir').st_mode) == expected_mode
+
+
+@pytest.mark.parametrize(
     "method",
     [
         ZIP_32,
         ZIP_64,
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_32,
     ],
 )
 @pytest.mark.parametrize(
-    "trailing_slash,mode,is_dir",
+    "modified_at,expected_time",
     [
-        ('', stat.S_IFDIR | 0o700, False),  # Documents that zipfile needs the trailing slash
-        ('/', stat.S_IFDIR | 0o700, True),
-        ('/', stat.S_IFREG | 0o700, True),  # Documents that trailing slash is enough
+        (datetime(2011, 1, 1, 1, 2, 3, 123), (2011, 1, 1, 1, 2, 2)),
+        (datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=0))), (2011, 1, 1, 1, 2, 2)),
+        (datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=1))), (2011, 1, 1, 1, 2, 2)),
+        (datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=-1))), (2011, 1, 1, 1, 2, 2)),
+        (datetime(2011, 1, 1, 1, 2, 3, 123), (2011, 1, 1, 1, 2, 2)),
+        (datetime(2011, 1, 1, 1, 2, 4, 123, tzinfo=timezone(timedelta(hours=0))), (2011, 1, 1, 1, 2, 4)),
+        (datetime(2011, 1, 1, 1, 2, 4, 123, tzinfo=timezone(timedelta(hours=1))), (2011, 1, 1, 1, 2, 4)),
+        (datetime(2011, 1, 1, 1, 2, 4, 123, tzinfo=timezone(timedelta(hours=-1))), (2011, 1, 1, 1, 2, 4)),
     ],
 )
-def test_zipfile_empty_directory(method, trailing_slash, mode, is_dir):
-    modified_at = datetime.now()
+def test_zipfile_modification_time(method, modified_at, expected_time):
     member_files = (
-        ('my-dir' + trailing_slash, modified_at, stat.S_IFDIR | 0o700, method, ()),
+        ('my_file', modified_at, stat.S_IFREG | 0o600, method, ()),
+    )
+    zipped_chunks = stream_zip(member_files)
+
+    def extracted():
+        with ZipFile(BytesIO(b''.join(zipped_chunks))) as my_zip:
+            for my_info in my_zip.infolist():
+                with my_zip.open(my_info.filename) as my_file:
+                    yield (
+                        my_info.filename,
+                        my_info.date_time,
+                    )
+
+    assert [('my_file', expected_time)] == list(extracted())
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_32,
+    ],
+)
+@pytest.mark.parametrize(
+    "timezone,modified_at",
+    [
+        ('UTC+0', datetime(2011, 1, 1, 1, 2, 3, 123)),
+        ('UTC+0', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=0)))),
+        ('UTC+0', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=1)))),
+        ('UTC+0', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=-1)))),
+        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123)),
+        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=0)))),
+        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=1)))),
+        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=-1)))),
+        ('UTC-1', datetime(2011, 1, 1, 1, 2, 3, 123)),
+        ('UTC-1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=0)))),
+        ('UTC-1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=1)))),
+        ('UTC-1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=-1)))),
+    ],
+)
+def test_unzip_modification_time(method, timezone, modified_at):
+    member_files = (
+        ('my_file', modified_at, stat.S_IFREG | 0o600, method, ()),
     )
     zipped_chunks = stream_zip(member_files)
 
-    def extracted():
-        with ZipFile(BytesIO(b''.join(zipped_chunks))) as my_zip:
-            for my_info in my_zip.infolist():
-                with my_zip.open(my_info.filename) as my_file:
-                    yield (
-                        my_info.filename,
-                        my_info.is_dir(),
-                    )
+    with \
+            TemporaryDirectory() as d, \
+            cwd(d): \
+
+        with open('test.zip', 'wb') as fp:
+            for zipped_chunk in zipped_chunks:
+                fp.write(zipped_chunk)
+
+        subprocess.run(['unzip', f'{d}/test.zip', '-d', d], env={'TZ': timezone})
+
+        assert os.path.getmtime('my_file') == int(modified_at.timestamp())
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_32,
+    ],
+)
+@pytest.mark.parametrize(
+    "timezone,modified_at,expected_modified_at",
+    [
+        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123), datetime(2011, 1, 1, 2, 2, 2, 0)),
+    ],
+)
+def test_unzip_modification_time_extended_timestamps_disabled(method, timezone, modified_at, expected_modified_at):
+    member_files = (
+        ('my_file', modified_at, stat.S_IFREG | 0o600, method, ()),
+    )
+    zipped_chunks = stream_zip(member_files, extended_timestamps=False)
+
+    with \
+            TemporaryDirectory() as d, \
+            cwd(d): \
+
+        with open('test.zip', 'wb') as fp:
+            for zipped_chunk in zipped_chunks:
+                fp.write(zipped_chunk)
+
+        subprocess.run(['unzip', f'{d}/test.zip', '-d', d], env={'TZ': timezone})
+
+        assert os.path.getmtime('my_file') == expected_modified_at.timestamp()
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_64(18, 1571107898),
+        NO_COMPRESSION_32,
+        NO_COMPRESSION_32(18, 1571107898),
+    ],
+)
+def test_password_unzips_with_stream_unzip(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    password = secrets.token_urlsafe(32)
+
+    files = (
+        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
+    )
+
+    assert b''.join(
+        chunk
+        for _, _, chunks in stream_unzip(stream_zip(files, password=password), password=password)
+        for chunk in chunks
+    ) == b'a' * 9 + b'b' * 9
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_64(18, 1571107898),
+        NO_COMPRESSION_32,
+        NO_COMPRESSION_32(18, 1571107898),
+    ],
+)
+def test_bad_password_not_unzips_with_stream_unzip(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    password = secrets.token_urlsafe(32)
+
+    files = (
+        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
+    )
+
+    with pytest.raises(IncorrectAESPasswordError):
+        list(stream_unzip(stream_zip(files, password=password), password='not'))
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_64(18, 1571107898),
+        NO_COMPRESSION_32,
+        NO_COMPRESSION_32(18, 1571107898),
+    ],
+)
+def test_password_unzips_with_7z(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    password = secrets.token_urlsafe(32)
+
+    files = (
+        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
+    )
+
+    with \
+            TemporaryDirectory() as d, \
+            cwd(d): \
+
+        with open('test.zip', 'wb') as fp:
+            for zipped_chunk in stream_zip(files, password=password):
+                fp.write(zipped_chunk)
+
+        r = subprocess.run(['7zz', '-p' + password, 'e', 'test.zip'])
+        assert r.returncode == 0
+
+        for file in files:
+            with open(file[0], 'rb') as f:
+                assert f.read() == (b'a' * 9 ) + (b'b' * 9)
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        ZIP_32,
+        ZIP_64,
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_64(18, 1571107898),
+        NO_COMPRESSION_32,
+        NO_COMPRESSION_32(18, 1571107898),
+    ],
+)
+def test_password_unzips_with_pyzipper(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    password = secrets.token_urlsafe(32)
+
+    files = (
+        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
+    )
+
+    with \
+            TemporaryDirectory() as d, \
+            cwd(d): \
+
+        with open('test.zip', 'wb') as fp:
+            for zipped_chunk in stream_zip(files, password=password):
+                fp.write(zipped_chunk)
 
-    assert [('my-dir' + trailing_slash, is_dir)] == list(extracted())
+        with pyzipper.AESZipFile('test.zip') as zf:
+            zf.setpassword(password.encode())
+            zf.testzip()
+            assert zf.read('file-1') == (b'a' * 9 ) + (b'b' * 9)
 
 
 @pytest.mark.parametrize(
@@ -1005,388 +2963,686 @@ def test_zipfile_empty_directory(method, trailing_slash, mode, is_dir):
     [
         ZIP_32,
         ZIP_64,
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_64(18, 1571107898),
+        NO_COMPRESSION_32,
+        NO_COMPRESSION_32(18, 1571107898),
     ],
 )
+def test_password_bytes_not_deterministic(method):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    password = secrets.token_urlsafe(32)
+
+    files = (
+        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
+    )
+
+    assert b''.join(stream_zip(files, password=password)) != b''.join(stream_zip(files, password=password))
+
+
 @pytest.mark.parametrize(
-    "trailing_slash,mode,expected_mode",
+    "method",
     [
-        ('', stat.S_IFDIR | 0o700, '-rw-rw-r--'),  # Documents that bsdcpio needs the trailing slash and doesn't preserve perms
-        ('/', stat.S_IFDIR | 0o700, 'drwxrwxr-x'),  # Documents that bsdcpio doesn't preserve perms
-        ('/', stat.S_IFREG | 0o700, 'drwxrwxr-x'),  # Documents that trailing slash is enough and doesn't preserve perms
+        ZIP_32,
+        ZIP_64,
+        NO_COMPRESSION_64,
+        NO_COMPRESSION_64(18, 1571107898),
+        NO_COMPRESSION_32,
+        NO_COMPRESSION_32(18, 1571107898),
     ],
 )
-def test_bsdio_empty_directory(method, trailing_slash, mode, expected_mode):
-    modified_at = datetime.now()
-    member_files = (
-        ('my-dir' + trailing_slash, modified_at, mode, method, ()),
-    )
-    zip_bytes = b''.join(stream_zip(member_files))
+def test_crc_32_not_in_file(method):
+    # AE-2 should not have the CRC_32, so we check that the CRC_32 isn't anywhere in the file. This
+    # is "too strong" as check, because it could just happen to appear in the cipher text, which
+    # would be fine. The cipher text is by default non-deterministic due to its random salt, and
+    # so this could be a flaky test and faily randomly. To make the test not flaky, we make the
+    # bytes of the file completely deterministic, by forcing the random numbers used to generate
+    # the salt to be non-random
 
-    bsdcpio = os.getcwd() + '/libarchive-3.5.3/bsdcpio'
-    with \
-            TemporaryDirectory() as d, \
-            cwd(d), \
-            subprocess.Popen(
-                [bsdcpio, '-i'],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            ) as p:
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    password = secrets.token_urlsafe(32)
 
-        a = p.communicate(input=zip_bytes)
+    files = (
+        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
+    )
+    crc_32 = Struct('<I').pack(1571107898)
 
-        subprocess.run([bsdcpio, f'{d}/test.zip', '-d', d])
+    # To make sure we've got the correct CRC_32...
+    assert crc_32 in b''.join(stream_zip(files))
 
-        assert stat.filemode(os.lstat('my-dir').st_mode) == expected_mode
+    # ... to assert on the lack of it if we're using a password
+    encrypted_bytes = b''.join(stream_zip(files, password=password, get_crypto_random=lambda num_bytes: b'-' * num_bytes))
+    assert crc_32 not in encrypted_bytes
+
+    # ... and we can just out of paranoia check check substrings of it are not in the file, in case
+    # somehow we're leaking part of it. It's not perfect, but it's probably the best we can do
+    # and will catch the most likely cases of just not enabling the logic to hide it
+    assert crc_32[0:2] not in encrypted_bytes
+    assert crc_32[1:3] not in encrypted_bytes
+    assert crc_32[2:4] not in encrypted_bytes
+    assert crc_32[0:3] not in encrypted_bytes
+    assert crc_32[1:4] not in encrypted_bytes
 
 
 @pytest.mark.parametrize(
-    "method",
+    "lookahead_bytes",
     [
-        ZIP_32,
-        ZIP_64,
-        NO_COMPRESSION_64,
-        NO_COMPRESSION_32,
+        1,
+        33554432,
     ],
 )
+def test_executor_equivalent_to_no_executor(lookahead_bytes):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    batch = os.urandom(100000)
+
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (batch,) * 10
+        yield 'file-2', now, mode, NO_COMPRESSION_32, (b'c', b'd')
+        yield 'file-3', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
+        yield 'file-4', now, mode, NO_COMPRESSION_64(2, zlib.crc32(b'cd')), (b'c', b'd')
+        yield 'file-5', now, mode, ZIP_AUTO(1000000), (batch,) * 10
+        for i in range(0, 50):
+            yield f'file-{i + 6}', now, mode, ZIP_32, (b'e' * i,)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        zipped = b''.join(stream_zip(files(), executor=executor, lookahead_members=4, lookahead_bytes=lookahead_bytes))
+
+    assert zipped == b''.join(stream_zip(files()))
+    assert [(b'file-1', None, batch * 10), (b'file-2', 2, b'cd'), (b'file-3', None, b'a' * 10000 + b'b' * 10000)] == [
+        (name, size, b''.join(chunks))
+        for name, size, chunks in stream_unzip((zipped,))
+    ][0:3]
+
+
 @pytest.mark.parametrize(
-    "modified_at,expected_time",
+    "lookahead_kwargs",
     [
-        (datetime(2011, 1, 1, 1, 2, 3, 123), (2011, 1, 1, 1, 2, 2)),
-        (datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=0))), (2011, 1, 1, 1, 2, 2)),
-        (datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=1))), (2011, 1, 1, 1, 2, 2)),
-        (datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=-1))), (2011, 1, 1, 1, 2, 2)),
-        (datetime(2011, 1, 1, 1, 2, 3, 123), (2011, 1, 1, 1, 2, 2)),
-        (datetime(2011, 1, 1, 1, 2, 4, 123, tzinfo=timezone(timedelta(hours=0))), (2011, 1, 1, 1, 2, 4)),
-        (datetime(2011, 1, 1, 1, 2, 4, 123, tzinfo=timezone(timedelta(hours=1))), (2011, 1, 1, 1, 2, 4)),
-        (datetime(2011, 1, 1, 1, 2, 4, 123, tzinfo=timezone(timedelta(hours=-1))), (2011, 1, 1, 1, 2, 4)),
+        {'lookahead_members': 0},
+        {'lookahead_bytes': 0},
+        {'lookahead_members': 0, 'lookahead_bytes': 0},
     ],
 )
-def test_zipfile_modification_time(method, modified_at, expected_time):
-    member_files = (
-        ('my_file', modified_at, stat.S_IFREG | 0o600, method, ()),
-    )
-    zipped_chunks = stream_zip(member_files)
+def test_executor_zero_lookahead(lookahead_kwargs):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
 
-    def extracted():
-        with ZipFile(BytesIO(b''.join(zipped_chunks))) as my_zip:
-            for my_info in my_zip.infolist():
-                with my_zip.open(my_info.filename) as my_file:
-                    yield (
-                        my_info.filename,
-                        my_info.date_time,
-                    )
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (b'a' * 10000,)
+        yield 'file-2', now, mode, ZIP_32, (b'b' * 10000,)
+        yield 'file-3', now, mode, ZIP_AUTO(10000), (b'c' * 10000,)
 
-    assert [('my_file', expected_time)] == list(extracted())
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        zipped = b''.join(stream_zip(files(), executor=executor, **lookahead_kwargs))
+
+    assert zipped == b''.join(stream_zip(files()))
+    with ZipFile(BytesIO(zipped)) as my_zip:
+        assert my_zip.namelist() == ['file-1', 'file-2', 'file-3']
+
+
+def test_executor_deflate_in_blocks_from_stream_unzip():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    contents_1 = os.urandom(300000)
+    contents_2 = b'b' * 300000
+
+    zipped = b''.join(stream_zip((
+        ('file-1', now, mode, ZIP_32, (contents_1,)),
+        ('file-2', now, mode, ZIP_32, (contents_2,)),
+    )))
+
+    def files():
+        for name, _, chunks in stream_unzip((zipped,)):
+            yield name.decode(), now, mode, ZIP_32, chunks
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        rezipped = b''.join(stream_zip(files(), executor=executor, deflate_block_size=65536))
+
+    assert [(b'file-1', contents_1), (b'file-2', contents_2)] == [
+        (name, b''.join(chunks))
+        for name, size, chunks in stream_unzip((rezipped,))
+    ]
+
+
+def test_executor_compresses_ahead():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    state = []
+
+    def data(i):
+        state.append(f'data-{i}')
+        yield b'-'
+
+    def files():
+        for i in range(0, 3):
+            yield f'file-{i}', now, mode, ZIP_64, data(i)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        it = iter(stream_zip(files(), executor=executor))
+        next(it)
+        executor.shutdown(wait=True)
+        assert sorted(state) == ['data-0', 'data-1', 'data-2']
+        for _ in it:
+            pass
+
+
+def test_executor_not_starting_compression():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    class NeverStartingExecutor(Executor):
+        def submit(self, fn, *args, **kwargs):
+            return Future()
+
+    def files():
+        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
+        yield 'file-2', now, mode, ZIP_32, (b'c', b'd')
+
+    assert b''.join(stream_zip(files(), executor=NeverStartingExecutor())) == b''.join(stream_zip(files()))
+
+
+def test_executor_exception_from_bytes_propagates():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def data():
+        yield b'-'
+        raise Exception('From generator')
+
+    def files():
+        yield 'file-1', now, mode, ZIP_64, (b'-',)
+        yield 'file-2', now, mode, ZIP_64, data()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(Exception,  match='From generator'):
+            for chunk in stream_zip(files(), executor=executor):
+                pass
 
 
 @pytest.mark.parametrize(
-    "method",
+    "deflate_block_size",
     [
-        ZIP_32,
-        ZIP_64,
-        NO_COMPRESSION_64,
-        NO_COMPRESSION_32,
+        7,
+        1000,
+        65536,
+        1048576,
     ],
 )
+def test_executor_deflate_in_blocks(deflate_block_size):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    batch_1 = os.urandom(100000)
+    batch_2 = b'-' * 100000 + batch_1[:1000]
+
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (batch_1, batch_2) * 2
+        yield 'file-2', now, mode, ZIP_64, (batch_2, b'', batch_1[:50]) * 2
+        yield 'file-3', now, mode, ZIP_32, ()
+        yield 'file-4', now, mode, ZIP_64, (b'a',)
+
+    submitted = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            submitted.append(fn)
+            return super().submit(fn, *args, **kwargs)
+
+    with RecordingExecutor(max_workers=4) as executor:
+        zipped = b''.join(stream_zip(files(), executor=executor, lookahead_bytes=1000000, deflate_block_size=deflate_block_size))
+
+    assert submitted
+    assert [
+        (b'file-1', None, (batch_1 + batch_2) * 2),
+        (b'file-2', None, (batch_2 + batch_1[:50]) * 2),
+        (b'file-3', None, b''),
+        (b'file-4', None, b'a'),
+    ] == [
+        (name, size, b''.join(chunks))
+        for name, size, chunks in stream_unzip((zipped,))
+    ]
+
+    with ZipFile(BytesIO(zipped)) as my_zip:
+        assert my_zip.testzip() is None
+        assert my_zip.read('file-1') == (batch_1 + batch_2) * 2
+
+
 @pytest.mark.parametrize(
-    "timezone,modified_at",
+    "deflate_block_size",
     [
-        ('UTC+0', datetime(2011, 1, 1, 1, 2, 3, 123)),
-        ('UTC+0', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=0)))),
-        ('UTC+0', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=1)))),
-        ('UTC+0', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=-1)))),
-        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123)),
-        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=0)))),
-        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=1)))),
-        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=-1)))),
-        ('UTC-1', datetime(2011, 1, 1, 1, 2, 3, 123)),
-        ('UTC-1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=0)))),
-        ('UTC-1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=1)))),
-        ('UTC-1', datetime(2011, 1, 1, 1, 2, 3, 123, tzinfo=timezone(timedelta(hours=-1)))),
+        0,
+        -1,
     ],
 )
-def test_unzip_modification_time(method, timezone, modified_at):
-    member_files = (
-        ('my_file', modified_at, stat.S_IFREG | 0o600, method, ()),
-    )
-    zipped_chunks = stream_zip(member_files)
+def test_executor_deflate_in_blocks_invalid_size(deflate_block_size):
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
 
-    with \
-            TemporaryDirectory() as d, \
-            cwd(d): \
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (b'a',)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        with pytest.raises(ValueError, match='deflate_block_size'):
+            b''.join(stream_zip(files(), executor=executor, deflate_block_size=deflate_block_size))
+
+
+def test_executor_deflate_in_blocks_not_zip_auto():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    batch = os.urandom(100000)
+
+    def files():
+        yield 'file-1', now, mode, ZIP_AUTO(1000000), (batch,) * 10
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        zipped = b''.join(stream_zip(files(), executor=executor, deflate_block_size=1000))
+
+    assert zipped == b''.join(stream_zip(files()))
+
+
+def test_executor_deflate_in_blocks_with_upcoming_zip_auto():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+    batch = os.urandom(1000000)
+
+    def files():
+        yield 'file-1', now, mode, ZIP_32, (batch,) * 4
+        yield 'file-2', now, mode, ZIP_AUTO(len(batch)), (batch,)
+        yield 'file-3', now, mode, ZIP_AUTO(len(batch)), (batch,)
+
+    # Run in a daemon thread, so a deadlock fails the test rather than hanging it
+    executor = ThreadPoolExecutor(max_workers=2)
+    zipped = []
+    thread = threading.Thread(target=lambda: zipped.append(b''.join(stream_zip(
+        files(), executor=executor, deflate_block_size=65536, lookahead_bytes=100000,
+    ))), daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive()
+    executor.shutdown()
+
+    assert [
+        (b'file-1', batch * 4),
+        (b'file-2', batch),
+        (b'file-3', batch),
+    ] == [
+        (name, b''.join(chunks))
+        for name, size, chunks in stream_unzip((zipped[0],))
+    ]
+
+
+###################################################################################################
+# Tests of sync interface: async_stream_zip
+#
+# Under the hood we know that async_stream_zip shares its internals with stream_zip, so there
+# isn't as much of a need to test everything. We have brief tests that it seems to work and
+# results in the same bytes, but otherwise focus on the riskiest parts: that exceptions don't
+# propagate, that the async version doesn't actually stream, that it runs too much or too little
+# in threads, or that context vars are not propagated properly
+
+def test_async_stream_zip_equivalent_to_stream_unzip_zip_32_and_zip_64():
+    now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
+    mode = stat.S_IFREG | 0o600
+
+    def sync_files():
+        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
+        yield 'file-2', now, mode, ZIP_32, (b'c', b'd')
+
+    async def async_files():
+        async def data_1():
+            yield b'a' * 10000
+            yield b'b' * 10000
+
+        async def data_2():
+            yield b'c'
+            yield b'd'
+
+        yield 'file-1', now, mode, ZIP_64, data_1()
+        yield 'file-2', now, mode, ZIP_32, data_2()
 
-        with open('test.zip', 'wb') as fp:
-            for zipped_chunk in zipped_chunks:
-                fp.write(zipped_chunk)
+    # Might not be performant, but good enough for the test
+    async def async_concat(chunks):
+        result = b''
+        async for chunk in chunks:
+            result += chunk
+        return result
 
-        subprocess.run(['unzip', f'{d}/test.zip', '-d', d], env={'TZ': timezone})
+    async def test():
+        assert b''.join(stream_zip(sync_files())) == await async_concat(async_stream_zip(async_files()))
 
-        assert os.path.getmtime('my_file') == int(modified_at.timestamp())
+    asyncio.get_event_loop().run_until_complete(test())
 
 
 @pytest.mark.parametrize(
-    "method",
-    [
-        ZIP_32,
-        ZIP_64,
-        NO_COMPRESSION_64,
-        NO_COMPRESSION_32,
-    ],
-)
-@pytest.mark.parametrize(
-    "timezone,modified_at,expected_modified_at",
+    "password",
     [
-        ('UTC+1', datetime(2011, 1, 1, 1, 2, 3, 123), datetime(2011, 1, 1, 2, 2, 2, 0)),
+        None,
+        'my-password',
     ],
 )
-def test_unzip_modification_time_extended_timestamps_disabled(method, timezone, modified_at, expected_modified_at):
-    member_files = (
-        ('my_file', modified_at, stat.S_IFREG | 0o600, method, ()),
-    )
-    zipped_chunks = stream_zip(member_files, extended_timestamps=False)
-
-    with \
-            TemporaryDirectory() as d, \
-            cwd(d): \
-
-        with open('test.zip', 'wb') as fp:
-            for zipped_chunk in zipped_chunks:
-                fp.write(zipped_chunk)
-
-        subprocess.run(['unzip', f'{d}/test.zip', '-d', d], env={'TZ': timezone})
-
-        assert os.path.getmtime('my_file') == expected_modified_at.timestamp()
-
-
 @pytest.mark.parametrize(
     "method",
     [
         ZIP_32,
         ZIP_64,
+        ZIP_AUTO(200001),
         NO_COMPRESSION_64,
-        NO_COMPRESSION_64(18, 1571107898),
+        NO_COMPRESSION_64(200001, zlib.crc32(b'a' * 100000 + b'b' * 100000 + b'c')),
         NO_COMPRESSION_32,
-        NO_COMPRESSION_32(18, 1571107898),
+        NO_COMPRESSION_32(200001, zlib.crc32(b'a' * 100000 + b'b' * 100000 + b'c')),
     ],
 )
-def test_password_unzips_with_stream_unzip(method):
+def test_async_stream_zip_equivalent_to_stream_zip(method, password):
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
-    password = secrets.token_urlsafe(32)
 
-    files = (
-        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
-    )
+    def get_crypto_random(num_bytes):
+        return b'-' * num_bytes
 
-    assert b''.join(
-        chunk
-        for _, _, chunks in stream_unzip(stream_zip(files, password=password), password=password)
-        for chunk in chunks
-    ) == b'a' * 9 + b'b' * 9
+    def sync_files():
+        yield 'file-1', now, mode, method, (b'a' * 100000, b'b' * 100000, b'c')
+        yield 'file-2', now, mode, ZIP_64, ()
+
+    async def async_files():
+        async def data_1():
+            yield b'a' * 100000
+            yield b'b' * 100000
+            yield b'c'
+
+        async def data_2():
+            for _ in ():
+                yield _
+
+        yield 'file-1', now, mode, method, data_1()
+        yield 'file-2', now, mode, ZIP_64, data_2()
+
+    async def async_chunks():
+        return [
+            chunk async for chunk in
+            async_stream_zip(async_files(), password=password, get_crypto_random=get_crypto_random)
+        ]
+
+    assert list(stream_zip(sync_files(), password=password, get_crypto_random=get_crypto_random)) \
+        == asyncio.get_event_loop().run_until_complete(async_chunks())
 
 
 @pytest.mark.parametrize(
     "method",
     [
-        ZIP_32,
-        ZIP_64,
-        NO_COMPRESSION_64,
-        NO_COMPRESSION_64(18, 1571107898),
-        NO_COMPRESSION_32,
-        NO_COMPRESSION_32(18, 1571107898),
+        NO_COMPRESSION_32_TWO_PASS,
+        NO_COMPRESSION_64_TWO_PASS,
     ],
 )
-def test_bad_password_not_unzips_with_stream_unzip(method):
+def test_async_stream_zip_two_pass_equivalent_to_stream_zip(method):
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
-    password = secrets.token_urlsafe(32)
 
-    files = (
-        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
-    )
+    def sync_files():
+        yield 'file-1', now, mode, method, lambda: (b'a' * 100000, b'b' * 100000, b'c')
 
-    with pytest.raises(IncorrectAESPasswordError):
-        list(stream_unzip(stream_zip(files, password=password), password='not'))
+    async def async_files():
+        async def data_1():
+            yield b'a' * 100000
+            yield b'b' * 100000
+            yield b'c'
+
+        yield 'file-1', now, mode, method, data_1
+
+    async def async_chunks():
+        return [chunk async for chunk in async_stream_zip(async_files())]
+
+    assert list(stream_zip(sync_files())) == asyncio.get_event_loop().run_until_complete(async_chunks())
 
 
 @pytest.mark.parametrize(
-    "method",
+    "chunk_size,expected_in_thread",
     [
-        ZIP_32,
-        ZIP_64,
-        NO_COMPRESSION_64,
-        NO_COMPRESSION_64(18, 1571107898),
-        NO_COMPRESSION_32,
-        NO_COMPRESSION_32(18, 1571107898),
+        (1000, False),
+        (100000, True),
     ],
 )
-def test_password_unzips_with_7z(method):
+def test_async_stream_zip_only_large_chunks_in_thread(chunk_size, expected_in_thread):
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
-    password = secrets.token_urlsafe(32)
 
-    files = (
-        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
-    )
+    async def async_data():
+        for _ in range(0, 10):
+            yield b'-' * chunk_size
 
-    with \
-            TemporaryDirectory() as d, \
-            cwd(d): \
+    async def async_files():
+        yield 'file-1', now, mode, ZIP_64, async_data()
+        yield 'file-2', now, mode, NO_COMPRESSION_64, async_data()
 
-        with open('test.zip', 'wb') as fp:
-            for zipped_chunk in stream_zip(files, password=password):
-                fp.write(zipped_chunk)
+    loop = asyncio.get_event_loop()
+    in_thread = []
+    original_run_in_executor = loop.run_in_executor
 
-        r = subprocess.run(['7zz', '-p' + password, 'e', 'test.zip'])
-        assert r.returncode == 0
+    def run_in_executor(executor, func, *args):
+        in_thread.append(func)
+        return original_run_in_executor(executor, func, *args)
 
-        for file in files:
-            with open(file[0], 'rb') as f:
-                assert f.read() == (b'a' * 9 ) + (b'b' * 9)
+    async def test():
+        async for chunk in async_stream_zip(async_files()):
+            pass
+
+    loop.run_in_executor = run_in_executor
+    try:
+        loop.run_until_complete(test())
+    finally:
+        del loop.run_in_executor
+
+    assert bool(in_thread) == expected_in_thread
+    assert len(in_thread) <= 10
 
 
 @pytest.mark.parametrize(
-    "method",
+    "password",
     [
-        ZIP_32,
-        ZIP_64,
-        NO_COMPRESSION_64,
-        NO_COMPRESSION_64(18, 1571107898),
-        NO_COMPRESSION_32,
-        NO_COMPRESSION_32(18, 1571107898),
+        None,
+        'my-password',
     ],
 )
-def test_password_unzips_with_pyzipper(method):
+@pytest.mark.parametrize(
+    "get_executor",
+    [
+        lambda: None,
+        lambda: FairScheduler(max_workers=2),
+        lambda: ThreadPoolExecutor(max_workers=2),
+    ],
+)
+def test_async_stream_zip_producer_thread_equivalent_to_stream_zip(password, get_executor):
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
-    password = secrets.token_urlsafe(32)
+    batch = os.urandom(100000)
 
-    files = (
-        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
-    )
+    def get_crypto_random(num_bytes):
+        return b'-' * num_bytes
 
-    with \
-            TemporaryDirectory() as d, \
-            cwd(d): \
+    def sync_files():
+        for i in range(0, 10):
+            yield f'file-{i}', now, mode, ZIP_32, (batch,) * i
+            yield f'file-{i}-stored', now, mode, NO_COMPRESSION_64, (batch,) * i
 
-        with open('test.zip', 'wb') as fp:
-            for zipped_chunk in stream_zip(files, password=password):
-                fp.write(zipped_chunk)
+    async def async_files():
+        async def data(i):
+            for _ in range(0, i):
+                yield batch
 
-        with pyzipper.AESZipFile('test.zip') as zf:
-            zf.setpassword(password.encode())
-            zf.testzip()
-            assert zf.read('file-1') == (b'a' * 9 ) + (b'b' * 9)
+        for i in range(0, 10):
+            yield f'file-{i}', now, mode, ZIP_32, data(i)
+            yield f'file-{i}-stored', now, mode, NO_COMPRESSION_64, data(i)
+
+    async def async_chunks():
+        return [
+            chunk async for chunk in
+            async_stream_zip(async_files(), password=password, get_crypto_random=get_crypto_random,
+                             producer_thread=True, high_watermark=200000, low_watermark=100000,
+                             executor=get_executor())
+        ]
+
+    assert list(stream_zip(sync_files(), password=password, get_crypto_random=get_crypto_random)) \
+        == asyncio.get_event_loop().run_until_complete(async_chunks())
 
 
 @pytest.mark.parametrize(
-    "method",
+    "get_executor",
     [
-        ZIP_32,
-        ZIP_64,
-        NO_COMPRESSION_64,
-        NO_COMPRESSION_64(18, 1571107898),
-        NO_COMPRESSION_32,
-        NO_COMPRESSION_32(18, 1571107898),
+        lambda: None,
+        lambda: FairScheduler(max_workers=2),
     ],
 )
-def test_password_bytes_not_deterministic(method):
+def test_async_stream_zip_producer_thread_backpressure(get_executor):
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
-    password = secrets.token_urlsafe(32)
 
-    files = (
-        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
-    )
+    num_in = 0
 
-    assert b''.join(stream_zip(files, password=password)) != b''.join(stream_zip(files, password=password))
+    async def async_data():
+        nonlocal num_in
+        for i in range(0, 1000):
+            num_in += 1
+            yield b'-' * 64000
+
+    async def async_files():
+        yield 'file-1', now, mode, NO_COMPRESSION_64(64000000, zlib.crc32(b'-' * 64000000)), async_data()
+
+    async def test():
+        it = async_stream_zip(async_files(), producer_thread=True, high_watermark=640000, low_watermark=320000,
+                              executor=get_executor()).__aiter__()
+        await it.__anext__()
+        await asyncio.sleep(0.5)
+        num_in_after_sleep = num_in
+        await it.__anext__()
+        await asyncio.sleep(0.5)
+        await it.aclose()
+        return num_in_after_sleep, num_in
+
+    num_in_after_sleep, num_in_after_next = asyncio.get_event_loop().run_until_complete(test())
+    assert 10 <= num_in_after_sleep <= 12
+    assert num_in_after_next == num_in_after_sleep
 
 
 @pytest.mark.parametrize(
-    "method",
+    "get_executor",
     [
-        ZIP_32,
-        ZIP_64,
-        NO_COMPRESSION_64,
-        NO_COMPRESSION_64(18, 1571107898),
-        NO_COMPRESSION_32,
-        NO_COMPRESSION_32(18, 1571107898),
+        lambda: None,
+        lambda: FairScheduler(max_workers=2),
     ],
 )
-def test_crc_32_not_in_file(method):
-    # AE-2 should not have the CRC_32, so we check that the CRC_32 isn't anywhere in the file. This
-    # is "too strong" as check, because it could just happen to appear in the cipher text, which
-    # would be fine. The cipher text is by default non-deterministic due to its random salt, and
-    # so this could be a flaky test and faily randomly. To make the test not flaky, we make the
-    # bytes of the file completely deterministic, by forcing the random numbers used to generate
-    # the salt to be non-random
-
+def test_async_producer_thread_exception_from_bytes_propagates(get_executor):
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
-    password = secrets.token_urlsafe(32)
-
-    files = (
-        ('file-1', now, mode, method, (b'a' * 9, b'b' * 9)),
-    )
-    crc_32 = Struct('<I').pack(1571107898)
 
-    # To make sure we've got the correct CRC_32...
-    assert crc_32 in b''.join(stream_zip(files))
+    async def async_data():
+        yield b'-'
+        raise Exception('From generator')
 
-    # ... to assert on the lack of it if we're using a password
-    encrypted_bytes = b''.join(stream_zip(files, password=password, get_crypto_random=lambda num_bytes: b'-' * num_bytes))
-    assert crc_32 not in encrypted_bytes
+    async def async_files():
+        yield 'file-1', now, mode, ZIP_64, async_data()
 
-    # ... and we can just out of paranoia check check substrings of it are not in the file, in case
-    # somehow we're leaking part of it. It's not perfect, but it's probably the best we can do
-    # and will catch the most likely cases of just not enabling the logic to hide it
-    assert crc_32[0:2] not in encrypted_bytes
-    assert crc_32[1:3] not in encrypted_bytes
-    assert crc_32[2:4] not in encrypted_bytes
-    assert crc_32[0:3] not in encrypted_bytes
-    assert crc_32[1:4] not in encrypted_bytes
+    async def test():
+        async for chunk in async_stream_zip(async_files(), producer_thread=True, executor=get_executor()):
+            pass
 
+    with pytest.raises(Exception,  match='From generator'):
+        asyncio.get_event_loop().run_until_complete(test())
 
-###################################################################################################
-# Tests of sync interface: async_stream_zip
-#
-# Under the hood we know that async_stream_zip delegates to stream_zip, so there isn't as much
-# of a need to test everything. We have a brief test that it seems to work in one case, but
-# otherwise focus on the riskiest parts: that exceptions don't propagate, that the async version
-# doesn't actually stream, or that context vars are not propagated properly
 
-def test_async_stream_zip_equivalent_to_stream_unzip_zip_32_and_zip_64():
+def test_async_stream_zip_fair_scheduler_equivalent_to_stream_zip():
     now = datetime.strptime('2021-01-01 21:01:12', '%Y-%m-%d %H:%M:%S')
     mode = stat.S_IFREG | 0o600
+    batch = os.urandom(100000)
 
     def sync_files():
-        yield 'file-1', now, mode, ZIP_64, (b'a' * 10000, b'b' * 10000)
-        yield 'file-2', now, mode, ZIP_32, (b'c', b'd')
+        for i in range(0, 5):
+            yield f'file-{i}', now, mode, ZIP_32, (batch,) * i
 
     async def async_files():
-        async def data_1():
-            yield b'a' * 10000
-            yield b'b' * 10000
+        async def data(i):
+            for _ in range(0, i):
+                yield batch
 
-        async def data_2():
-            yield b'c'
-            yield b'd'
+        for i in range(0, 5):
+            yield f'file-{i}', now, mode, ZIP_32, data(i)
 
-        yield 'file-1', now, mode, ZIP_64, data_1()
-        yield 'file-2', now, mode, ZIP_32, data_2()
+    scheduler = FairScheduler(max_workers=2)
 
-    # Might not be performant, but good enough for the test
     async def async_concat(chunks):
-        result = b''
-        async for chunk in chunks:
-            result += chunk
-        return result
+        return b''.join([chunk async for chunk in chunks])
 
-    async def test():
-        assert b''.join(stream_zip(sync_files())) == await async_concat(async_stream_zip(async_files()))
+    async def async_chunks():
+        return await asyncio.gather(*(
+            async_concat(async_stream_zip(async_files(), executor=scheduler, producer_thread=producer_thread))
+            for producer_thread in (False, True, False, True)
+        ))
 
-    asyncio.get_event_loop().run_until_complete(test())
+    expected = b''.join(stream_zip(sync_files()))
+    assert asyncio.get_event_loop().run_until_complete(async_chunks()) == [expected] * 4
+    scheduler.shutdown()
+
+
+def test_fair_scheduler_round_robin_between_archives():
+    scheduler = FairScheduler(max_workers=1)
+    archive_1 = scheduler._for_archive()
+    archive_2 = scheduler._for_archive()
+
+    started = threading.Event()
+    blocked = threading.Event()
+    order = []
+
+    def block():
+        started.set()
+        blocked.wait()
+
+    scheduler.submit(block)
+    started.wait()
+    futures = [archive_1.submit(order.append, 1) for _ in range(0, 3)] + \
+        [archive_2.submit(order.append, 2) for _ in range(0, 2)]
+    assert scheduler.queue_depth == 5
+
+    blocked.set()
+    for future in futures:
+        future.result()
+
+    assert order == [1, 2, 1, 2, 1]
+    assert scheduler.queue_depth == 0
+    scheduler.shutdown()
+
+
+def test_fair_scheduler_max_workers_per_archive():
+    scheduler = FairScheduler(max_workers=4, max_workers_per_archive=2)
+    archive = scheduler._for_archive()
+
+    condition = threading.Condition()
+    running = 0
+    max_running = 0
+
+    def task():
+        nonlocal running, max_running
+        with condition:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.05)
+        with condition:
+            running -= 1
+
+    for future in [archive.submit(task) for _ in range(0, 8)]:
+        future.result()
+
+    assert max_running == 2
+    scheduler.shutdown()
+
+
+def test_fair_scheduler_shutdown():
+    scheduler = FairScheduler(max_workers=1)
+    future = scheduler.submit(lambda: 1)
+    scheduler.shutdown()
+    assert future.result() == 1
+
+    with pytest.raises(RuntimeError):
+        scheduler.submit(lambda: 1)
 
 
 def test_async_exception_propagates():
@@ -1454,7 +3710,16 @@ def test_async_stream_zip_does_stream():
     sys.version_info[:2] < (3,7,0),
     reason="contextvars are not supported before Python 3.7.0",
 )
-def test_copy_of_context_variable_available_in_iterable():
+@pytest.mark.parametrize(
+    "producer_thread,get_executor",
+    [
+        (False, lambda: None),
+        (True, lambda: None),
+        (False, lambda: FairScheduler(max_workers=2)),
+        (True, lambda: FairScheduler(max_workers=2)),
+    ],
+)
+def test_copy_of_context_variable_available_in_iterable(producer_thread, get_executor):
     # Ideally the context would be identical in the iterables, because that's what a purely asyncio
     # implementation of stream-zip would likely do
 
@@ -1488,7 +3753,7 @@ def test_copy_of_context_variable_available_in_iterable():
         yield 'file-1', now, mode, ZIP_64, data_1()
 
     async def test():
-        async for chunk in async_stream_zip(async_files()):
+        async for chunk in async_stream_zip(async_files(), producer_thread=producer_thread, executor=get_executor()):
             pass
 
     asyncio.get_event_loop().run_until_complete(test())